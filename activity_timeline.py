@@ -0,0 +1,270 @@
+"""
+Timeline compatta dell'attività per telecamera e giorno.
+
+Ogni giorno di ogni telecamera è un file di dimensione fissa con un byte per
+secondo: 0 = nessuna analisi, 1-255 = punteggio di movimento massimo del
+secondo (1 + millesimi di pixel cambiati, saturato). Un giorno occupa circa
+88 KB e si legge tramite mmap: "quando c'è stata attività ieri su X" diventa
+la scansione di pochi KB invece dell'analisi del video.
+
+I punteggi arrivano dal rilevatore di movimento, vengono accumulati in
+memoria e scritti con pwrite a intervalli regolari; il file viene creato
+subito alla dimensione finale, quindi i lettori (anche da altri processi,
+come il bot) non vedono mai un file che cambia lunghezza.
+"""
+
+import logging
+import mmap
+import os
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+# Cartella (nella cartella registrazioni) della timeline
+TIMELINE_DIRNAME = ".timeline"
+TIMELINE_EXTENSION = ".act"
+
+# Secondi per file: 25 ore, per contenere anche il giorno del cambio dall'ora legale
+DAY_SLOTS = 25 * 3600
+
+# Scrittura dei punteggi accumulati
+FLUSH_INTERVAL = 5
+
+# Giorni di timeline conservati
+TIMELINE_MAX_DAYS = 400
+
+# Punteggio minimo (frazione di pixel) di un secondo "attivo" nei riepiloghi
+DEFAULT_ACTIVE_SCORE = 0.01
+
+SPARKLINE = " ▁▂▃▄▅▆▇█"
+
+
+def encode_score(score):
+    """Punteggio (frazione di pixel cambiati) -> valore del byte (1-255)"""
+    return 1 + min(254, int(round(score * 1000)))
+
+
+def decode_score(value):
+    """Valore del byte -> punteggio (None se il secondo non è stato analizzato)"""
+    return (value - 1) / 1000 if value else None
+
+
+def _midnight(day):
+    return datetime(day.year, day.month, day.day).timestamp()
+
+
+class ActivityTimeline:
+    """File giornalieri dell'attività per telecamera, con scrittura accumulata."""
+
+    def __init__(self, directory, flush_interval=FLUSH_INTERVAL):
+        """
+        Args:
+            directory (str): Cartella della timeline
+            flush_interval (float): Secondi tra due scritture dei punteggi accumulati
+        """
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._pending = {}  # (telecamera, giorno) -> {slot: valore}
+        self._fds = {}  # (telecamera, giorno) -> fd aperto in scrittura
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, camera, day):
+        return os.path.join(self.directory, camera, day.isoformat() + TIMELINE_EXTENSION)
+
+    @staticmethod
+    def slot_of(ts):
+        """(giorno locale, secondo dall'inizio del giorno) di un timestamp"""
+        day = datetime.fromtimestamp(ts).date()
+        return day, int(ts - _midnight(day))
+
+    # --- Scrittura -----------------------------------------------------
+
+    def record(self, camera, ts, score):
+        """Registra il punteggio di un fotogramma (listener di MotionMonitor)"""
+        day, slot = self.slot_of(ts)
+        value = encode_score(score)
+        with self._lock:
+            slots = self._pending.setdefault((camera, day), {})
+            if value > slots.get(slot, 0):
+                slots[slot] = value
+
+    def start(self):
+        threading.Thread(target=self._run, name="activity-timeline", daemon=True).start()
+        logging.info(f"📈 Timeline attività in {self.directory}")
+
+    def _run(self):
+        last_prune = 0
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+                if time.time() - last_prune > 86400:
+                    self.prune()
+                    last_prune = time.time()
+            except Exception as e:
+                logging.error(f"❌ Errore scrittura timeline attività: {e}")
+
+    def flush(self):
+        """Scrive i punteggi accumulati nei file dei rispettivi giorni"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for key, slots in pending.items():
+            fd = self._open_for_write(*key)
+            for slot, value in slots.items():
+                # Un secondo può arrivare in due giri diversi: vince il massimo
+                current = os.pread(fd, 1, slot)
+                if not current or value > current[0]:
+                    os.pwrite(fd, bytes((value,)), slot)
+        # Tiene aperti solo i file dei giorni ancora in scrittura
+        today = date.today()
+        for key in [key for key in self._fds if key[1] < today - timedelta(days=1)]:
+            os.close(self._fds.pop(key))
+
+    def _open_for_write(self, camera, day):
+        fd = self._fds.get((camera, day))
+        if fd is None:
+            path = self.path(camera, day)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            if os.fstat(fd).st_size < DAY_SLOTS:
+                os.ftruncate(fd, DAY_SLOTS)  # file sparso di dimensione fissa
+            self._fds[(camera, day)] = fd
+        return fd
+
+    def prune(self, max_days=TIMELINE_MAX_DAYS):
+        """Elimina i file dei giorni più vecchi di `max_days`"""
+        limit = (date.today() - timedelta(days=max_days)).isoformat()
+        for camera in self.cameras():
+            camera_dir = os.path.join(self.directory, camera)
+            for name in os.listdir(camera_dir):
+                if name.endswith(TIMELINE_EXTENSION) and name[:-len(TIMELINE_EXTENSION)] < limit:
+                    os.unlink(os.path.join(camera_dir, name))
+
+    # --- Lettura -------------------------------------------------------
+
+    def cameras(self):
+        try:
+            return sorted(name for name in os.listdir(self.directory)
+                          if os.path.isdir(os.path.join(self.directory, name)))
+        except FileNotFoundError:
+            return []
+
+    def _read_day(self, camera, day, first, last, days=None):
+        """
+        Byte dei secondi [first, last) di un giorno (None se il giorno non esiste).
+
+        Con `days` (dizionario del chiamante) ogni giorno si legge una sola
+        volta per intero e le letture successive sono fette in memoria.
+        """
+        if days is not None:
+            if (camera, day) not in days:
+                days[(camera, day)] = self._read_day(camera, day, 0, DAY_SLOTS)
+            data = days[(camera, day)]
+            return None if data is None else data[first:last]
+        try:
+            with open(self.path(camera, day), "rb") as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    return data[first:last]
+        except (FileNotFoundError, ValueError):  # ValueError: file vuoto
+            return None
+
+    def values(self, camera, start_ts, end_ts, days=None):
+        """
+        Valori grezzi al secondo dell'intervallo, anche su più giorni
+        (`days`: cache dei giorni letti, vedi _read_day).
+
+        Returns:
+            list: (timestamp del primo secondo, bytes) per ogni giorno con dati
+        """
+        chunks = []
+        ts = int(start_ts)
+        while ts < end_ts:
+            day, first = self.slot_of(ts)
+            next_day = _midnight(day + timedelta(days=1))
+            last = first + int(min(end_ts, next_day) - ts)
+            data = self._read_day(camera, day, first, min(last, DAY_SLOTS), days)
+            if data:
+                chunks.append((ts, data))
+            ts = int(next_day)
+        return chunks
+
+    def summary(self, camera, start_ts, end_ts, bucket_seconds=3600):
+        """
+        Punteggio massimo per intervallo di `bucket_seconds` (riepilogo sottocampionato).
+
+        Returns:
+            list: (inizio intervallo, punteggio massimo o None senza analisi)
+        """
+        # Stesso inizio intero dei blocchi di values(): con un start_ts frazionario
+        # il primo intervallo risulterebbe -1 e vuoto
+        start_ts = int(start_ts)
+        buckets = {}
+        for chunk_start, data in self.values(camera, start_ts, end_ts):
+            offset = 0
+            while offset < len(data):
+                bucket = int((chunk_start + offset - start_ts) // bucket_seconds)
+                bucket_end = int(start_ts + (bucket + 1) * bucket_seconds - chunk_start)
+                peak = max(data[offset:bucket_end])
+                if peak:
+                    buckets[bucket] = max(buckets.get(bucket, 0), peak)
+                offset = bucket_end
+        count = int(-(-(end_ts - start_ts) // bucket_seconds))
+        return [(start_ts + i * bucket_seconds, decode_score(buckets.get(i, 0))) for i in range(count)]
+
+    def busy_periods(self, camera, start_ts, end_ts, min_score=DEFAULT_ACTIVE_SCORE, max_gap=30):
+        """
+        Periodi di attività: secondi sopra `min_score` uniti se distano meno di `max_gap`.
+
+        Returns:
+            list: dict con start_ts, end_ts, peak
+        """
+        threshold = encode_score(min_score)
+        # Secondi attivi -> 1, gli altri -> 0: le sequenze si trovano con find() in C
+        table = bytes(int(value >= threshold) for value in range(256))
+        periods = []
+        for chunk_start, data in self.values(camera, start_ts, end_ts):
+            active = data.translate(table)
+            run_end = 0
+            while True:
+                run_start = active.find(1, run_end)
+                if run_start < 0:
+                    break
+                run_end = active.find(0, run_start)
+                if run_end < 0:
+                    run_end = len(active)
+                peak = max(data[run_start:run_end])
+                if periods and chunk_start + run_start - periods[-1]["end_ts"] <= max_gap:
+                    periods[-1]["end_ts"] = chunk_start + run_end
+                    periods[-1]["peak"] = max(periods[-1]["peak"], peak)
+                else:
+                    periods.append({"start_ts": chunk_start + run_start, "end_ts": chunk_start + run_end,
+                                    "peak": peak})
+        for period in periods:
+            period["peak"] = decode_score(period["peak"])
+        return periods
+
+    def has_activity(self, camera, start_ts, end_ts, min_score=DEFAULT_ACTIVE_SCORE, days=None):
+        """
+        Indica se c'è almeno un secondo attivo nell'intervallo
+        (`days`: cache dei giorni letti, vedi _read_day).
+
+        Returns:
+            bool | None: None se l'intervallo non è mai stato analizzato
+        """
+        peak = max((max(data) for _, data in self.values(camera, start_ts, end_ts, days) if data), default=0)
+        if not peak:
+            return None
+        return peak >= encode_score(min_score)
+
+
+def sparkline(scores, full_scale=0.1):
+    """Riga di blocchi per una serie di punteggi (None = nessuna analisi)"""
+    chars = []
+    for score in scores:
+        if score is None:
+            chars.append("·")
+        else:
+            level = min(len(SPARKLINE) - 1, int(round(score / full_scale * (len(SPARKLINE) - 1))))
+            chars.append(SPARKLINE[level])
+    return "".join(chars)
@@ -181,7 +181,7 @@ def list_cameras():
     
     # Filtra solo le sezioni che rappresentano telecamere
     cameras = [section for section in config.sections() 
-               if section not in ["Logging", "LANGUAGE", "STORAGE", "TELEGRAM"]]
+               if section not in ["Logging", "LANGUAGE", "STORAGE", "TELEGRAM", "MOTION", "RESTREAM", "HTTP", "HLS", "THUMBNAILS"]]
     
     print("=" * 50)
     print(get_translation("add_camera", "cameras_configured"))
@@ -0,0 +1,246 @@
+"""
+Esportazione di clip dalle registrazioni senza ricodifica video.
+
+Dato telecamera e intervallo, i segmenti che lo coprono si trovano con
+l'indice (camera, start_ts) del catalogo; ffmpeg li concatena con il
+demuxer concat in stream copy, usando inpoint/outpoint sul primo e
+sull'ultimo segmento. In stream copy il taglio cade sul keyframe più vicino
+prima dell'inizio richiesto (letto dall'indice dei keyframe, se presente),
+quindi il video non viene mai decodificato e una clip di qualche minuto è
+pronta in pochi secondi.
+
+Uso da riga di comando:
+
+    python3 clip_exporter.py Ingresso 14:02 14:09
+"""
+
+import logging
+import os
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+# Cartella (nella cartella registrazioni) delle clip esportate
+CLIPS_DIRNAME = ".clips"
+
+# Tempo massimo per l'esportazione di una clip
+EXPORT_TIMEOUT = 120
+
+# Le clip esportate restano in cache per 24 ore
+CLIP_MAX_AGE = 24 * 3600
+
+# Formati accettati per inizio e fine della clip
+_TIME_FORMATS = ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M")
+_CLOCK_FORMATS = ("%H:%M:%S", "%H:%M")
+
+
+class ClipExportError(Exception):
+    """Clip non esportabile (nessun segmento, intervallo non valido, errore ffmpeg)."""
+
+
+def parse_clip_time(text, reference=None):
+    """
+    Interpreta un orario di inizio/fine clip.
+
+    Accetta "HH:MM[:SS]" (giorno di `reference`, default oggi) oppure
+    "YYYY-MM-DD HH:MM[:SS]".
+
+    Returns:
+        float: Timestamp
+    """
+    text = text.strip()
+    for fmt in _TIME_FORMATS:
+        try:
+            return datetime.strptime(text, fmt).timestamp()
+        except ValueError:
+            pass
+    day = (reference or datetime.now()).date()
+    for fmt in _CLOCK_FORMATS:
+        try:
+            clock = datetime.strptime(text, fmt).time()
+            return datetime.combine(day, clock).timestamp()
+        except ValueError:
+            pass
+    raise ClipExportError(f"Orario non valido: {text}")
+
+
+def parse_clip_range(start_text, end_text):
+    """
+    Interpreta un intervallo; se la fine (solo orario) precede l'inizio,
+    si intende il giorno successivo (es. 23:55 → 00:05).
+
+    Returns:
+        tuple: (inizio, fine) come timestamp
+    """
+    start_ts = parse_clip_time(start_text)
+    end_ts = parse_clip_time(end_text, reference=datetime.fromtimestamp(start_ts))
+    if end_ts <= start_ts:
+        end_ts = (datetime.fromtimestamp(end_ts) + timedelta(days=1)).timestamp()
+    return start_ts, end_ts
+
+
+def clip_filename(camera, start_ts, end_ts, extension="mp4"):
+    """Nome deterministico della clip, usato anche come chiave di cache"""
+    start = time.strftime("%Y%m%dT%H%M%S", time.localtime(start_ts))
+    end = time.strftime("%Y%m%dT%H%M%S", time.localtime(end_ts))
+    return f"{camera}_{start}-{end}.{extension}"
+
+
+def _concat_quote(path):
+    """Quota un percorso per il file di input del demuxer concat"""
+    return "'" + path.replace("'", "'\\''") + "'"
+
+
+class ClipExporter:
+    """Esporta intervalli di registrazione in un unico file, in stream copy."""
+
+    def __init__(self, catalog, output_dir, resolve=None, max_duration=3600, keyframes=None):
+        """
+        Args:
+            catalog (SegmentCatalog): Catalogo dei segmenti
+            output_dir (str): Cartella delle clip esportate
+            resolve (callable): percorso catalogo -> percorso attuale (livelli hot/cold)
+            max_duration (int): Durata massima di una clip in secondi
+            keyframes (KeyframeIndex): Indice dei keyframe per allineare l'inizio (opzionale)
+        """
+        self.catalog = catalog
+        self.output_dir = output_dir
+        self.resolve = resolve or (lambda path: path if os.path.exists(path) else None)
+        self.max_duration = max_duration
+        self.keyframes = keyframes
+        os.makedirs(output_dir, exist_ok=True)
+
+    def prune(self, max_age=CLIP_MAX_AGE):
+        """Elimina le clip in cache più vecchie di `max_age` secondi"""
+        limit = time.time() - max_age
+        with os.scandir(self.output_dir) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file() and entry.stat().st_mtime < limit:
+                        os.unlink(entry.path)
+                except FileNotFoundError:
+                    pass
+
+    def plan(self, camera, start_ts, end_ts):
+        """
+        Segmenti che coprono l'intervallo, con inpoint/outpoint relativi.
+
+        Returns:
+            list: dict con path, inpoint, outpoint (None = intero segmento)
+        """
+        if end_ts <= start_ts:
+            raise ClipExportError("La fine della clip deve seguire l'inizio")
+        if end_ts - start_ts > self.max_duration:
+            raise ClipExportError(f"Clip troppo lunga (massimo {self.max_duration // 60} minuti)")
+
+        parts = []
+        for segment in self.catalog.segments_between(camera, start_ts, end_ts):
+            path = self.resolve(segment["path"])
+            if path is None:
+                logging.warning(f"⚠️ Segmento non più presente: {segment['path']}")
+                continue
+            inpoint = start_ts - segment["start_ts"] if segment["start_ts"] < start_ts else None
+            if inpoint is not None and self.keyframes is not None:
+                # Il taglio in stream copy parte comunque dal keyframe precedente:
+                # usandolo come inpoint l'inizio dichiarato della clip è quello reale
+                keyframe = self.keyframes.keyframe_before(segment["path"], start_ts)
+                if keyframe is not None:
+                    inpoint = keyframe[0] or None
+            outpoint = end_ts - segment["start_ts"] if segment["end_ts"] > end_ts else None
+            parts.append({"path": path, "start_ts": segment["start_ts"], "end_ts": segment["end_ts"],
+                          "inpoint": inpoint, "outpoint": outpoint})
+        if not parts:
+            raise ClipExportError(f"Nessuna registrazione di {camera} nell'intervallo richiesto")
+        return parts
+
+    def export(self, camera, start_ts, end_ts, output_path=None):
+        """
+        Esporta la clip.
+
+        Returns:
+            dict: path, camera, start_ts, end_ts (coperti davvero), segments, size, elapsed, cached
+        """
+        started = time.time()
+        parts = self.plan(camera, start_ts, end_ts)
+        covered_start = parts[0]["start_ts"] + (parts[0]["inpoint"] or 0)
+        covered_end = min(end_ts, parts[-1]["end_ts"])
+        # Il nome usa la fine coperta: una clip ancora incompleta non viene riusata
+        # quando la stessa richiesta arriva dopo la chiusura degli altri segmenti
+        output_path = output_path or os.path.join(self.output_dir, clip_filename(camera, start_ts, covered_end))
+
+        result = {"path": output_path, "camera": camera, "start_ts": covered_start, "end_ts": covered_end,
+                  "segments": len(parts), "cached": False}
+        if os.path.exists(output_path):
+            result.update(size=os.path.getsize(output_path), elapsed=0.0, cached=True)
+            return result
+
+        self.prune()
+
+        with tempfile.NamedTemporaryFile("w", suffix=".ffconcat", dir=self.output_dir, delete=False) as listing:
+            listing.write("ffconcat version 1.0\n")
+            for part in parts:
+                listing.write(f"file {_concat_quote(part['path'])}\n")
+                if part["inpoint"] is not None:
+                    listing.write(f"inpoint {part['inpoint']:.3f}\n")
+                if part["outpoint"] is not None:
+                    listing.write(f"outpoint {part['outpoint']:.3f}\n")
+            list_path = listing.name
+
+        # Nome temporaneo univoco: esportazioni identiche in contemporanea (bot, CLI, HTTP)
+        # scrivono ciascuna sul proprio file e l'ultima a finire sostituisce l'altra
+        fd, partial = tempfile.mkstemp(suffix=".part", prefix=os.path.basename(output_path) + ".",
+                                       dir=os.path.dirname(output_path) or ".")
+        os.close(fd)
+        os.chmod(partial, 0o644)
+        command = ["ffmpeg", "-hide_banner", "-loglevel", "error", "-y",
+                   "-f", "concat", "-safe", "0", "-i", list_path,
+                   "-map", "0:v", "-map", "0:a?", "-c:v", "copy"]
+        # Il video non viene mai decodificato; l'audio G.711 di mkv/mpegts non entra in MP4
+        all_mp4 = all(part["path"].endswith(".mp4") for part in parts)
+        command += ["-c:a", "copy" if all_mp4 else "aac"]
+        command += ["-avoid_negative_ts", "make_zero", "-movflags", "+faststart", "-f", "mp4", partial]
+        try:
+            completed = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                       timeout=EXPORT_TIMEOUT, text=True)
+            if completed.returncode != 0:
+                raise ClipExportError(f"ffmpeg: {completed.stderr.strip()[-300:]}")
+            os.replace(partial, output_path)
+        except subprocess.TimeoutExpired:
+            raise ClipExportError(f"Esportazione oltre {EXPORT_TIMEOUT}s")
+        finally:
+            for path in (list_path, partial):
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+
+        result.update(size=os.path.getsize(output_path), elapsed=time.time() - started)
+        logging.info(f"🎬 Clip {camera} esportata: {os.path.basename(output_path)} "
+                     f"({len(parts)} segmenti, {result['size'] / (1024**2):.1f} MB, {result['elapsed']:.1f}s)")
+        return result
+
+
+if __name__ == "__main__":
+    import sys
+
+    import config
+    from segment_catalog import CATALOG_FILENAME, SegmentCatalog
+    from storage_tiering import resolve_segment_path
+    from keyframe_index import KEYFRAMES_DIRNAME, KeyframeIndex
+
+    if len(sys.argv) != 4:
+        print("Uso: python3 clip_exporter.py <telecamera> <inizio> <fine>")
+        sys.exit(1)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    catalog = SegmentCatalog(os.path.join(config.REGISTRAZIONI_DIR, CATALOG_FILENAME))
+    exporter = ClipExporter(catalog, os.path.join(config.REGISTRAZIONI_DIR, CLIPS_DIRNAME),
+                            resolve=lambda path: resolve_segment_path(path, config.HOT_TIER_DIR, config.STORAGE_VOLUMES),
+                            keyframes=KeyframeIndex(os.path.join(config.REGISTRAZIONI_DIR, KEYFRAMES_DIRNAME), workers=0))
+    try:
+        start, end = parse_clip_range(sys.argv[2], sys.argv[3])
+        print(exporter.export(sys.argv[1], start, end)["path"])
+    except ClipExportError as e:
+        print(f"❌ {e}")
+        sys.exit(1)
@@ -5,6 +5,15 @@ import sys
 import subprocess
 from security_manager import SecurityManager
 from secure_executor import SecureCommandExecutor
+from storage_layout import LAYOUT_FLAT, LAYOUTS, output_template
+from motion_detector import (DEFAULT_PIXEL_DELTA, DEFAULT_THRESHOLD, EVENT_COOLDOWN, MOTION_FPS, MOTION_HEIGHT,
+                             MOTION_WIDTH, parse_mask)
+from event_buffer import POST_EVENT_SECONDS, PRE_EVENT_SECONDS
+from http_server import DEFAULT_MAX_CONNECTIONS, DEFAULT_PORT as DEFAULT_HTTP_PORT
+from live_hls import DEFAULT_HLS_DIR, DEFAULT_IDLE_TIMEOUT, DEFAULT_MAX_STREAMS, DEFAULT_SEGMENT_SECONDS
+from thumbnail_cache import DEFAULT_MAX_AGE as DEFAULT_THUMBNAIL_MAX_AGE
+from ffmpeg_command import (AUDIO_CODECS, CONTAINERS, DEFAULT_CONTAINER, DEFAULT_SEGMENT_TIME, MAX_SEGMENT_TIME,
+                            MIN_SEGMENT_TIME, container_extension)
 
 # Usa la directory corrente come OUTPUT_DIR
 OUTPUT_DIR = os.getcwd()
@@ -38,6 +47,28 @@ CUSTOM_PATH = config.get("STORAGE", "CUSTOM_PATH", fallback="")
 STORAGE_SIZE = config.getint("STORAGE", "STORAGE_SIZE", fallback=450)
 STORAGE_MAX_USE = config.getfloat("STORAGE", "STORAGE_MAX_USE", fallback=0.90)
 
+# Politiche di conservazione: soglie di pulizia globali e limiti predefiniti per telecamera
+CLEANUP_HIGH_WATERMARK = config.getfloat("STORAGE", "CLEANUP_HIGH_WATERMARK", fallback=94.0)
+CLEANUP_LOW_WATERMARK = config.getfloat("STORAGE", "CLEANUP_LOW_WATERMARK", fallback=92.0)
+REBALANCE_WATERMARK = config.getfloat("STORAGE", "REBALANCE_WATERMARK", fallback=97.0)
+DEFAULT_MIN_RETENTION_DAYS = config.getfloat("STORAGE", "MIN_RETENTION_DAYS", fallback=0)
+DEFAULT_MAX_RETENTION_DAYS = config.getfloat("STORAGE", "MAX_RETENTION_DAYS", fallback=0)
+# Conservazione in base all'attività (richiede il rilevamento movimento, 0 = disattivato):
+# oltre la soglia si eliminano prima i segmenti inattivi più vecchi di IDLE_RETENTION_DAYS,
+# quelli con movimento restano fino a EVENT_RETENTION_DAYS (anche oltre MAX_RETENTION_DAYS)
+DEFAULT_IDLE_RETENTION_DAYS = config.getfloat("STORAGE", "IDLE_RETENTION_DAYS", fallback=0)
+DEFAULT_EVENT_RETENTION_DAYS = config.getfloat("STORAGE", "EVENT_RETENTION_DAYS", fallback=0)
+
+# Eliminazione in background: budget in MB/s (0 = illimitato) e passo di troncamento
+DELETE_RATE_MB_S = config.getfloat("STORAGE", "DELETE_RATE_MB_S", fallback=200)
+DELETE_TRUNCATE_STEP_MB = config.getint("STORAGE", "DELETE_TRUNCATE_STEP_MB", fallback=256)
+
+# Organizzazione dei segmenti su disco: "flat" o "sharded" ({camera}/{YYYY}/{MM}/{DD}/)
+STORAGE_LAYOUT = config.get("STORAGE", "LAYOUT", fallback=LAYOUT_FLAT).strip().lower()
+if STORAGE_LAYOUT not in LAYOUTS:
+    logging.warning(f"⚠️ Layout registrazioni sconosciuto '{STORAGE_LAYOUT}', uso '{LAYOUT_FLAT}'")
+    STORAGE_LAYOUT = LAYOUT_FLAT
+
 def mount_hard_drive():
     """ Monta l'hard disk esterno se necessario """
     if USE_EXTERNAL_DRIVE:
@@ -76,6 +107,90 @@ os.makedirs(REGISTRAZIONI_DIR, exist_ok=True)
 # 🔹 **Log del percorso della cartella di registrazione**
 logging.info(f"📂 Cartella registrazioni impostata su: {REGISTRAZIONI_DIR}")
 
+# Pool di volumi: punti di montaggio separati da virgola (vuoto = solo REGISTRAZIONI_DIR)
+STORAGE_POOL = [mount.strip() for mount in config.get("STORAGE", "POOL", fallback="").split(",") if mount.strip()]
+
+def _pool_volumes():
+    """Cartelle delle registrazioni sui volumi del pool effettivamente montati"""
+    volumes = []
+    for mount in STORAGE_POOL:
+        if not os.path.ismount(mount):
+            # Mai scrivere sul disco di sistema al posto di un volume non montato
+            logging.warning(f"⚠️ Volume del pool non montato, ignorato: {mount}")
+            continue
+        volume = os.path.abspath(os.path.join(mount, REC_FOLDER_NAME))
+        os.makedirs(volume, exist_ok=True)
+        volumes.append(volume)
+    return volumes or [os.path.abspath(REGISTRAZIONI_DIR)]
+
+STORAGE_VOLUMES = _pool_volumes()
+if len(STORAGE_VOLUMES) > 1:
+    logging.info(f"💽 Pool di registrazione: {', '.join(STORAGE_VOLUMES)}")
+
+# Con il pool la cartella principale non riceve nuove registrazioni, ma i segmenti
+# registrati prima restano nel catalogo e la conservazione continua a eliminarli
+LEGACY_RECORDINGS_DIR = "" if os.path.abspath(REGISTRAZIONI_DIR) in STORAGE_VOLUMES else os.path.abspath(REGISTRAZIONI_DIR)
+
+# Livello hot (SSD/disco locale) su cui scrive ffmpeg: i segmenti chiusi vengono
+# spostati sui volumi sopra (livello cold). Vuoto = registrazione diretta sul cold.
+HOT_TIER_DIR = config.get("STORAGE", "HOT_TIER_PATH", fallback="").strip()
+if HOT_TIER_DIR:
+    HOT_TIER_DIR = os.path.abspath(HOT_TIER_DIR)
+    if HOT_TIER_DIR in STORAGE_VOLUMES:
+        logging.warning("⚠️ Il livello hot coincide con un volume cold: livelli disattivati")
+        HOT_TIER_DIR = ""
+    else:
+        os.makedirs(HOT_TIER_DIR, exist_ok=True)
+        logging.info(f"⚡ Livello hot: {HOT_TIER_DIR}")
+TIER_MOVE_RATE_MB_S = config.getfloat("STORAGE", "TIER_MOVE_RATE_MB_S", fallback=80)
+
+# Thread che costruiscono l'indice dei keyframe dei segmenti chiusi (0 = disattivato)
+KEYFRAME_INDEX_WORKERS = config.getint("STORAGE", "KEYFRAME_INDEX_WORKERS", fallback=2)
+
+# Rilevamento movimento sui flussi secondari (attivato per telecamera con motion = true)
+MOTION_FPS = config.getfloat("MOTION", "FPS", fallback=MOTION_FPS)
+MOTION_WIDTH = config.getint("MOTION", "WIDTH", fallback=MOTION_WIDTH)
+MOTION_HEIGHT = config.getint("MOTION", "HEIGHT", fallback=MOTION_HEIGHT)
+MOTION_COOLDOWN = config.getfloat("MOTION", "COOLDOWN", fallback=EVENT_COOLDOWN)
+MOTION_NOTIFY = config.getboolean("MOTION", "NOTIFY", fallback=False)
+# Clip degli eventi con anticipo da un buffer in memoria (flusso "sub" o "main")
+EVENT_CLIPS = config.getboolean("MOTION", "EVENT_CLIPS", fallback=False)
+EVENT_PRE_SECONDS = config.getfloat("MOTION", "PRE_EVENT_SECONDS", fallback=PRE_EVENT_SECONDS)
+EVENT_POST_SECONDS = config.getfloat("MOTION", "POST_EVENT_SECONDS", fallback=POST_EVENT_SECONDS)
+EVENT_CLIP_SOURCE = config.get("MOTION", "EVENT_CLIP_SOURCE", fallback="auto").strip().lower()
+
+# Ritrasmissione: ffmpeg pubblica il flusso registrato sul server RTSP locale (MediaMTX),
+# così la telecamera riceve una sola connessione ({camera} = nome della telecamera)
+RESTREAM_ENABLED = config.getboolean("RESTREAM", "ENABLED", fallback=False)
+RESTREAM_URL = config.get("RESTREAM", "URL", fallback="rtsp://127.0.0.1:8554/{camera}").strip()
+
+# Server HTTP di riproduzione (consultazione remota via Tailscale)
+HTTP_ENABLED = config.getboolean("HTTP", "ENABLED", fallback=False)
+HTTP_PORT = config.getint("HTTP", "PORT", fallback=DEFAULT_HTTP_PORT)
+HTTP_MAX_CONNECTIONS = config.getint("HTTP", "MAX_CONNECTIONS", fallback=DEFAULT_MAX_CONNECTIONS)
+
+# Visione live HLS su richiesta (servita dal server HTTP, file su tmpfs)
+HLS_ENABLED = config.getboolean("HLS", "ENABLED", fallback=False)
+HLS_DIR = config.get("HLS", "DIR", fallback=DEFAULT_HLS_DIR).strip() or DEFAULT_HLS_DIR
+HLS_IDLE_TIMEOUT = config.getfloat("HLS", "IDLE_TIMEOUT", fallback=DEFAULT_IDLE_TIMEOUT)
+HLS_SEGMENT_SECONDS = config.getfloat("HLS", "SEGMENT_SECONDS", fallback=DEFAULT_SEGMENT_SECONDS)
+HLS_MAX_STREAMS = config.getint("HLS", "MAX_STREAMS", fallback=DEFAULT_MAX_STREAMS)
+
+# Miniature dell'ultimo fotogramma, estratte dal segmento in scrittura (larghezza 0 = originale)
+THUMBNAIL_MAX_AGE = config.getfloat("THUMBNAILS", "MAX_AGE", fallback=DEFAULT_THUMBNAIL_MAX_AGE)
+THUMBNAIL_WIDTH = config.getint("THUMBNAILS", "WIDTH", fallback=0)
+
+def _http_setting(key, default=""):
+    """Valore di [HTTP] o [TELEGRAM], decifrato se salvato con il prefisso ENC:"""
+    value = config.get(*key, fallback=default).strip()
+    if value.startswith("ENC:") and security_manager:
+        value = security_manager.decrypt_password(value[4:]) or ""
+    return value
+
+HTTP_TOKEN = _http_setting(("HTTP", "TOKEN"))
+# Indirizzo di ascolto: vuoto = IP Tailscale di [TELEGRAM] (solo locale se assente)
+HTTP_BIND = _http_setting(("HTTP", "BIND")) or _http_setting(("TELEGRAM", "ip")) or "127.0.0.1"
+
 # Recupera le credenziali di Telegram (con decifratura)
 def get_telegram_credentials():
     """Recupera le credenziali Telegram cifrate"""
@@ -132,7 +247,7 @@ def load_camera_config(config_path):
     
     cameras = []
     for section in config.sections():
-        if section.lower() in ["logging", "telegram", "storage", "language"]:
+        if section.lower() in ["logging", "telegram", "storage", "language", "motion", "restream", "http", "hls", "thumbnails"]:
             continue  # Salta le sezioni di sistema
         
         camera_name = section
@@ -166,11 +281,41 @@ def load_camera_config(config_path):
                 logging.error(f"Impossibile decifrare la password per {camera_name}")
                 continue
         
+        # Durata dei segmenti e contenitore per telecamera
+        segment_time = config.getint(section, "segment_time", fallback=DEFAULT_SEGMENT_TIME)
+        if not MIN_SEGMENT_TIME <= segment_time <= MAX_SEGMENT_TIME:
+            logging.warning(f"⚠️ segment_time non valido per {camera_name}: {segment_time}, uso {DEFAULT_SEGMENT_TIME}")
+            segment_time = DEFAULT_SEGMENT_TIME
+        container = config.get(section, "container", fallback=DEFAULT_CONTAINER).strip().lower()
+        if container not in CONTAINERS:
+            logging.warning(f"⚠️ Contenitore non supportato per {camera_name}: {container}, uso {DEFAULT_CONTAINER}")
+            container = DEFAULT_CONTAINER
+        audio = config.get(section, "audio", fallback="copy").strip().lower()
+        if audio not in AUDIO_CODECS:
+            logging.warning(f"⚠️ Audio non valido per {camera_name}: {audio}, uso copy")
+            audio = "copy"
+
+        # Flusso secondario (path2) e rilevamento del movimento
+        camera_path2 = config.get(section, "path2", fallback="").strip()
+        if camera_path2 and not security_manager.validate_path(camera_path2):
+            logging.error(f"Percorso secondario non valido per {camera_name}: {camera_path2}")
+            camera_path2 = ""
+        try:
+            motion_mask = parse_mask(config.get(section, "motion_mask", fallback=""))
+        except ValueError as e:
+            logging.warning(f"⚠️ motion_mask ignorata per {camera_name}: {e}")
+            motion_mask = []
+
         # Imposta il percorso di output per i file video nella cartella 'registrazioni'
-        output_path = os.path.join(REGISTRAZIONI_DIR, f"{camera_name}_%Y%m%dT%H%M%S.mkv")
+        output_path = output_template(REGISTRAZIONI_DIR, camera_name, STORAGE_LAYOUT, container_extension(container))
         
         # Costruisci l'URL RTSP per il flusso principale
         rtsp_url = f"rtsp://{camera_username}:{camera_password}@{camera_ip}:{camera_port}/{camera_path}"
+        sub_url = (f"rtsp://{camera_username}:{camera_password}@{camera_ip}:{camera_port}/{camera_path2}"
+                   if camera_path2 else "")
+        # Flusso ritrasmesso in locale: istantanee e buffer eventi lo leggono da qui
+        restream_url = (RESTREAM_URL.replace("{camera}", camera_name)
+                        if config.getboolean(section, "restream", fallback=RESTREAM_ENABLED) else "")
         
         camera = {
             "name": camera_name,
@@ -180,7 +325,24 @@ def load_camera_config(config_path):
             "username": camera_username,
             "password": camera_password,
             "url": rtsp_url,
-            "output": output_path
+            "output": output_path,
+            "segment_time": segment_time,
+            "container": container,
+            "audio": audio,
+            "sub_url": sub_url,
+            "restream_url": restream_url,
+            "live_url": restream_url or rtsp_url,
+            # Movimento: soglia in % di pixel cambiati, sensibilità come differenza di luminosità
+            "motion": config.getboolean(section, "motion", fallback=False),
+            "motion_threshold": config.getfloat(section, "motion_threshold", fallback=DEFAULT_THRESHOLD * 100) / 100,
+            "motion_pixel_delta": config.getint(section, "motion_pixel_delta", fallback=DEFAULT_PIXEL_DELTA),
+            "motion_mask": motion_mask,
+            # Conservazione per telecamera (0 = nessun limite)
+            "quota_bytes": int(config.getfloat(section, "quota_gb", fallback=0) * (1024 ** 3)),
+            "min_retention_days": config.getfloat(section, "min_retention_days", fallback=DEFAULT_MIN_RETENTION_DAYS),
+            "max_retention_days": config.getfloat(section, "max_retention_days", fallback=DEFAULT_MAX_RETENTION_DAYS),
+            "idle_retention_days": config.getfloat(section, "idle_retention_days", fallback=DEFAULT_IDLE_RETENTION_DAYS),
+            "event_retention_days": config.getfloat(section, "event_retention_days", fallback=DEFAULT_EVENT_RETENTION_DAYS)
         }
         cameras.append(camera)
     return cameras
@@ -156,7 +156,7 @@ class NVRConfigurator:
         
         # Rimuovi telecamere esistenti se richiesto
         existing_cameras = [s for s in self.config.sections() 
-                          if s.lower() not in ['logging', 'telegram', 'storage']]
+                          if s.lower() not in ['logging', 'telegram', 'storage', 'language', 'motion', 'restream', 'http', 'hls', 'thumbnails']]
         
         if existing_cameras:
             print(f"Telecamere esistenti: {', '.join(existing_cameras)}")
@@ -23,6 +23,27 @@ FILES_TO_COPY=(
     "main.py"
     "config.py"
     "process_manager.py"
+    "activity_timeline.py"
+    "clip_exporter.py"
+    "deletion_worker.py"
+    "event_buffer.py"
+    "ffmpeg_command.py"
+    "ffmpeg_progress.py"
+    "http_server.py"
+    "keyframe_index.py"
+    "live_hls.py"
+    "media_jobs.py"
+    "mosaic.py"
+    "motion_detector.py"
+    "recording_watcher.py"
+    "restart_scheduler.py"
+    "retention.py"
+    "segment_catalog.py"
+    "storage_accountant.py"
+    "storage_layout.py"
+    "storage_pool.py"
+    "storage_tiering.py"
+    "thumbnail_cache.py"
     "logging_setup.py"
     "telegram_bot.py"
     "telegram_notifier.py"
@@ -0,0 +1,162 @@
+"""
+Eliminazione dei segmenti in background con priorità I/O idle.
+
+Le politiche di conservazione accodano i segmenti da eliminare; un thread
+dedicato, con classe di priorità I/O idle, li elimina rispettando un budget
+di byte liberati al secondo. I file grandi vengono troncati a passi prima
+dell'unlink, così ext4 libera gli extent in piccole transazioni invece di un
+unico picco di journal che rallenta le scritture dei registratori.
+"""
+
+import logging
+import os
+import queue
+import threading
+import time
+
+import psutil
+
+# Dimensione dei passi di troncamento prima dell'unlink (0 = unlink diretto)
+DEFAULT_TRUNCATE_STEP = 256 * 1024 * 1024
+
+
+class DeletionWorker:
+    """Coda di eliminazione con budget di byte/s e metriche."""
+
+    def __init__(self, catalog, bytes_per_second=0, truncate_step=DEFAULT_TRUNCATE_STEP, after_delete=None):
+        """
+        Args:
+            catalog (SegmentCatalog): Catalogo da aggiornare dopo ogni eliminazione
+            bytes_per_second (int): Budget di byte liberati al secondo (0 = illimitato)
+            truncate_step (int): Byte rimossi per ogni passo di troncamento
+            after_delete (callable): Chiamata con il percorso dopo ogni eliminazione
+        """
+        self.catalog = catalog
+        self.after_delete = after_delete
+        self.bytes_per_second = bytes_per_second
+        self.truncate_step = truncate_step
+        self._queue = queue.Queue()
+        self._pending = {}  # percorso -> dimensione
+        self._lock = threading.Lock()
+        self._metrics = {
+            "deleted": 0,
+            "failed": 0,
+            "bytes_freed": 0,
+            "last_unlink_ms": None,
+            "max_unlink_ms": 0.0,
+            "total_unlink_ms": 0.0,
+        }
+        self._thread = threading.Thread(target=self._run, name="deletion-worker", daemon=True)
+        self._thread.start()
+
+    def enqueue(self, segment):
+        """
+        Accoda un segmento da eliminare.
+
+        Returns:
+            bool: False se il segmento era già in coda
+        """
+        with self._lock:
+            if segment["path"] in self._pending:
+                return False
+            self._pending[segment["path"]] = segment["size"]
+        self._queue.put(segment)
+        return True
+
+    def pending_paths(self):
+        """Percorsi in attesa di eliminazione (da escludere dalle nuove selezioni)"""
+        with self._lock:
+            return set(self._pending)
+
+    def metrics(self):
+        """
+        Restituisce le metriche della coda di eliminazione.
+
+        Returns:
+            dict: queue_depth, pending_bytes, deleted, failed, bytes_freed,
+                  last_unlink_ms, avg_unlink_ms, max_unlink_ms
+        """
+        with self._lock:
+            metrics = dict(self._metrics)
+            metrics["queue_depth"] = len(self._pending)
+            metrics["pending_bytes"] = sum(self._pending.values())
+        total = metrics.pop("total_unlink_ms")
+        metrics["avg_unlink_ms"] = total / metrics["deleted"] if metrics["deleted"] else None
+        return metrics
+
+    def _set_idle_io_priority(self):
+        """Imposta la classe I/O idle per il solo thread di eliminazione (Linux)"""
+        try:
+            psutil.Process(threading.get_native_id()).ionice(psutil.IOPRIO_CLASS_IDLE)
+            logging.info("🐢 Eliminazione segmenti con priorità I/O idle")
+        except (AttributeError, psutil.Error, OSError) as e:
+            logging.warning(f"⚠️ Impossibile impostare la priorità I/O idle: {e}")
+
+    def _run(self):
+        self._set_idle_io_priority()
+        window_start = time.monotonic()
+        window_bytes = 0
+
+        while True:
+            segment = self._queue.get()
+            path = segment["path"]
+            try:
+                started = time.monotonic()
+                freed = self._remove_file(path)
+                elapsed_ms = (time.monotonic() - started) * 1000
+                self.catalog.remove_segment(path)
+                if self.after_delete:
+                    self.after_delete(path)
+
+                with self._lock:
+                    self._metrics["deleted"] += 1
+                    self._metrics["bytes_freed"] += freed
+                    self._metrics["last_unlink_ms"] = elapsed_ms
+                    self._metrics["max_unlink_ms"] = max(self._metrics["max_unlink_ms"], elapsed_ms)
+                    self._metrics["total_unlink_ms"] += elapsed_ms
+                window_bytes += freed
+            except Exception as e:
+                logging.error(f"❌ Errore eliminazione {os.path.basename(path)}: {e}")
+                with self._lock:
+                    self._metrics["failed"] += 1
+            finally:
+                with self._lock:
+                    self._pending.pop(path, None)
+                self._queue.task_done()
+
+            # Budget di byte/s: attende quanto basta per restare sotto il limite
+            if self.bytes_per_second:
+                expected = window_bytes / self.bytes_per_second
+                elapsed = time.monotonic() - window_start
+                if expected > elapsed:
+                    time.sleep(expected - elapsed)
+                if self._queue.empty():
+                    window_start = time.monotonic()
+                    window_bytes = 0
+
+    def _remove_file(self, path):
+        """
+        Tronca a passi ed elimina un file.
+
+        Returns:
+            int: Byte liberati (0 se il file non esisteva)
+        """
+        try:
+            size = os.stat(path).st_size
+        except FileNotFoundError:
+            return 0
+
+        if self.truncate_step and size > self.truncate_step:
+            with open(path, "r+b") as handle:
+                remaining = size
+                while remaining > self.truncate_step:
+                    remaining -= self.truncate_step
+                    os.ftruncate(handle.fileno(), remaining)
+                    # Lascia spazio alle scritture dei registratori tra un passo e l'altro
+                    time.sleep(0.01)
+
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            return 0
+        return size
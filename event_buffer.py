@@ -0,0 +1,368 @@
+"""
+Buffer circolare dei pacchetti video per le clip degli eventi.
+
+Per ogni telecamera un processo ffmpeg rimuxa (senza decodificare) il flusso
+in MPEG-TS su una pipe; gli ultimi secondi di pacchetti restano in memoria,
+divisi in GOP che iniziano ciascuno da un keyframe (random access indicator
+dei pacchetti TS). Quando scatta un evento, il contenuto del buffer più i
+pacchetti che arrivano nei secondi successivi diventano una clip autonoma:
+l'avviso porta con sé anche quello che è successo *prima* del movimento,
+pochi secondi dopo l'evento invece che alla chiusura del segmento.
+
+Memoria: un flusso secondario a 1 Mbit/s con 5 secondi di anticipo occupa
+meno di 1 MB per telecamera.
+"""
+
+import logging
+import os
+import subprocess
+import threading
+import time
+from collections import deque
+
+from ffmpeg_command import build_ring_command
+
+# Cartella (nella cartella registrazioni) delle clip degli eventi
+EVENTS_DIRNAME = ".events"
+
+# Secondi conservati prima dell'evento e registrati dopo l'inizio
+PRE_EVENT_SECONDS = 5
+POST_EVENT_SECONDS = 10
+
+# Le clip degli eventi restano per 24 ore
+EVENT_CLIP_MAX_AGE = 24 * 3600
+
+# Tempo massimo di conversione della clip in MP4
+REMUX_TIMEOUT = 30
+
+# Attesa prima di riavviare il buffer dopo un errore
+RETRY_DELAY = 10
+
+TS_PACKET_SIZE = 188
+TS_SYNC_BYTE = 0x47
+_READ_SIZE = TS_PACKET_SIZE * 348  # ~64 KB
+
+
+def ts_pid(packet):
+    return ((packet[1] & 0x1F) << 8) | packet[2]
+
+
+def _has_adaptation(packet):
+    return bool(packet[3] & 0x20)
+
+
+def is_random_access(packet):
+    """Pacchetto TS che apre un'unità con keyframe (payload_unit_start + random_access_indicator)"""
+    if not packet[1] & 0x40:  # payload_unit_start_indicator
+        return False
+    return _has_adaptation(packet) and packet[4] > 0 and bool(packet[5] & 0x40)
+
+
+def pmt_pids(pat_packet):
+    """PID delle PMT elencate in un pacchetto PAT"""
+    offset = 4
+    if _has_adaptation(pat_packet):
+        offset += 1 + pat_packet[4]
+    offset += 1 + pat_packet[offset]  # pointer_field
+    section_length = ((pat_packet[offset + 1] & 0x0F) << 8) | pat_packet[offset + 2]
+    start = offset + 8
+    end = min(offset + 3 + section_length - 4, TS_PACKET_SIZE)  # esclude il CRC
+    pids = set()
+    for position in range(start, end - 3, 4):
+        program = (pat_packet[position] << 8) | pat_packet[position + 1]
+        if program:  # il programma 0 è la network PID
+            pids.add(((pat_packet[position + 2] & 0x1F) << 8) | pat_packet[position + 3])
+    return pids
+
+
+class _EventCapture:
+    """Clip di un evento in scrittura: buffer iniziale più pacchetti live."""
+
+    def __init__(self, path, until, on_done):
+        self.path = path
+        self.until = until
+        self.on_done = on_done
+        self.file = open(path, "wb")
+
+
+class PacketRing:
+    """Ultimi secondi del flusso di una telecamera, a GOP interi."""
+
+    def __init__(self, camera, url, output_dir, seconds=PRE_EVENT_SECONDS, fallback_url=None):
+        """
+        Args:
+            camera (str): Nome della telecamera
+            url (str): URL RTSP del flusso da tenere in memoria
+            output_dir (str): Cartella delle clip degli eventi
+            seconds (float): Secondi di anticipo conservati
+            fallback_url (str): Flusso usato quando `url` non risponde (es. la telecamera
+                al posto del server RTSP locale)
+        """
+        self.camera = camera
+        self.url = url
+        self.fallback_url = fallback_url if fallback_url != url else None
+        self._reading = None  # URL letto in questo momento
+        self.output_dir = output_dir
+        self.seconds = seconds
+        self._gops = deque()  # (istante del keyframe, [blocchi di pacchetti])
+        self._headers = {}  # PID -> ultimo pacchetto PAT/PMT
+        self._pmt_pids = set()
+        self._captures = []
+        self._remainder = b""
+        self._lock = threading.Lock()
+        self._process = None
+        self._stop = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self._run, name=f"event-ring-{self.camera}", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+        process = self._process
+        if process and process.poll() is None:
+            process.terminate()
+
+    def reconnect(self):
+        """Torna al flusso principale se si sta leggendo quello alternativo"""
+        process = self._process
+        if self._reading == self.fallback_url and process and process.poll() is None:
+            process.terminate()
+
+    def buffered_seconds(self):
+        with self._lock:
+            return time.time() - self._gops[0][0] if self._gops else 0.0
+
+    def _run(self):
+        url = self.url
+        while not self._stop.is_set():
+            received = 0
+            try:
+                received = self._read_stream(url)
+            except Exception as e:
+                logging.error(f"❌ Errore buffer eventi {self.camera}: {e}")
+            if self._stop.is_set():
+                break
+            if self.fallback_url and url == self.url and not received:
+                # Flusso principale non disponibile (es. server RTSP locale fermo): subito l'alternativa
+                logging.warning(f"⚠️ Buffer eventi {self.camera}: {self.url} non risponde, uso il flusso alternativo")
+                url = self.fallback_url
+                continue
+            # Dopo un'interruzione si riprova prima il flusso principale
+            url = self.url
+            logging.warning(f"⚠️ Buffer eventi {self.camera} interrotto, nuovo tentativo tra {RETRY_DELAY}s")
+            self._stop.wait(RETRY_DELAY)
+
+    def _read_stream(self, url):
+        """Legge il flusso finché non si interrompe; restituisce i byte ricevuti"""
+        received = 0
+        self._reading = url
+        self._process = subprocess.Popen(build_ring_command(url), stdout=subprocess.PIPE,
+                                         stderr=subprocess.DEVNULL, bufsize=0)
+        fd = self._process.stdout.fileno()
+        try:
+            while not self._stop.is_set():
+                data = os.read(fd, _READ_SIZE)
+                if not data:
+                    break
+                received += len(data)
+                self._ingest(data, time.time())
+        finally:
+            if self._process.poll() is None:
+                self._process.terminate()
+                try:
+                    self._process.wait(timeout=5)
+                except subprocess.TimeoutExpired:
+                    self._process.kill()
+            with self._lock:
+                self._gops.clear()
+                self._remainder = b""
+                captures, self._captures = self._captures, []
+            for capture in captures:
+                self._finish(capture)
+        return received
+
+    def _ingest(self, data, now):
+        """Divide i dati in pacchetti TS, apre un GOP a ogni keyframe e alimenta le clip in corso"""
+        data = self._remainder + data
+        usable = len(data) - len(data) % TS_PACKET_SIZE
+        self._remainder = data[usable:]
+        with self._lock:
+            chunk_start = 0
+            for offset in range(0, usable, TS_PACKET_SIZE):
+                packet = data[offset:offset + TS_PACKET_SIZE]
+                if packet[0] != TS_SYNC_BYTE:
+                    continue
+                pid = ts_pid(packet)
+                if pid == 0:
+                    self._headers[0] = packet
+                    self._pmt_pids = pmt_pids(packet)
+                elif pid in self._pmt_pids:
+                    self._headers[pid] = packet
+                elif is_random_access(packet):
+                    # Il blocco precedente chiude il GOP corrente, il keyframe ne apre uno nuovo
+                    self._append(data[chunk_start:offset])
+                    chunk_start = offset
+                    self._gops.append((now, []))
+            self._append(data[chunk_start:usable])
+
+            # Tiene almeno `seconds` secondi: il GOP più vecchio esce solo se il successivo basta
+            while len(self._gops) > 1 and self._gops[1][0] <= now - self.seconds:
+                self._gops.popleft()
+
+            finished = [capture for capture in self._captures if now >= capture.until]
+            self._captures = [capture for capture in self._captures if now < capture.until]
+        for capture in finished:
+            self._finish(capture)
+
+    def _append(self, chunk):
+        """Aggiunge un blocco di pacchetti al GOP corrente e alle clip in scrittura"""
+        if not chunk:
+            return
+        if self._gops:
+            self._gops[-1][1].append(chunk)
+        for capture in self._captures:
+            capture.file.write(chunk)
+
+    def capture(self, event_ts, post_seconds=POST_EVENT_SECONDS, on_done=None):
+        """
+        Avvia una clip dell'evento: buffer attuale più `post_seconds` secondi live.
+
+        Args:
+            event_ts (float): Istante dell'evento
+            post_seconds (float): Secondi registrati dopo l'evento
+            on_done (callable): Riceve il percorso della clip MP4 (o None se non riuscita)
+
+        Returns:
+            bool: False se il buffer non contiene ancora un keyframe
+        """
+        os.makedirs(self.output_dir, exist_ok=True)
+        stamp = time.strftime("%Y%m%dT%H%M%S", time.localtime(event_ts))
+        path = os.path.join(self.output_dir, f"{self.camera}_{stamp}.ts")
+        with self._lock:
+            if not self._gops:
+                return False
+            capture = _EventCapture(path, event_ts + post_seconds, on_done)
+            # PAT/PMT in testa: la clip è decodificabile da sola
+            for pid in sorted(self._headers):
+                capture.file.write(self._headers[pid])
+            for _, chunks in self._gops:
+                for chunk in chunks:
+                    capture.file.write(chunk)
+            self._captures.append(capture)
+        return True
+
+    def _finish(self, capture):
+        capture.file.close()
+        threading.Thread(target=self._remux, args=(capture,), name=f"event-clip-{self.camera}",
+                         daemon=True).start()
+
+    def _remux(self, capture):
+        """Converte la clip in MP4 (stream copy) per la riproduzione sui telefoni"""
+        mp4_path = os.path.splitext(capture.path)[0] + ".mp4"
+        command = ["ffmpeg", "-hide_banner", "-loglevel", "error", "-y", "-i", capture.path,
+                   "-c", "copy", "-avoid_negative_ts", "make_zero", "-movflags", "+faststart", mp4_path]
+        try:
+            completed = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                       timeout=REMUX_TIMEOUT, text=True)
+            if completed.returncode != 0:
+                raise RuntimeError(completed.stderr.strip()[-200:])
+            logging.info(f"🎞️ Clip evento {self.camera}: {os.path.basename(mp4_path)} "
+                         f"({os.path.getsize(mp4_path) / 1024:.0f} KB)")
+        except Exception as e:
+            logging.error(f"❌ Clip evento {self.camera} non creata: {e}")
+            mp4_path = None
+        finally:
+            try:
+                os.unlink(capture.path)
+            except FileNotFoundError:
+                pass
+        if capture.on_done:
+            capture.on_done(mp4_path)
+
+
+class EventClipRecorder:
+    """Buffer circolari di tutte le telecamere e clip sugli eventi di movimento."""
+
+    def __init__(self, output_dir, pre_seconds=PRE_EVENT_SECONDS, post_seconds=POST_EVENT_SECONDS):
+        self.output_dir = output_dir
+        self.pre_seconds = pre_seconds
+        self.post_seconds = post_seconds
+        self.rings = {}
+        self._listeners = []
+
+    def add_listener(self, callback):
+        """Registra una funzione chiamata con (evento, percorso clip MP4 o None)"""
+        self._listeners.append(callback)
+
+    def start(self, cameras, source="auto"):
+        """
+        Avvia i buffer delle telecamere con movimento attivo.
+
+        Args:
+            source (str): "auto" (flusso ritrasmesso se attivo, altrimenti secondario),
+                "sub" (flusso secondario se presente) o "main"
+
+        Returns:
+            int: Buffer avviati
+        """
+        for camera in cameras:
+            if not camera.get("motion") or camera["name"] in self.rings:
+                continue
+            url = self._source_url(camera, source)
+            # Se il flusso ritrasmesso non è disponibile si legge direttamente la telecamera
+            ring = PacketRing(camera["name"], url, self.output_dir, seconds=self.pre_seconds,
+                              fallback_url=camera["url"])
+            self.rings[camera["name"]] = ring
+            ring.start()
+        return len(self.rings)
+
+    @staticmethod
+    def _source_url(camera, source):
+        """Flusso del buffer: con la ritrasmissione attiva non apre un'altra sessione sulla telecamera"""
+        if source == "auto" and camera.get("restream_url"):
+            return camera["restream_url"]
+        if source in ("auto", "sub") and camera.get("sub_url"):
+            return camera["sub_url"]
+        return camera.get("live_url", camera["url"])
+
+    def stop(self):
+        for ring in self.rings.values():
+            ring.stop()
+
+    def reconnect(self, camera):
+        """Riporta sul flusso principale il buffer di una telecamera (es. al ritorno del server RTSP)"""
+        ring = self.rings.get(camera)
+        if ring is not None:
+            ring.reconnect()
+
+    def on_motion(self, event):
+        """Listener di MotionMonitor: a inizio movimento avvia la clip con anticipo"""
+        if event["type"] != "start":
+            return
+        ring = self.rings.get(event["camera"])
+        if ring is None:
+            return
+        self.prune()
+        if not ring.capture(event["ts"], self.post_seconds, on_done=lambda path: self._done(event, path)):
+            self._done(event, None)
+
+    def _done(self, event, path):
+        for listener in self._listeners:
+            try:
+                listener(event, path)
+            except Exception as e:
+                logging.error(f"❌ Errore notifica clip evento {event['camera']}: {e}")
+
+    def prune(self, max_age=EVENT_CLIP_MAX_AGE):
+        """Elimina le clip degli eventi più vecchie di `max_age` secondi"""
+        limit = time.time() - max_age
+        try:
+            with os.scandir(self.output_dir) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_file() and entry.stat().st_mtime < limit:
+                            os.unlink(entry.path)
+                    except FileNotFoundError:
+                        pass
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,368 @@
+"""
+Costruzione delle righe di comando ffmpeg.
+
+Unico punto in cui si compongono gli argomenti di registrazione: avvio,
+riavvio e spostamento di volume usano tutti `build_recording_command`.
+Durata dei segmenti e contenitore sono configurabili per telecamera.
+
+Con la ritrasmissione attiva lo stesso processo, con un'unica connessione
+RTSP alla telecamera, scrive i segmenti e pubblica il flusso sul server
+RTSP locale (MediaMTX) tramite il muxer tee.
+"""
+
+# Durata predefinita dei segmenti (secondi)
+DEFAULT_SEGMENT_TIME = 300
+MIN_SEGMENT_TIME = 2
+MAX_SEGMENT_TIME = 3600
+
+# Contenitori supportati: formato del muxer segment, estensione, opzioni del muxer
+CONTAINERS = {
+    "mkv": {
+        "format": "matroska",
+        "extension": "mkv",
+        "options": None,
+    },
+    # MP4 frammentato: ogni segmento è riproducibile e servibile via HTTP senza remux
+    "mp4": {
+        "format": "mp4",
+        "extension": "mp4",
+        "options": "movflags=frag_keyframe+empty_moov",
+    },
+    "mpegts": {
+        "format": "mpegts",
+        "extension": "ts",
+        "options": None,
+    },
+}
+DEFAULT_CONTAINER = "mkv"
+
+# Codec audio: "copy" mantiene il flusso della telecamera, "none" lo scarta.
+# L'MP4 non accetta il G.711 (pcm_alaw/pcm_mulaw) di molte telecamere: usare "aac".
+AUDIO_CODECS = ("copy", "aac", "none")
+
+# Caratteri speciali del muxer tee: separazione delle uscite e lettura delle opzioni
+_TEE_SLAVE_CHARS = "\\'|"
+_TEE_OPTION_CHARS = "\\':]"
+
+
+def container_extension(container):
+    """Estensione dei file di un contenitore"""
+    return CONTAINERS.get(container, CONTAINERS[DEFAULT_CONTAINER])["extension"]
+
+
+def segment_extensions():
+    """Estensioni di tutti i contenitori supportati (con il punto)"""
+    return tuple(f".{spec['extension']}" for spec in CONTAINERS.values())
+
+
+def _tee_escape(value, special):
+    return "".join("\\" + char if char in special else char for char in value)
+
+
+def _tee_slave(options, target):
+    """
+    Uscita del muxer tee: "[opzione=valore:...]destinazione".
+
+    Il muxer toglie un livello di escape separando le uscite ("|") e un
+    altro leggendo le opzioni (":" e "]"), quindi i valori ne hanno due.
+    """
+    fields = ":".join(f"{key}={_tee_escape(_tee_escape(str(value), _TEE_OPTION_CHARS), _TEE_SLAVE_CHARS)}"
+                      for key, value in options)
+    return f"[{fields}]{_tee_escape(target, _TEE_SLAVE_CHARS)}"
+
+
+def is_recording_command(cmdline):
+    """Indica se gli argomenti di un processo ffmpeg sono quelli di una registrazione"""
+    return any(arg == "-segment_list" or (arg.startswith("[f=segment:") and "segment_list=" in arg)
+               for arg in cmdline or ())
+
+
+def build_recording_command(camera, segment_list):
+    """
+    Comando ffmpeg di registrazione a segmenti di una telecamera.
+
+    Con `restream_url` la stessa connessione alimenta anche il server RTSP
+    locale: se la pubblicazione fallisce la registrazione prosegue.
+
+    Args:
+        camera (dict): Configurazione della telecamera (url, output, segment_time, container, audio,
+            restream_url)
+        segment_list (str): File CSV in cui ffmpeg elenca i segmenti chiusi
+
+    Returns:
+        list: Argomenti per subprocess.Popen
+    """
+    container = CONTAINERS.get(camera.get("container"), CONTAINERS[DEFAULT_CONTAINER])
+    audio = camera.get("audio", "copy")
+    restream_url = camera.get("restream_url")
+
+    command = [
+        "ffmpeg",
+        "-hide_banner",
+        "-y",
+        "-loglevel",
+        "error",
+        "-nostats",
+        "-progress",
+        "pipe:1",
+        "-rtsp_transport",
+        "tcp",
+        "-use_wallclock_as_timestamps",
+        "1",
+        "-i",
+        camera["url"],
+        "-vcodec",
+        "copy",
+    ]
+    if audio == "none":
+        command += ["-an"]
+    else:
+        command += ["-acodec", audio]
+
+    segment_options = [
+        ("reset_timestamps", 1),
+        ("segment_time", camera.get("segment_time", DEFAULT_SEGMENT_TIME)),
+        ("segment_format", container["format"]),
+    ]
+    if container["options"]:
+        segment_options.append(("segment_format_options", container["options"]))
+    segment_options += [
+        ("segment_atclocktime", 1),
+        ("strftime", 1),
+        ("segment_list", segment_list),
+        ("segment_list_type", "csv"),
+    ]
+
+    if restream_url:
+        # Il tee non sceglie i flussi da solo: video e (se presente) audio esplicitati
+        command += ["-map", "0:v:0"]
+        if audio != "none":
+            command += ["-map", "0:a?"]
+        command += [
+            "-f",
+            "tee",
+            _tee_slave([("f", "segment")] + segment_options, camera["output"]) + "|"
+            + _tee_slave([("f", "rtsp"), ("rtsp_transport", "tcp"), ("onfail", "ignore")], restream_url),
+        ]
+        return command
+
+    command += [
+        "-f",
+        "segment",
+        "-reset_timestamps",
+        "1",
+        "-segment_time",
+        str(camera.get("segment_time", DEFAULT_SEGMENT_TIME)),
+        "-segment_format",
+        container["format"],
+    ]
+    if container["options"]:
+        command += ["-segment_format_options", container["options"]]
+    command += [
+        "-segment_atclocktime",
+        "1",
+        "-strftime",
+        "1",
+        "-segment_list",
+        segment_list,
+        "-segment_list_type",
+        "csv",
+        camera["output"],
+    ]
+    return command
+
+
+def build_snapshot_command(url, width=None):
+    """
+    Comando ffmpeg che decodifica un solo fotogramma dal flusso RTSP e lo
+    scrive come JPEG su stdout.
+
+    Args:
+        url (str): URL RTSP della telecamera
+        width (int): Larghezza di ridimensionamento (None = originale)
+    """
+    command = [
+        "ffmpeg",
+        "-hide_banner",
+        "-loglevel",
+        "error",
+        "-rtsp_transport",
+        "tcp",
+        "-i",
+        url,
+        "-frames:v",
+        "1",
+    ]
+    if width:
+        command += ["-vf", f"scale={width}:-2"]
+    command += ["-q:v", "3", "-f", "image2", "-c:v", "mjpeg", "pipe:1"]
+    return command
+
+
+def build_motion_command(url, fps, width, height):
+    """
+    Comando ffmpeg per l'analisi del movimento: decodifica il flusso
+    secondario e scrive su stdout fotogrammi grezzi in scala di grigi
+    (un byte per pixel, width*height byte per fotogramma).
+
+    Args:
+        url (str): URL RTSP del flusso secondario
+        fps (float): Fotogrammi al secondo da analizzare
+        width (int): Larghezza dei fotogrammi
+        height (int): Altezza dei fotogrammi
+    """
+    return [
+        "ffmpeg",
+        "-hide_banner",
+        "-loglevel",
+        "error",
+        "-nostats",
+        "-rtsp_transport",
+        "tcp",
+        "-threads",
+        "1",
+        "-i",
+        url,
+        "-an",
+        "-sn",
+        "-vf",
+        f"fps={fps},scale={width}:{height}",
+        "-pix_fmt",
+        "gray",
+        "-f",
+        "rawvideo",
+        "pipe:1",
+    ]
+
+
+def build_ring_command(url):
+    """
+    Comando ffmpeg che rimuxa (senza ricodifica) il video della telecamera in
+    MPEG-TS su stdout, per il buffer circolare degli eventi.
+
+    Args:
+        url (str): URL RTSP del flusso (secondario o principale)
+    """
+    return [
+        "ffmpeg",
+        "-hide_banner",
+        "-loglevel",
+        "error",
+        "-nostats",
+        "-rtsp_transport",
+        "tcp",
+        "-i",
+        url,
+        "-map",
+        "0:v:0",
+        "-c",
+        "copy",
+        "-f",
+        "mpegts",
+        "pipe:1",
+    ]
+
+
+def build_hls_command(url, directory, playlist_name, segment_seconds, list_size):
+    """
+    Comando ffmpeg per la visione live HLS: rimuxa (senza ricodifica) il
+    video in segmenti fMP4 brevi, eliminando quelli usciti dalla playlist.
+
+    Args:
+        url (str): URL RTSP del flusso
+        directory (str): Cartella di playlist e segmenti
+        playlist_name (str): Nome della playlist
+        segment_seconds (float): Durata obiettivo dei segmenti (tagliati ai keyframe)
+        list_size (int): Segmenti elencati nella playlist
+    """
+    return [
+        "ffmpeg",
+        "-hide_banner",
+        "-loglevel",
+        "error",
+        "-nostats",
+        "-rtsp_transport",
+        "tcp",
+        "-i",
+        url,
+        "-map",
+        "0:v:0",
+        "-c",
+        "copy",
+        "-f",
+        "hls",
+        "-hls_time",
+        str(segment_seconds),
+        "-hls_list_size",
+        str(list_size),
+        "-hls_segment_type",
+        "fmp4",
+        "-hls_fmp4_init_filename",
+        "init.mp4",
+        "-hls_flags",
+        "delete_segments+independent_segments+omit_endlist+temp_file",
+        "-hls_segment_filename",
+        f"{directory}/segment_%06d.m4s",
+        f"{directory}/{playlist_name}",
+    ]
+
+
+def build_mosaic_command(urls, columns, tile_width, tile_height):
+    """
+    Comando ffmpeg che legge un fotogramma da ogni ingresso e li compone in
+    una griglia (filtro xstack), scrivendo un JPEG su stdout.
+
+    Args:
+        urls (list): URL RTSP o file JPEG delle celle, da sinistra a destra e dall'alto
+        columns (int): Colonne della griglia
+        tile_width (int): Larghezza di una cella
+        tile_height (int): Altezza di una cella
+    """
+    command = ["ffmpeg", "-hide_banner", "-loglevel", "error"]
+    for url in urls:
+        if url.startswith("rtsp://"):
+            command += ["-rtsp_transport", "tcp"]
+        command += ["-i", url]
+
+    # Ogni cella è ridimensionata mantenendo le proporzioni e centrata su sfondo nero
+    tiles = "".join(f"[{i}:v]scale={tile_width}:{tile_height}:force_original_aspect_ratio=decrease,"
+                    f"pad={tile_width}:{tile_height}:(ow-iw)/2:(oh-ih)/2,setsar=1[t{i}];"
+                    for i in range(len(urls)))
+    if len(urls) == 1:
+        graph = tiles.replace("[t0];", "[out]")
+    else:
+        layout = "|".join(f"{(i % columns) * tile_width}_{(i // columns) * tile_height}" for i in range(len(urls)))
+        graph = (tiles + "".join(f"[t{i}]" for i in range(len(urls)))
+                 + f"xstack=inputs={len(urls)}:layout={layout}:fill=black[out]")
+    command += ["-filter_complex", graph, "-map", "[out]", "-frames:v", "1",
+                "-q:v", "4", "-f", "image2", "-c:v", "mjpeg", "pipe:1"]
+    return command
+
+
+def build_thumbnail_command(input_format, width=None):
+    """
+    Comando ffmpeg che decodifica il primo fotogramma video dei dati
+    ricevuti su stdin (un keyframe con le intestazioni del contenitore) e lo
+    scrive come JPEG su stdout.
+
+    Args:
+        input_format (str): Demuxer dei dati (matroska, mov, mpegts)
+        width (int): Larghezza di ridimensionamento (None = originale)
+    """
+    command = [
+        "ffmpeg",
+        "-hide_banner",
+        "-loglevel",
+        "error",
+        "-f",
+        input_format,
+        "-i",
+        "pipe:0",
+        "-an",
+        "-frames:v",
+        "1",
+    ]
+    if width:
+        command += ["-vf", f"scale={width}:-2"]
+    command += ["-q:v", "3", "-f", "image2", "-c:v", "mjpeg", "pipe:1"]
+    return command
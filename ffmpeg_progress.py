@@ -0,0 +1,188 @@
+"""
+Lettura del canale di avanzamento di ffmpeg (-progress pipe:1).
+
+ffmpeg scrive blocchi di righe chiave=valore terminati da `progress=continue`
+(o `progress=end`). Ogni blocco aggiorna lo stato live della telecamera:
+frame, fps, bitrate, out_time e speed. Un contatore frame fermo indica un
+flusso connesso ma bloccato.
+"""
+
+import logging
+import threading
+import time
+
+# Secondi senza avanzamento del contatore frame prima di considerare il flusso bloccato
+STALL_TIMEOUT = 20
+
+
+def _parse_bitrate(value):
+    """Converte '1234.5kbits/s' in kbit/s (None se non disponibile)"""
+    value = value.strip()
+    if not value or value == "N/A":
+        return None
+    try:
+        return float(value.replace("kbits/s", ""))
+    except ValueError:
+        return None
+
+
+def _parse_speed(value):
+    """Converte '1.01x' in float (None se non disponibile)"""
+    value = value.strip()
+    if not value or value == "N/A":
+        return None
+    try:
+        return float(value.rstrip("x"))
+    except ValueError:
+        return None
+
+
+def _parse_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _parse_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class ProgressMonitor:
+    """Stato di avanzamento live dei processi ffmpeg, per telecamera."""
+
+    def __init__(self, stall_timeout=STALL_TIMEOUT, startup_grace=60):
+        """
+        Args:
+            stall_timeout (int): Secondi senza nuovi frame per segnalare uno stallo
+            startup_grace (int): Secondi concessi per il primo frame dopo l'avvio
+        """
+        self.stall_timeout = stall_timeout
+        self.startup_grace = startup_grace
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def attach(self, name, pid, stream):
+        """
+        Avvia la lettura del canale di avanzamento di un processo.
+
+        Args:
+            name (str): Nome telecamera
+            pid (int): PID del processo ffmpeg (per distinguere i riavvii)
+            stream: stdout del processo ffmpeg (modalità binaria)
+        """
+        now = time.time()
+        with self._lock:
+            self._states[name] = {
+                "pid": pid,
+                "frame": 0,
+                "fps": None,
+                "bitrate_kbps": None,
+                "out_time": None,
+                "out_time_s": None,
+                "total_size": None,
+                "speed": None,
+                "drop_frames": 0,
+                "started_at": now,
+                "updated_at": None,
+                "first_frame_at": None,
+                "last_advance_at": now,
+                "ended": False,
+            }
+        thread = threading.Thread(target=self._reader, args=(name, pid, stream),
+                                  name=f"progress-{name}", daemon=True)
+        thread.start()
+
+    def _reader(self, name, pid, stream):
+        """Legge i blocchi di avanzamento fino alla chiusura dello stream"""
+        block = {}
+        try:
+            for raw_line in iter(stream.readline, b""):
+                line = raw_line.decode("utf-8", errors="replace").strip()
+                if "=" not in line:
+                    continue
+                key, value = line.split("=", 1)
+                if key == "progress":
+                    self._commit(name, pid, block, ended=(value == "end"))
+                    block = {}
+                else:
+                    block[key] = value
+        except Exception as e:
+            logging.error(f"❌ Errore lettura avanzamento ffmpeg per {name}: {e}")
+        finally:
+            try:
+                stream.close()
+            except Exception:
+                pass
+            with self._lock:
+                state = self._states.get(name)
+                if state and state["pid"] == pid:
+                    state["ended"] = True
+
+    def _commit(self, name, pid, block, ended=False):
+        """Applica un blocco completo allo stato della telecamera"""
+        now = time.time()
+        with self._lock:
+            state = self._states.get(name)
+            if not state or state["pid"] != pid:
+                return
+
+            frame = _parse_int(block.get("frame"))
+            if frame is not None:
+                if frame > state["frame"]:
+                    state["last_advance_at"] = now
+                    if state["first_frame_at"] is None:
+                        state["first_frame_at"] = now
+                state["frame"] = frame
+
+            out_time_us = _parse_int(block.get("out_time_us", block.get("out_time_ms")))
+            state["fps"] = _parse_float(block.get("fps"))
+            state["bitrate_kbps"] = _parse_bitrate(block.get("bitrate", ""))
+            state["out_time"] = block.get("out_time")
+            state["out_time_s"] = out_time_us / 1_000_000 if out_time_us is not None else None
+            state["total_size"] = _parse_int(block.get("total_size"))
+            state["speed"] = _parse_speed(block.get("speed", ""))
+            state["drop_frames"] = _parse_int(block.get("drop_frames")) or 0
+            state["updated_at"] = now
+            state["ended"] = ended
+
+    def get(self, name):
+        """Restituisce una copia dello stato di avanzamento (None se assente)"""
+        with self._lock:
+            state = self._states.get(name)
+            return dict(state) if state else None
+
+    def snapshot(self):
+        """Restituisce una copia dello stato di tutte le telecamere"""
+        with self._lock:
+            return {name: dict(state) for name, state in self._states.items()}
+
+    def seconds_since_advance(self, name, now=None):
+        """Secondi trascorsi dall'ultimo incremento del contatore frame"""
+        state = self.get(name)
+        if not state:
+            return None
+        return (now or time.time()) - state["last_advance_at"]
+
+    def is_stalled(self, name, now=None):
+        """
+        Indica se il flusso della telecamera è bloccato.
+
+        Returns:
+            tuple: (bloccato, secondi dall'ultimo frame)
+        """
+        state = self.get(name)
+        if not state:
+            return False, None
+        since = (now or time.time()) - state["last_advance_at"]
+        # Prima del primo frame la connessione RTSP può richiedere più tempo
+        limit = self.stall_timeout if state["first_frame_at"] else max(self.stall_timeout, self.startup_grace)
+        return since > limit, since
+
+    def forget(self, name):
+        """Rimuove lo stato di una telecamera"""
+        with self._lock:
+            self._states.pop(name, None)
@@ -0,0 +1,380 @@
+"""
+Server HTTP di riproduzione integrato nell'NVR.
+
+Pensato per la consultazione remota tramite Tailscale: elenca telecamere,
+giorni e timeline (segmenti dal catalogo, attività dalla timeline del
+movimento) e serve segmenti e clip esportate con supporto alle richieste
+Range, così un lettore può posizionarsi in un punto qualsiasi di un file.
+
+I file vengono inviati con sendfile (copia zero dal page cache al socket):
+nessun file passa per la memoria di Python. Le connessioni sono servite da
+un pool di thread di dimensione fissa; oltre il limite il server risponde
+subito 503 invece di accumulare richieste.
+
+Endpoint (GET e HEAD):
+
+    /api/cameras                          telecamere con totali
+    /api/cameras/<telecamera>/days        giorni con registrazioni
+    /api/cameras/<telecamera>/<giorno>    segmenti, attività al minuto e periodi di movimento
+    /segments/<id>                        file di un segmento
+    /clips/<nome>                         clip esportate o degli eventi
+    /live/<telecamera>/index.m3u8         visione live HLS su richiesta (vedi live_hls)
+    /mosaic                               pagina con il mosaico aggiornato periodicamente
+    /mosaic.jpg                           mosaico di tutte le telecamere (vedi mosaic)
+    /thumbnails/<telecamera>.jpg          ultimo fotogramma in cache (vedi thumbnail_cache)
+"""
+
+import hmac
+import json
+import logging
+import mimetypes
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, quote, unquote, urlsplit
+
+# Porta predefinita e connessioni servite contemporaneamente
+DEFAULT_PORT = 8090
+DEFAULT_MAX_CONNECTIONS = 8
+
+# Secondi di inattività dopo cui una connessione keep-alive viene chiusa
+CONNECTION_TIMEOUT = 30
+
+# Risoluzione della curva di attività nella timeline del giorno
+ACTIVITY_BUCKET = 60
+
+CONTENT_TYPES = {
+    ".mkv": "video/x-matroska",
+    ".mp4": "video/mp4",
+    ".ts": "video/mp2t",
+    ".jpg": "image/jpeg",
+    ".m3u8": "application/vnd.apple.mpegurl",
+    ".m4s": "video/iso.segment",
+}
+
+# Pagina del mosaico: ricarica l'immagine ogni `ttl` secondi
+_MOSAIC_PAGE = """<!DOCTYPE html>
+<html><head><meta name="viewport" content="width=device-width, initial-scale=1"><title>pws-nvr</title>
+<style>body{{margin:0;background:#000}}img{{width:100%}}</style></head>
+<body><img id="m" src="mosaic.jpg{query}">
+<script>setInterval(function(){{document.getElementById("m").src="mosaic.jpg{query}"+
+"{separator}t="+Date.now();}},{interval});</script></body></html>"""
+
+# URI nelle righe della playlist HLS (righe senza "#" e attributi URI="...")
+_PLAYLIST_URI = re.compile(r'^(?!#)(\S+)$|(URI=")([^"]+)(")', re.MULTILINE)
+
+
+def parse_range(header, size):
+    """
+    Interpreta un'intestazione Range con un solo intervallo di byte.
+
+    Returns:
+        tuple: (inizio, fine inclusa), None per l'intero file (intestazione
+        assente o non supportata), oppure "invalid" se fuori dal file
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    first, _, last = header[len("bytes="):].strip().partition("-")
+    try:
+        if not first:  # ultimi N byte
+            length = int(last)
+            if length <= 0:
+                return "invalid"
+            return max(size - length, 0), size - 1
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        return "invalid"
+    return start, end
+
+
+class _BoundedHTTPServer(HTTPServer):
+    """HTTPServer con un pool fisso di thread e rifiuto immediato oltre il limite."""
+
+    def __init__(self, address, handler, max_connections):
+        super().__init__(address, handler)
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self._executor = ThreadPoolExecutor(max_workers=max_connections, thread_name_prefix="http-playback")
+
+    def process_request(self, request, client_address):
+        if not self._slots.acquire(blocking=False):
+            try:
+                request.sendall(b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\n"
+                                b"Retry-After: 5\r\nConnection: close\r\n\r\n")
+            except OSError:
+                pass
+            self.shutdown_request(request)
+            return
+        self._executor.submit(self._serve, request, client_address)
+
+    def _serve(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._slots.release()
+
+    def handle_error(self, request, client_address):
+        logging.debug(f"Connessione HTTP {client_address[0]} interrotta", exc_info=True)
+
+    def server_close(self):
+        super().server_close()
+        self._executor.shutdown(wait=False)
+
+
+class _PlaybackHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "pws-nvr"
+    timeout = CONNECTION_TIMEOUT
+
+    def do_GET(self):
+        self._dispatch(send_body=True)
+
+    def do_HEAD(self):
+        self._dispatch(send_body=False)
+
+    def log_message(self, format, *args):
+        logging.debug(f"🌐 HTTP {self.address_string()} {format % args}")
+
+    def _dispatch(self, send_body):
+        app = self.server.app
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        if not app.authorized(self.headers.get("Authorization", ""), query.get("token", [""])[0]):
+            self._send_json(401, {"error": "non autorizzato"}, send_body)
+            return
+        parts = [unquote(part) for part in url.path.split("/") if part]
+        try:
+            if parts[:1] == ["api"]:
+                status, payload = app.api(parts[1:])
+                self._send_json(status, payload, send_body)
+            elif len(parts) == 2 and parts[0] == "segments" and parts[1].isdigit():
+                self._send_file(app.segment_file(int(parts[1])), send_body)
+            elif len(parts) == 2 and parts[0] == "clips":
+                self._send_file(app.clip_file(parts[1]), send_body)
+            elif parts == ["mosaic.jpg"] and app.mosaic is not None:
+                self._send_mosaic(app.mosaic, send_body)
+            elif len(parts) == 2 and parts[0] == "thumbnails" and app.thumbnails is not None:
+                self._send_thumbnail(app.thumbnails, parts[1], send_body)
+            elif parts == ["mosaic"] and app.mosaic is not None:
+                token = query.get("token", [""])[0]
+                query_string = f"?token={quote(token, safe='')}" if token else ""
+                page = _MOSAIC_PAGE.format(query=query_string, separator="&" if query_string else "?",
+                                           interval=int(app.mosaic.ttl * 1000))
+                self._send_body(200, "text/html; charset=utf-8", page.encode(), send_body)
+            elif len(parts) == 3 and parts[0] == "live" and app.live is not None:
+                self._send_live(app.live, parts[1], parts[2], query.get("token", [""])[0], send_body)
+            else:
+                self._send_json(404, {"error": "non trovato"}, send_body)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+        except Exception as e:
+            logging.error(f"❌ Errore server HTTP su {url.path}: {e}")
+            self._send_json(500, {"error": str(e)}, send_body)
+
+    def _send_json(self, status, payload, send_body):
+        self._send_body(status, "application/json; charset=utf-8",
+                        json.dumps(payload, ensure_ascii=False).encode(), send_body)
+
+    def _send_body(self, status, content_type, body, send_body, cache="no-store"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", cache)
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def _send_mosaic(self, mosaic, send_body):
+        try:
+            jpeg, created = mosaic.get()
+        except Exception as e:
+            self._send_json(503, {"error": f"mosaico non disponibile: {e}"}, send_body)
+            return
+        # La cache del mosaico è condivisa: il client può riusarlo fino alla prossima composizione
+        max_age = max(0, int(mosaic.ttl - (time.time() - created)))
+        self._send_body(200, "image/jpeg", jpeg, send_body, cache=f"private, max-age={max_age}")
+
+    def _send_thumbnail(self, thumbnails, name, send_body):
+        camera, extension = os.path.splitext(name)
+        entry = None
+        if extension == ".jpg" and camera and not camera.startswith(".") and os.path.basename(camera) == camera:
+            entry = thumbnails.get(camera)
+        if entry is None:
+            self._send_json(404, {"error": f"miniatura non disponibile: {camera}"}, send_body)
+            return
+        created, jpeg = entry
+        max_age = max(0, int(thumbnails.max_age - (time.time() - created)))
+        self._send_body(200, "image/jpeg", jpeg, send_body, cache=f"private, max-age={max_age}")
+
+    def _send_live(self, live, camera, name, token, send_body):
+        client = self.client_address[0]
+        if name != "index.m3u8":
+            self._send_file(live.file(camera, name, client), send_body)
+            return
+        playlist = live.open(camera, client)
+        if playlist == "busy":
+            self._send_json(503, {"error": "troppi flussi live attivi"}, send_body)
+            return
+        if playlist is None:
+            self._send_json(404, {"error": f"flusso live non disponibile: {camera}"}, send_body)
+            return
+        with open(playlist, "rb") as f:
+            body = f.read()
+        if token:
+            token = quote(token, safe="")
+            # Il lettore richiede segmenti e init senza la query della playlist: il token va riportato
+            body = _PLAYLIST_URI.sub(lambda m: (f"{m.group(1)}?token={token}" if m.group(1) else
+                                                f"{m.group(2)}{m.group(3)}?token={token}{m.group(4)}"),
+                                     body.decode()).encode()
+        self._send_body(200, CONTENT_TYPES[".m3u8"], body, send_body, cache="no-cache")
+
+    def _send_file(self, path, send_body):
+        if path is None:
+            self._send_json(404, {"error": "file non trovato"}, send_body)
+            return
+        with open(path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            size = stat.st_size
+            byte_range = parse_range(self.headers.get("Range"), size)
+            if byte_range == "invalid":
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            start, end = byte_range or (0, size - 1)
+            length = end - start + 1 if size else 0
+
+            extension = os.path.splitext(path)[1].lower()
+            self.send_response(206 if byte_range else 200)
+            self.send_header("Content-Type", CONTENT_TYPES.get(extension)
+                             or mimetypes.guess_type(path)[0] or "application/octet-stream")
+            self.send_header("Content-Length", str(length))
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("Last-Modified", self.date_time_string(stat.st_mtime))
+            self.send_header("Content-Disposition", f'inline; filename="{os.path.basename(path)}"')
+            if byte_range:
+                self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+            self.end_headers()
+            if send_body and length:
+                # socket.sendfile usa os.sendfile: i byte vanno dal page cache al socket
+                self.wfile.flush()
+                self.connection.sendfile(f, offset=start, count=length)
+
+
+class PlaybackServer:
+    """Server HTTP di riproduzione: catalogo, timeline e file delle registrazioni."""
+
+    def __init__(self, catalog, resolve, timeline=None, clip_dirs=(), max_connections=DEFAULT_MAX_CONNECTIONS,
+                 token="", live=None, mosaic=None, thumbnails=None):
+        """
+        Args:
+            catalog (SegmentCatalog): Catalogo dei segmenti
+            resolve (callable): percorso catalogo -> percorso attuale (livelli hot/cold), None se assente
+            timeline (ActivityTimeline): Timeline dell'attività (opzionale)
+            clip_dirs (list): Cartelle delle clip servite da /clips
+            max_connections (int): Connessioni servite contemporaneamente
+            token (str): Token richiesto (Authorization: Bearer o ?token=), vuoto = nessuno
+            live (LiveHLS): Flussi HLS su richiesta (opzionale)
+            mosaic (Mosaic): Mosaico delle telecamere (opzionale)
+            thumbnails (ThumbnailCache): Miniature dell'ultimo fotogramma (opzionale)
+        """
+        self.catalog = catalog
+        self.resolve = resolve
+        self.timeline = timeline
+        self.clip_dirs = list(clip_dirs)
+        self.max_connections = max_connections
+        self.token = token
+        self.live = live
+        self.mosaic = mosaic
+        self.thumbnails = thumbnails
+        self._server = None
+
+    def start(self, host, port=DEFAULT_PORT):
+        """Avvia il server in un thread dedicato"""
+        self._server = _BoundedHTTPServer((host, port), _PlaybackHandler, self.max_connections)
+        self._server.app = self
+        threading.Thread(target=self._server.serve_forever, name="http-playback", daemon=True).start()
+        logging.info(f"🌐 Server di riproduzione su http://{host}:{port} "
+                     f"(max {self.max_connections} connessioni{', con token' if self.token else ''})")
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def authorized(self, authorization, query_token):
+        if not self.token:
+            return True
+        supplied = authorization[len("Bearer "):] if authorization.startswith("Bearer ") else query_token
+        return hmac.compare_digest(supplied.encode(), self.token.encode())
+
+    # --- API -----------------------------------------------------------
+
+    def api(self, parts):
+        """
+        Risponde a /api/...
+
+        Returns:
+            tuple: (stato HTTP, contenuto JSON)
+        """
+        if parts == ["cameras"]:
+            return 200, [{"name": row["camera"], "files": row["files"], "bytes": row["bytes"],
+                          "oldest_ts": row["oldest_ts"], "newest_ts": row["newest_ts"]}
+                         for row in self.catalog.totals()]
+        if len(parts) == 3 and parts[0] == "cameras":
+            camera = parts[1]
+            if camera not in self.catalog.cameras():
+                return 404, {"error": f"telecamera sconosciuta: {camera}"}
+            if parts[2] == "days":
+                return 200, self.catalog.days(camera)
+            try:
+                day = date.fromisoformat(parts[2])
+            except ValueError:
+                return 400, {"error": f"giorno non valido: {parts[2]} (AAAA-MM-GG)"}
+            return 200, self.day_timeline(camera, day)
+        return 404, {"error": "non trovato"}
+
+    def day_timeline(self, camera, day):
+        """Segmenti, attività al minuto e periodi di movimento di un giorno"""
+        start_ts = datetime(day.year, day.month, day.day).timestamp()
+        following = day + timedelta(days=1)
+        end_ts = datetime(following.year, following.month, following.day).timestamp()
+        segments = [{"id": segment["id"], "start_ts": segment["start_ts"], "end_ts": segment["end_ts"],
+                     "size": segment["size"], "url": f"/segments/{segment['id']}"}
+                    for segment in self.catalog.segments_between(camera, start_ts, end_ts)]
+        result = {"camera": camera, "day": day.isoformat(), "start_ts": start_ts, "end_ts": end_ts,
+                  "segments": segments}
+        if self.timeline is not None:
+            until = min(end_ts, time.time())
+            if until > start_ts:
+                result["activity_bucket"] = ACTIVITY_BUCKET
+                result["activity"] = [score for _, score in
+                                      self.timeline.summary(camera, start_ts, until, ACTIVITY_BUCKET)]
+                result["busy_periods"] = self.timeline.busy_periods(camera, start_ts, until)
+        return result
+
+    # --- File ----------------------------------------------------------
+
+    def segment_file(self, segment_id):
+        segment = self.catalog.segment(segment_id)
+        return self.resolve(segment["path"]) if segment else None
+
+    def clip_file(self, name):
+        """Percorso di una clip per nome (solo file direttamente nelle cartelle delle clip)"""
+        if name != os.path.basename(name) or name.startswith("."):
+            return None
+        for directory in self.clip_dirs:
+            path = os.path.join(directory, name)
+            if os.path.isfile(path):
+                return path
+        return None
@@ -0,0 +1,229 @@
+"""
+Indice dei keyframe dei segmenti chiusi.
+
+Per ogni segmento sigillato viene scritto un piccolo file binario che
+associa a ogni keyframe il PTS, l'istante reale e l'offset in byte nel
+file. Esportazione clip, miniature e seek HTTP trovano il keyframe giusto
+con una ricerca binaria invece di un ffprobe sull'intero file.
+
+L'indice si costruisce con un solo passaggio di demux (nessuna decodifica)
+subito dopo la chiusura del segmento, quando il file è ancora in page
+cache, su un piccolo pool di thread. I file indice stanno in una cartella
+propria della cartella registrazioni, uno per segmento: restano validi
+quando il segmento viene spostato tra livelli o volumi, perché la copia è
+identica byte per byte.
+
+Uso da riga di comando (indicizza i segmenti recenti ancora senza indice):
+
+    python3 keyframe_index.py backfill [ore]
+"""
+
+import bisect
+import logging
+import os
+import struct
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from segment_catalog import parse_segment_name
+
+# Cartella (nella cartella registrazioni) dei file indice
+KEYFRAMES_DIRNAME = ".keyframes"
+INDEX_EXTENSION = ".kfi"
+
+# Tempo massimo per l'analisi di un segmento
+INDEX_TIMEOUT = 60
+
+# Intestazione: magic, versione, numero di keyframe
+_MAGIC = b"KFI1"
+_VERSION = 1
+_HEADER = struct.Struct("<4sHI")
+# Voce: PTS (s dall'inizio del segmento), istante reale (timestamp), offset in byte
+_ENTRY = struct.Struct("<ddQ")
+
+
+def _probe_keyframes(path):
+    """
+    Elenca (pts, offset) dei keyframe video con un solo passaggio di demux.
+
+    Returns:
+        list: (pts in secondi, offset in byte) in ordine di PTS
+    """
+    command = ["ffprobe", "-v", "error", "-select_streams", "v:0",
+               "-show_entries", "packet=pts_time,pos,flags", "-of", "csv=p=0", path]
+    completed = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               timeout=INDEX_TIMEOUT, text=True)
+    if completed.returncode != 0:
+        raise RuntimeError(completed.stderr.strip()[-200:] or f"ffprobe uscito con {completed.returncode}")
+
+    keyframes = []
+    for line in completed.stdout.splitlines():
+        fields = line.strip().split(",")
+        if len(fields) < 3 or "K" not in fields[2]:
+            continue
+        try:
+            keyframes.append((float(fields[0]), int(fields[1])))
+        except ValueError:
+            continue  # pts o pos non disponibili (N/A)
+    keyframes.sort()
+    return keyframes
+
+
+class KeyframeIndex:
+    """File indice dei keyframe per segmento, costruiti in background."""
+
+    def __init__(self, index_dir, workers=2, resolve=None):
+        """
+        Args:
+            index_dir (str): Cartella dei file indice
+            workers (int): Thread di indicizzazione (0 = sola lettura)
+            resolve (callable): percorso catalogo -> percorso attuale (livelli hot/cold)
+        """
+        self.index_dir = index_dir
+        self.resolve = resolve or (lambda path: path if os.path.exists(path) else None)
+        self.indexed = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+        self._executor = None
+        if workers > 0:
+            self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="keyframe-index")
+        os.makedirs(index_dir, exist_ok=True)
+
+    def sidecar_path(self, segment_path):
+        """File indice di un segmento (indipendente da cartella e volume del segmento)"""
+        camera, _ = parse_segment_name(segment_path)
+        stem = os.path.splitext(os.path.basename(segment_path))[0]
+        return os.path.join(self.index_dir, camera or "_", stem + INDEX_EXTENSION)
+
+    def submit(self, segment):
+        """Accoda l'indicizzazione di un segmento appena chiuso (listener di SegmentListFeed)"""
+        if self._executor is not None:
+            self._executor.submit(self._build_safely, segment)
+
+    def _build_safely(self, segment):
+        try:
+            self.build(segment)
+        except Exception as e:
+            with self._lock:
+                self.failed += 1
+            logging.warning(f"⚠️ Indice keyframe di {os.path.basename(segment['path'])} non creato: {e}")
+
+    def build(self, segment):
+        """
+        Analizza un segmento e scrive il suo file indice.
+
+        Args:
+            segment (dict): Segmento del catalogo (path, start_ts)
+
+        Returns:
+            int: Keyframe indicizzati
+        """
+        path = self.resolve(segment["path"])
+        if path is None:
+            return 0
+        keyframes = _probe_keyframes(path)
+        sidecar = self.sidecar_path(segment["path"])
+        os.makedirs(os.path.dirname(sidecar), exist_ok=True)
+        partial = sidecar + ".part"
+        with open(partial, "wb") as f:
+            f.write(_HEADER.pack(_MAGIC, _VERSION, len(keyframes)))
+            # Con -reset_timestamps il PTS parte da zero all'inizio del segmento
+            f.write(b"".join(_ENTRY.pack(pts, segment["start_ts"] + pts, offset) for pts, offset in keyframes))
+        os.replace(partial, sidecar)
+        with self._lock:
+            self.indexed += 1
+        return len(keyframes)
+
+    def load(self, segment_path):
+        """
+        Legge il file indice di un segmento.
+
+        Returns:
+            list: (pts, istante reale, offset) per keyframe, oppure None se assente
+        """
+        try:
+            with open(self.sidecar_path(segment_path), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        if len(data) < _HEADER.size:
+            return None
+        magic, version, count = _HEADER.unpack_from(data)
+        if magic != _MAGIC or version != _VERSION or len(data) < _HEADER.size + count * _ENTRY.size:
+            return None
+        return [_ENTRY.unpack_from(data, _HEADER.size + i * _ENTRY.size) for i in range(count)]
+
+    def keyframe_before(self, segment_path, timestamp):
+        """
+        Ultimo keyframe del segmento non successivo a `timestamp`.
+
+        Returns:
+            tuple: (pts, istante reale, offset) oppure None senza indice
+        """
+        entries = self.load(segment_path)
+        if not entries:
+            return None
+        position = bisect.bisect_right([entry[1] for entry in entries], timestamp)
+        return entries[max(position - 1, 0)]
+
+    def latest_keyframe(self, segment_path):
+        """Ultimo keyframe del segmento (None senza indice)"""
+        entries = self.load(segment_path)
+        return entries[-1] if entries else None
+
+    def remove(self, segment_path):
+        """Elimina il file indice di un segmento eliminato"""
+        try:
+            os.unlink(self.sidecar_path(segment_path))
+        except FileNotFoundError:
+            pass
+
+    def backfill(self, catalog, since):
+        """
+        Accoda i segmenti iniziati dopo `since` che non hanno ancora un indice
+        (es. chiusi mentre l'NVR era fermo o prima dell'attivazione).
+
+        Returns:
+            int: Segmenti accodati
+        """
+        queued = 0
+        for segment in catalog.oldest_segments(limit=100000, started_after=(since, 0)):
+            if not os.path.exists(self.sidecar_path(segment["path"])):
+                self.submit(segment)
+                queued += 1
+        if queued:
+            logging.info(f"🔑 Indicizzazione keyframe di {queued} segmenti recenti in background")
+        return queued
+
+    def metrics(self):
+        with self._lock:
+            return {"indexed": self.indexed, "failed": self.failed}
+
+
+if __name__ == "__main__":
+    import sys
+
+    import config
+    from segment_catalog import CATALOG_FILENAME, SegmentCatalog
+    from storage_tiering import resolve_segment_path
+
+    if len(sys.argv) not in (2, 3) or sys.argv[1] != "backfill":
+        print("Uso: python3 keyframe_index.py backfill [ore]")
+        sys.exit(1)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    hours = float(sys.argv[2]) if len(sys.argv) == 3 else 24
+    catalog = SegmentCatalog(os.path.join(config.REGISTRAZIONI_DIR, CATALOG_FILENAME))
+    index = KeyframeIndex(os.path.join(config.REGISTRAZIONI_DIR, KEYFRAMES_DIRNAME), workers=0,
+                          resolve=lambda path: resolve_segment_path(path, config.HOT_TIER_DIR, config.STORAGE_VOLUMES))
+    built = 0
+    for segment in catalog.oldest_segments(limit=100000, started_after=(time.time() - hours * 3600, 0)):
+        if os.path.exists(index.sidecar_path(segment["path"])):
+            continue
+        try:
+            built += bool(index.build(segment))
+        except Exception as e:
+            print(f"❌ {os.path.basename(segment['path'])}: {e}")
+    print(f"✅ Segmenti indicizzati: {built}")
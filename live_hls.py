@@ -0,0 +1,203 @@
+"""
+Visione live HLS su richiesta, servita dal server HTTP di riproduzione.
+
+Il flusso HLS di una telecamera esiste solo mentre qualcuno lo guarda: la
+prima richiesta della playlist avvia un ffmpeg che rimuxa (senza
+ricodifica) il flusso secondario, o il principale se manca, in segmenti
+fMP4 brevi; senza richieste per `idle_timeout` secondi il processo viene
+fermato e i file eliminati. Segmenti e playlist stanno su tmpfs
+(/dev/shm), quindi la visione non scrive mai sul disco delle registrazioni.
+
+La latenza dipende dalla durata dei segmenti, che inizia sempre a un
+keyframe: con un GOP della telecamera di 1-2 secondi resta di pochi secondi.
+"""
+
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+from ffmpeg_command import build_hls_command
+
+# Cartella su tmpfs dei flussi HLS attivi
+DEFAULT_HLS_DIR = "/dev/shm/pws-nvr-hls"
+
+# Secondi senza richieste dopo cui un flusso viene fermato
+DEFAULT_IDLE_TIMEOUT = 60
+
+# Durata obiettivo dei segmenti e segmenti elencati nella playlist
+DEFAULT_SEGMENT_SECONDS = 1
+PLAYLIST_SIZE = 6
+
+# Flussi contemporanei massimi
+DEFAULT_MAX_STREAMS = 4
+
+# Attesa massima della prima playlist dopo l'avvio di ffmpeg
+START_TIMEOUT = 20
+
+PLAYLIST_NAME = "index.m3u8"
+
+
+class _LiveStream:
+    """ffmpeg HLS di una telecamera e spettatori recenti."""
+
+    def __init__(self, camera, directory, process):
+        self.camera = camera
+        self.directory = directory
+        self.process = process
+        self.started_at = time.time()
+        self.last_access = self.started_at
+        self.viewers = {}  # client -> ultima richiesta
+
+    @property
+    def playlist(self):
+        return os.path.join(self.directory, PLAYLIST_NAME)
+
+
+class LiveHLS:
+    """Flussi HLS su richiesta con arresto automatico in assenza di spettatori."""
+
+    def __init__(self, directory=DEFAULT_HLS_DIR, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 segment_seconds=DEFAULT_SEGMENT_SECONDS, max_streams=DEFAULT_MAX_STREAMS):
+        """
+        Args:
+            directory (str): Cartella (su tmpfs) dei flussi attivi
+            idle_timeout (float): Secondi senza richieste prima dell'arresto
+            segment_seconds (float): Durata obiettivo dei segmenti
+            max_streams (int): Flussi contemporanei massimi
+        """
+        self.directory = directory
+        self.idle_timeout = idle_timeout
+        self.segment_seconds = segment_seconds
+        self.max_streams = max_streams
+        self.sources = {}  # telecamera -> URL RTSP
+        self._streams = {}
+        self._lock = threading.Lock()
+        self._reaper = None
+
+    def set_sources(self, cameras):
+        """Flusso usato per ogni telecamera: secondario se presente, altrimenti quello ritrasmesso/principale"""
+        self.sources = {camera["name"]: camera.get("sub_url") or camera.get("live_url") or camera["url"]
+                        for camera in cameras}
+        # Residui di un'esecuzione precedente
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def open(self, camera, client):
+        """
+        Playlist di una telecamera, avviando il flusso alla prima richiesta.
+
+        Args:
+            camera (str): Nome della telecamera
+            client (str): Identificativo dello spettatore (indirizzo IP)
+
+        Returns:
+            str: Percorso della playlist, "busy" oltre il limite di flussi,
+            None per telecamera sconosciuta o avvio non riuscito
+        """
+        if camera not in self.sources:
+            return None
+        ended = None
+        with self._lock:
+            stream = self._streams.get(camera)
+            if stream is not None and stream.process.poll() is not None:
+                ended = self._detach(stream)
+                stream = None
+            busy = stream is None and len(self._streams) >= self.max_streams
+            if not busy:
+                stream = stream or self._launch(camera)
+                self._touch(stream, client)
+        if ended is not None:
+            self._terminate(ended)
+        if busy:
+            return "busy"
+
+        deadline = time.time() + START_TIMEOUT
+        while not os.path.exists(stream.playlist):
+            if stream.process.poll() is not None or time.time() > deadline:
+                logging.error(f"❌ Flusso HLS di {camera} non avviato")
+                with self._lock:
+                    self._detach(stream)
+                self._terminate(stream)
+                return None
+            time.sleep(0.2)
+        return stream.playlist
+
+    def file(self, camera, name, client):
+        """Percorso di un file (segmento o init) di un flusso attivo, None se assente"""
+        if name != os.path.basename(name) or name.startswith("."):
+            return None
+        with self._lock:
+            stream = self._streams.get(camera)
+            if stream is None:
+                return None
+            self._touch(stream, client)
+        path = os.path.join(stream.directory, name)
+        return path if os.path.isfile(path) else None
+
+    def _touch(self, stream, client):
+        now = time.time()
+        stream.last_access = now
+        stream.viewers[client] = now
+
+    def _launch(self, camera):
+        # Cartella propria di ogni avvio: quella di un flusso fermato si elimina fuori dal lock
+        # senza toccare il flusso che lo sostituisce
+        os.makedirs(self.directory, exist_ok=True)
+        directory = tempfile.mkdtemp(prefix=f"{camera}.", dir=self.directory)
+        command = build_hls_command(self.sources[camera], directory, PLAYLIST_NAME, self.segment_seconds,
+                                    PLAYLIST_SIZE)
+        process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        stream = _LiveStream(camera, directory, process)
+        self._streams[camera] = stream
+        logging.info(f"📺 Flusso HLS di {camera} avviato (PID {process.pid})")
+        if self._reaper is None:
+            self._reaper = threading.Thread(target=self._reap_idle, name="live-hls", daemon=True)
+            self._reaper.start()
+        return stream
+
+    def _detach(self, stream):
+        """Toglie il flusso da quelli attivi (con il lock acquisito, senza attese)"""
+        if self._streams.get(stream.camera) is stream:
+            del self._streams[stream.camera]
+        return stream
+
+    def _terminate(self, stream):
+        """Ferma il processo e libera la cartella (senza il lock: può attendere alcuni secondi)"""
+        if stream.process.poll() is None:
+            stream.process.terminate()
+            try:
+                stream.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                stream.process.kill()
+        shutil.rmtree(stream.directory, ignore_errors=True)
+
+    def _reap_idle(self):
+        while True:
+            time.sleep(min(self.idle_timeout / 2, 10))
+            now = time.time()
+            with self._lock:
+                idle = [self._detach(stream) for stream in list(self._streams.values())
+                        if now - stream.last_access >= self.idle_timeout or stream.process.poll() is not None]
+            for stream in idle:
+                logging.info(f"📺 Flusso HLS di {stream.camera} fermato dopo {now - stream.started_at:.0f}s")
+                self._terminate(stream)
+
+    def stop(self):
+        with self._lock:
+            streams = [self._detach(stream) for stream in list(self._streams.values())]
+        for stream in streams:
+            self._terminate(stream)
+
+    def status(self):
+        """
+        Returns:
+            dict: telecamera -> spettatori (richieste negli ultimi `idle_timeout` secondi), attivo da
+        """
+        now = time.time()
+        with self._lock:
+            return {camera: {"viewers": sum(now - seen < self.idle_timeout for seen in stream.viewers.values()),
+                             "uptime": now - stream.started_at}
+                    for camera, stream in self._streams.items()}
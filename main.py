@@ -30,6 +30,10 @@ print(f"✅ STORAGE_MAX_USE aggiornato in main.py: {STORAGE_MAX_USE}")
 def signal_handler(sig=None, frame=None):
     logging.info("log:logs.interrupt_signal")
     send_telegram_message("⏹️ Arresto del sistema NVR.")
+    process_manager.motion_monitor.stop()
+    process_manager.event_clips.stop()
+    process_manager.playback_server.stop()
+    process_manager.live_hls.stop()
     process_manager.stop_ffmpeg_processes()
     sys.exit(0)
 
@@ -63,9 +67,12 @@ def monitor_storage_and_processes(FFMPEG_COMMANDS):
             if int(time.time()) % 60 == 0:  # Una volta al minuto
                 logging.info("log:logs.storage_check_nvr:%s:%s:%s:90" % (used_gb, MAX_STORAGE_GB, usage_percent))
             
-            # Pulizia automatica semplificata per NVR - Soglia fissa al 94%
-            cleanup_threshold_percent = 94.0
-            cleanup_target_percent = 92.0  # Target: scendere all'92%
+            # Pulizia automatica per NVR - Soglie configurabili (default 94% → 92%)
+            cleanup_threshold_percent = config.CLEANUP_HIGH_WATERMARK
+            cleanup_target_percent = config.CLEANUP_LOW_WATERMARK
+            
+            # Età massima e quote per telecamera, applicate a prescindere dalle soglie
+            process_manager.enforce_retention_policies()
             
             # Log delle soglie configurate (solo una volta ogni ora)
             if int(time.time()) % 3600 == 0:  # Una volta all'ora
@@ -82,27 +89,31 @@ def monitor_storage_and_processes(FFMPEG_COMMANDS):
                 logging.warning("log:logs.storage_critical_87:%s" % usage_percent)
                 storage_alerts = 2
             
-            # Pulizia automatica quando si supera la soglia impostata
-            if usage_percent >= cleanup_threshold_percent:
-                logging.warning("log:logs.nvr_cleanup_activated:%s:%s" % (usage_percent, cleanup_threshold_percent))
-                logging.warning("log:logs.disk_space_critical:%s" % usage_percent)
+            # Pulizia automatica di ogni volume che supera la soglia impostata
+            # (non si accodano altre eliminazioni finché la coda precedente non è smaltita)
+            deletion_metrics = process_manager.get_deletion_metrics()
+            for volume, volume_percent in process_manager.get_volume_usage().items():
+                if volume_percent < cleanup_threshold_percent:
+                    continue
+                if deletion_metrics["queue_depth"]:
+                    logging.info(f"⏳ Pulizia in corso: {deletion_metrics['queue_depth']} segmenti in coda di eliminazione "
+                                 f"({deletion_metrics['pending_bytes'] / (1024**3):.1f} GB)")
+                    break
+
+                logging.warning("log:logs.nvr_cleanup_activated:%s:%s" % (volume_percent, cleanup_threshold_percent))
+                logging.warning("log:logs.disk_space_critical:%s" % volume_percent)
                 
                 try:
                     # Opzione 1: Pulizia per percentuale
-                    deleted = process_manager.smart_cleanup(REGISTRAZIONI_DIR, target_usage_percent=cleanup_target_percent)
+                    deleted = process_manager.smart_cleanup(volume, target_usage_percent=cleanup_target_percent)
                     
                     if deleted > 0:
                         storage_alerts = 0  # Reset avvisi dopo pulizia
-                        # Riconteggia lo spazio dopo la pulizia
-                        new_used_gb = process_manager.get_storage_usage_gb()
-                        new_usage_percent = (new_used_gb / MAX_STORAGE_GB) * 100
                     else:
                         # Opzione 2 (fallback): Elimina 20 file fissi
                         logging.warning("log:logs.nvr_cleanup_fallback:20")
-                        deleted_fallback = process_manager.delete_oldest_files(REGISTRAZIONI_DIR, files_to_delete=20)
+                        deleted_fallback = process_manager.delete_oldest_files(volume, files_to_delete=20)
                         if deleted_fallback > 0:
-                            new_used_gb = process_manager.get_storage_usage_gb()
-                            new_usage_percent = (new_used_gb / MAX_STORAGE_GB) * 100
                             logging.info("log:logs.nvr_cleanup_fallback_completed:%s" % deleted_fallback)
                         else:
                             logging.error("log:logs.auto_cleanup_failed")
@@ -112,7 +123,7 @@ def monitor_storage_and_processes(FFMPEG_COMMANDS):
                     logging.error("log:logs.cleanup_error:%s" % e)
                     # Ultimo tentativo: elimina 20 file
                     try:
-                        deleted_emergency = process_manager.delete_oldest_files(REGISTRAZIONI_DIR, files_to_delete=20)
+                        deleted_emergency = process_manager.delete_oldest_files(volume, files_to_delete=20)
                         if deleted_emergency > 0:
                             logging.info("log:logs.nvr_cleanup_emergency:%s" % deleted_emergency)
                             send_telegram_message(f"⚠️ Pulizia di emergenza: {deleted_emergency} file eliminati")
@@ -129,9 +140,8 @@ def monitor_storage_and_processes(FFMPEG_COMMANDS):
                 # Controllo salute avanzato (meno aggressivo)
                 if not process_manager.is_ffmpeg_running(proc_info):
                     logging.error(f"log:logs.ffmpeg_abnormal:{name}")
-                    process_manager.processes.remove(proc_info)
-                    process_manager.restart_ffmpeg_process(name, FFMPEG_COMMANDS)
-                    process_restarts += 1
+                    if process_manager.schedule_restart(name, FFMPEG_COMMANDS):
+                        process_restarts += 1
                     continue
 
                 healthy_processes += 1
@@ -146,10 +156,9 @@ def monitor_storage_and_processes(FFMPEG_COMMANDS):
                     name = proc_info["name"]
                     if not is_recording_active(name, REGISTRAZIONI_DIR, timeout=120):  # Timeout più lungo
                         logging.warning(f"log:logs.recording_inactive:{name}")
-                        send_telegram_message(f"⚠️ Registrazione non attiva per {name}, riavvio in corso...")
-                        process_manager.processes.remove(proc_info)
-                        process_manager.restart_ffmpeg_process(name, FFMPEG_COMMANDS)
-                        process_restarts += 1
+                        if process_manager.schedule_restart(name, FFMPEG_COMMANDS):
+                            send_telegram_message(f"⚠️ Registrazione non attiva per {name}, riavvio pianificato...")
+                            process_restarts += 1
                 monitor_storage_and_processes.last_recording_check = current_time
 
             # Report statistiche ogni ora
@@ -157,6 +166,16 @@ def monitor_storage_and_processes(FFMPEG_COMMANDS):
                 stats = process_manager.get_storage_statistics()
                 if stats:
                     logging.info(f"📊 Statistiche orarie: {stats['total_files']} file, {stats['used_gb']:.1f}GB usati, {healthy_processes} telecamere attive")
+                    deletion_metrics = process_manager.get_deletion_metrics()
+                    avg_unlink = deletion_metrics["avg_unlink_ms"]
+                    logging.info(f"🗑️ Coda eliminazione: {deletion_metrics['queue_depth']} in attesa, "
+                                 f"{deletion_metrics['deleted']} eliminati ({deletion_metrics['failed']} errori), "
+                                 f"unlink medio {avg_unlink or 0:.1f} ms, max {deletion_metrics['max_unlink_ms']:.1f} ms")
+                    if process_manager.tier_mover:
+                        tier_metrics = process_manager.tier_mover.metrics()
+                        logging.info(f"🚚 Livello hot: {tier_metrics['moved']} segmenti spostati "
+                                     f"({tier_metrics['bytes_moved'] / (1024**3):.1f} GB), "
+                                     f"{tier_metrics['backlog_files']} in attesa, {tier_metrics['failed']} errori")
                     send_telegram_message(f"📊 Report NVR: {stats['total_files']} file, {stats['used_gb']:.1f}GB usati, {healthy_processes} telecamere attive, {process_restarts} riavvii")
                     process_restarts = 0  # Reset contatore
                 last_stats_report = time.time()
@@ -264,15 +283,37 @@ def main():
 
     # Carica la configurazione delle telecamere
     FFMPEG_COMMANDS = load_camera_config(CONFIG_FILE)
+    process_manager.configure_retention(FFMPEG_COMMANDS)
 
     # Gestione dei segnali per chiudere i processi ffmpeg correttamente
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
 
+    # Allinea il catalogo dei segmenti con il disco (sincrono solo al primo avvio)
+    process_manager.sync_segment_catalog()
+
     # Avvia la registrazione direttamente
     logging.info("Avvio delle registrazioni...")
     send_telegram_message("📹 Avvio delle registrazioni NVR.")
-    process_manager.start_ffmpeg_processes(FFMPEG_COMMANDS)
+    readiness = process_manager.start_ffmpeg_processes(FFMPEG_COMMANDS)
+    ready = [name for name, status in readiness.items() if status["ready"]]
+    not_ready = [f"{name} ({status['reason']})" for name, status in readiness.items() if not status["ready"]]
+    summary = f"📹 Telecamere pronte: {len(ready)}/{len(FFMPEG_COMMANDS)}"
+    if ready:
+        slowest = max(readiness[name]["time_to_first_segment"] for name in ready)
+        summary += f" (primo segmento entro {slowest:.1f}s)"
+    if not_ready:
+        summary += "\n⚠️ Non pronte: " + ", ".join(not_ready)
+    send_telegram_message(summary)
+
+    # Layout per giorno: sposta in background i segmenti ancora nella cartella principale
+    process_manager.start_layout_migration()
+
+    # Rilevamento movimento sui flussi secondari (path2), separato dalla registrazione
+    process_manager.start_motion_detection(FFMPEG_COMMANDS)
+
+    # Server HTTP di riproduzione (consultazione remota via Tailscale)
+    process_manager.start_playback_server(FFMPEG_COMMANDS)
 
     # Avvia il thread per monitorare lo spazio su disco e i processi
     monitor_thread = threading.Thread(target=monitor_storage_and_processes, args=(FFMPEG_COMMANDS,), daemon=True)
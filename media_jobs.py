@@ -0,0 +1,56 @@
+"""
+Pool limitato di lavori multimediali (clip, istantanee) per il bot.
+
+Le esportazioni girano su pochi thread dedicati così il polling di Telegram
+resta reattivo; oltre `max_pending` lavori in corso o in coda le nuove
+richieste vengono rifiutate invece di accumularsi. Una richiesta identica
+a un lavoro già in corso non ne avvia un secondo.
+"""
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class MediaJobPool:
+    """Esecuzione limitata e senza duplicati di lavori identificati da una chiave."""
+
+    def __init__(self, max_workers=2, max_pending=4):
+        """
+        Args:
+            max_workers (int): Lavori eseguiti in parallelo
+            max_pending (int): Lavori ammessi tra in esecuzione e in coda
+        """
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="media-job")
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key, func, *args):
+        """
+        Accoda un lavoro.
+
+        Returns:
+            str: "queued", "duplicate" (stessa chiave già in corso) o "busy" (coda piena)
+        """
+        with self._lock:
+            if key in self._inflight:
+                return "duplicate"
+            if len(self._inflight) >= self.max_pending:
+                return "busy"
+            future = self._executor.submit(self._run, key, func, *args)
+            self._inflight[key] = future
+        return "queued"
+
+    def _run(self, key, func, *args):
+        try:
+            func(*args)
+        except Exception as e:
+            logging.error(f"❌ Errore lavoro multimediale {key}: {e}")
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def pending(self):
+        with self._lock:
+            return len(self._inflight)
@@ -0,0 +1,111 @@
+"""
+Mosaico delle telecamere in un'unica immagine JPEG.
+
+Un solo ffmpeg compone in una griglia (filtro xstack) l'ultimo fotogramma
+di ogni telecamera: la miniatura in cache (vedi thumbnail_cache) se
+disponibile, altrimenti un fotogramma letto dal flusso secondario.
+Controllare 12 telecamere dal telefono costa un'immagine di poche centinaia
+di KB invece di 12 flussi.
+
+Il mosaico composto resta in cache su tmpfs per `ttl` secondi ed è
+condiviso tra i processi (NVR con il server HTTP e bot Telegram): un lock
+sul file fa sì che richieste contemporanee attendano un'unica composizione
+invece di avviarne una ciascuna.
+"""
+
+import fcntl
+import math
+import os
+import subprocess
+import time
+
+from ffmpeg_command import build_mosaic_command
+
+# Cartella (tmpfs) e nome del mosaico in cache
+DEFAULT_MOSAIC_DIR = "/dev/shm"
+MOSAIC_FILENAME = "pws-nvr-mosaic.jpg"
+
+# Durata della cache e dimensione delle celle
+MOSAIC_TTL = 15
+TILE_WIDTH = 480
+TILE_HEIGHT = 270
+
+# Tempo massimo di composizione
+MOSAIC_TIMEOUT = 30
+
+
+def grid_size(count):
+    """Colonne e righe della griglia più vicina a un quadrato"""
+    columns = max(1, math.ceil(math.sqrt(count)))
+    return columns, max(1, math.ceil(count / columns))
+
+
+class Mosaic:
+    """Mosaico JPEG delle telecamere con cache condivisa tra processi."""
+
+    def __init__(self, directory=DEFAULT_MOSAIC_DIR, ttl=MOSAIC_TTL, tile_width=TILE_WIDTH, tile_height=TILE_HEIGHT,
+                 thumbnails=None):
+        """
+        Args:
+            thumbnails (ThumbnailCache): Miniature usate come celle, senza connessioni RTSP (opzionale)
+        """
+        self.thumbnails = thumbnails
+        self.path = os.path.join(directory, MOSAIC_FILENAME)
+        self.ttl = ttl
+        self.tile_width = tile_width
+        self.tile_height = tile_height
+        self.sources = []  # (telecamera, URL)
+
+    def set_sources(self, cameras):
+        """Flusso di ogni cella: secondario se presente, altrimenti quello ritrasmesso/principale"""
+        self.sources = [(camera["name"], camera.get("sub_url") or camera.get("live_url") or camera["url"])
+                        for camera in cameras]
+
+    def _cached(self):
+        try:
+            with open(self.path, "rb") as f:
+                created = os.fstat(f.fileno()).st_mtime
+                if time.time() - created < self.ttl:
+                    return f.read(), created
+        except FileNotFoundError:
+            pass
+        return None
+
+    def get(self):
+        """
+        Mosaico aggiornato (al massimo `ttl` secondi), composto se necessario.
+
+        Returns:
+            tuple: (JPEG, istante di composizione)
+
+        Raises:
+            RuntimeError: nessuna telecamera o composizione non riuscita
+        """
+        cached = self._cached()
+        if cached:
+            return cached
+        if not self.sources:
+            raise RuntimeError("nessuna telecamera configurata")
+
+        with open(self.path + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # Chi attendeva il lock trova il mosaico appena composto da un altro
+            cached = self._cached()
+            if cached:
+                return cached
+            columns, _ = grid_size(len(self.sources))
+            inputs = [(self.thumbnails and self.thumbnails.file(name)) or url for name, url in self.sources]
+            command = build_mosaic_command(inputs, columns, self.tile_width, self.tile_height)
+            completed = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                       timeout=MOSAIC_TIMEOUT)
+            if completed.returncode != 0 or not completed.stdout:
+                raise RuntimeError(completed.stderr.decode(errors="replace").strip()[-200:] or "nessun fotogramma")
+            partial = self.path + ".part"
+            with open(partial, "wb") as f:
+                f.write(completed.stdout)
+            os.replace(partial, self.path)
+            return completed.stdout, time.time()
+
+    def camera_names(self):
+        """Telecamere nell'ordine delle celle (da sinistra a destra, dall'alto)"""
+        return [name for name, _ in self.sources]
@@ -0,0 +1,328 @@
+"""
+Rilevamento del movimento sul flusso secondario (path2) delle telecamere.
+
+Per ogni telecamera abilitata un processo ffmpeg separato decodifica il
+flusso secondario a bassa risoluzione e pochi fotogrammi al secondo e lo
+scrive come fotogrammi grezzi in scala di grigi su una pipe. Il punteggio di
+movimento è la frazione di pixel (fuori dalle zone mascherate) che cambia
+più di una soglia rispetto al fotogramma precedente, calcolata con NumPy
+sull'intero fotogramma. Il flusso principale e il processo di registrazione
+non vengono mai toccati.
+
+Dal punteggio nascono gli eventi: "start" dopo alcuni fotogrammi consecutivi
+sopra soglia, "stop" dopo un periodo di quiete.
+"""
+
+import logging
+import subprocess
+import threading
+import time
+from collections import deque
+
+import psutil
+
+try:
+    import numpy as np
+except ImportError:  # Dipendenza opzionale, necessaria solo con il movimento attivo
+    np = None
+
+from ffmpeg_command import build_motion_command
+
+# Risoluzione e frequenza dell'analisi
+MOTION_WIDTH = 320
+MOTION_HEIGHT = 180
+MOTION_FPS = 2
+
+# Differenza di luminosità (0-255) oltre cui un pixel è considerato cambiato
+DEFAULT_PIXEL_DELTA = 25
+# Frazione di pixel cambiati oltre cui il fotogramma ha movimento
+DEFAULT_THRESHOLD = 0.015
+# Fotogrammi consecutivi sopra soglia per aprire un evento
+TRIGGER_FRAMES = 2
+# Secondi senza movimento prima di chiudere un evento
+EVENT_COOLDOWN = 10
+
+# Attesa prima di riavviare l'analisi dopo un errore (raddoppia fino al massimo)
+RETRY_DELAY = 5
+MAX_RETRY_DELAY = 300
+
+# Eventi recenti tenuti in memoria
+EVENT_HISTORY = 200
+
+
+def parse_mask(text):
+    """
+    Interpreta le zone escluse dall'analisi.
+
+    Formato: rettangoli "x1,y1,x2,y2" separati da ";", in frazioni del
+    fotogramma (0-1), es. "0,0,1,0.1; 0.8,0.5,1,1".
+
+    Returns:
+        list: (x1, y1, x2, y2) validati
+    """
+    zones = []
+    for chunk in (text or "").split(";"):
+        if not chunk.strip():
+            continue
+        try:
+            x1, y1, x2, y2 = (float(value) for value in chunk.split(","))
+        except ValueError:
+            raise ValueError(f"Zona non valida: {chunk.strip()}")
+        if not (0 <= x1 < x2 <= 1 and 0 <= y1 < y2 <= 1):
+            raise ValueError(f"Zona fuori dal fotogramma: {chunk.strip()}")
+        zones.append((x1, y1, x2, y2))
+    return zones
+
+
+def build_mask(zones, width, height):
+    """Matrice booleana dei pixel analizzati (False nelle zone escluse)"""
+    mask = np.ones((height, width), dtype=bool)
+    for x1, y1, x2, y2 in zones:
+        mask[int(y1 * height):int(round(y2 * height)), int(x1 * width):int(round(x2 * width))] = False
+    return mask
+
+
+def motion_score(previous, frame, pixel_delta, mask=None, mask_pixels=None):
+    """
+    Frazione di pixel cambiati tra due fotogrammi in scala di grigi.
+
+    La differenza assoluta si calcola come max - min per restare in uint8
+    senza allocare matrici più larghe.
+    """
+    changed = (np.maximum(previous, frame) - np.minimum(previous, frame)) > pixel_delta
+    if mask is not None:
+        changed &= mask
+        return np.count_nonzero(changed) / mask_pixels
+    return np.count_nonzero(changed) / changed.size
+
+
+class MotionDetector:
+    """Analisi del movimento di una telecamera su un thread dedicato."""
+
+    def __init__(self, camera, url, emit, threshold=DEFAULT_THRESHOLD, pixel_delta=DEFAULT_PIXEL_DELTA,
+                 mask_zones=(), fps=MOTION_FPS, width=MOTION_WIDTH, height=MOTION_HEIGHT,
+                 trigger_frames=TRIGGER_FRAMES, cooldown=EVENT_COOLDOWN, on_score=None):
+        """
+        Args:
+            camera (str): Nome della telecamera
+            url (str): URL RTSP del flusso secondario
+            emit (callable): Riceve gli eventi (dict) di inizio e fine movimento
+            threshold (float): Frazione di pixel cambiati che indica movimento
+            pixel_delta (int): Differenza di luminosità minima di un pixel cambiato
+            mask_zones (list): Zone escluse (vedi parse_mask)
+            fps, width, height: Parametri dell'analisi
+            trigger_frames (int): Fotogrammi consecutivi sopra soglia per aprire un evento
+            cooldown (float): Secondi di quiete per chiudere un evento
+            on_score (callable): Riceve (telecamera, istante, punteggio) per ogni fotogramma
+        """
+        self.camera = camera
+        self.url = url
+        self.emit = emit
+        self.threshold = threshold
+        self.pixel_delta = pixel_delta
+        self.fps = fps
+        self.width = width
+        self.height = height
+        self.trigger_frames = trigger_frames
+        self.cooldown = cooldown
+        self.on_score = on_score
+        self.mask = build_mask(mask_zones, width, height) if mask_zones else None
+        self.mask_pixels = max(int(np.count_nonzero(self.mask)), 1) if mask_zones else None
+        self.last_score = 0.0
+        self.last_frame_at = None
+        self.event = None  # evento in corso
+        self._hits = 0
+        self._process = None
+        self._stop = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self._run, name=f"motion-{self.camera}", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+        process = self._process
+        if process and process.poll() is None:
+            process.terminate()
+
+    def _run(self):
+        delay = RETRY_DELAY
+        while not self._stop.is_set():
+            started = time.time()
+            try:
+                self._analyze()
+            except Exception as e:
+                logging.error(f"❌ Errore analisi movimento {self.camera}: {e}")
+            if self._stop.is_set():
+                break
+            # Un'analisi durata a lungo non è un errore ripetuto: riparte dal ritardo minimo
+            delay = RETRY_DELAY if time.time() - started > MAX_RETRY_DELAY else min(delay * 2, MAX_RETRY_DELAY)
+            logging.warning(f"⚠️ Analisi movimento {self.camera} interrotta, nuovo tentativo tra {delay}s")
+            self._stop.wait(delay)
+
+    def _analyze(self):
+        """Legge i fotogrammi dalla pipe di ffmpeg finché il processo è attivo"""
+        frame_size = self.width * self.height
+        buffers = [bytearray(frame_size), bytearray(frame_size)]
+        command = build_motion_command(self.url, self.fps, self.width, self.height)
+        self._process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, bufsize=0)
+        try:
+            # Priorità CPU più bassa della registrazione (preexec_fn non è sicuro con i thread)
+            psutil.Process(self._process.pid).nice(10)
+        except (psutil.Error, OSError) as e:
+            logging.warning(f"⚠️ Impossibile ridurre la priorità dell'analisi movimento {self.camera}: {e}")
+        logging.info(f"👁️ Analisi movimento avviata per {self.camera} "
+                     f"({self.width}x{self.height} a {self.fps} fps)")
+        previous = None
+        try:
+            while not self._stop.is_set():
+                buffer = buffers[0]
+                if not self._read_frame(buffer):
+                    break
+                frame = np.frombuffer(buffer, dtype=np.uint8).reshape(self.height, self.width)
+                if previous is not None:
+                    self._update(time.time(), motion_score(previous, frame, self.pixel_delta,
+                                                           self.mask, self.mask_pixels))
+                previous = frame
+                buffers.reverse()  # il fotogramma appena letto resta valido come precedente
+        finally:
+            if self._process.poll() is None:
+                self._process.terminate()
+                try:
+                    self._process.wait(timeout=5)
+                except subprocess.TimeoutExpired:
+                    self._process.kill()
+            self._close_event(time.time())
+
+    def _read_frame(self, buffer):
+        """Riempie il buffer con un fotogramma intero (False a fine flusso)"""
+        view = memoryview(buffer)
+        filled = 0
+        while filled < len(buffer):
+            count = self._process.stdout.readinto(view[filled:])
+            if not count:
+                return False
+            filled += count
+        return True
+
+    def _update(self, now, score):
+        """Aggiorna lo stato degli eventi con il punteggio dell'ultimo fotogramma"""
+        self.last_score = score
+        self.last_frame_at = now
+        if self.on_score:
+            self.on_score(self.camera, now, score)
+
+        if score >= self.threshold:
+            self._hits += 1
+            if self.event is not None:
+                self.event["last_motion"] = now
+                self.event["peak"] = max(self.event["peak"], score)
+            elif self._hits >= self.trigger_frames:
+                # L'evento inizia dal primo fotogramma della serie sopra soglia
+                start = now - (self._hits - 1) / self.fps
+                self.event = {"camera": self.camera, "start_ts": start, "last_motion": now, "peak": score}
+                self.emit({"type": "start", "camera": self.camera, "ts": start, "score": score})
+        else:
+            self._hits = 0
+            if self.event is not None and now - self.event["last_motion"] >= self.cooldown:
+                self._close_event(now)
+
+    def _close_event(self, now):
+        event, self.event = self.event, None
+        self._hits = 0
+        if event is None:
+            return
+        self.emit({"type": "stop", "camera": self.camera, "ts": now, "start_ts": event["start_ts"],
+                   "end_ts": event["last_motion"], "peak": event["peak"]})
+
+
+class MotionMonitor:
+    """Rilevatori di movimento di tutte le telecamere ed eventi recenti."""
+
+    def __init__(self, fps=MOTION_FPS, width=MOTION_WIDTH, height=MOTION_HEIGHT,
+                 trigger_frames=TRIGGER_FRAMES, cooldown=EVENT_COOLDOWN):
+        self.fps = fps
+        self.width = width
+        self.height = height
+        self.trigger_frames = trigger_frames
+        self.cooldown = cooldown
+        self.detectors = {}
+        self._events = deque(maxlen=EVENT_HISTORY)
+        self._listeners = []
+        self._score_listeners = []
+        self._lock = threading.Lock()
+
+    def add_listener(self, callback):
+        """Registra una funzione chiamata con ogni evento di inizio/fine movimento"""
+        self._listeners.append(callback)
+
+    def add_score_listener(self, callback):
+        """Registra una funzione chiamata con (telecamera, istante, punteggio) per ogni fotogramma"""
+        self._score_listeners.append(callback)
+
+    def start(self, cameras):
+        """
+        Avvia l'analisi per le telecamere con flusso secondario e movimento attivo.
+
+        Returns:
+            int: Rilevatori avviati
+        """
+        if np is None:
+            logging.error("❌ Rilevamento movimento non disponibile: installare numpy")
+            return 0
+        for camera in cameras:
+            if not camera.get("motion") or camera["name"] in self.detectors:
+                continue
+            if not camera.get("sub_url"):
+                logging.warning(f"⚠️ {camera['name']}: movimento attivo ma nessun flusso secondario (path2)")
+                continue
+            detector = MotionDetector(
+                camera["name"], camera["sub_url"], self._emit,
+                threshold=camera.get("motion_threshold", DEFAULT_THRESHOLD),
+                pixel_delta=camera.get("motion_pixel_delta", DEFAULT_PIXEL_DELTA),
+                mask_zones=camera.get("motion_mask", ()),
+                fps=self.fps, width=self.width, height=self.height,
+                trigger_frames=self.trigger_frames, cooldown=self.cooldown,
+                on_score=self._score,
+            )
+            self.detectors[camera["name"]] = detector
+            detector.start()
+        return len(self.detectors)
+
+    def stop(self):
+        for detector in self.detectors.values():
+            detector.stop()
+
+    def _emit(self, event):
+        with self._lock:
+            self._events.append(event)
+        if event["type"] == "start":
+            logging.info(f"🏃 Movimento su {event['camera']} ({event['score'] * 100:.1f}% pixel)")
+        else:
+            logging.info(f"🛑 Fine movimento su {event['camera']} "
+                         f"({event['end_ts'] - event['start_ts']:.0f}s, picco {event['peak'] * 100:.1f}%)")
+        for listener in self._listeners:
+            try:
+                listener(event)
+            except Exception as e:
+                logging.error(f"❌ Errore notifica evento movimento {event['camera']}: {e}")
+
+    def _score(self, camera, now, score):
+        for listener in self._score_listeners:
+            try:
+                listener(camera, now, score)
+            except Exception as e:
+                logging.error(f"❌ Errore registrazione punteggio movimento {camera}: {e}")
+
+    def events(self, camera=None):
+        """Eventi recenti, dal più vecchio"""
+        with self._lock:
+            return [event for event in self._events if camera is None or event["camera"] == camera]
+
+    def status(self):
+        """
+        Returns:
+            dict: telecamera -> last_score, last_frame_at, active (evento in corso)
+        """
+        return {name: {"last_score": detector.last_score, "last_frame_at": detector.last_frame_at,
+                       "active": detector.event is not None}
+                for name, detector in self.detectors.items()}
@@ -1,17 +1,42 @@
 import os
+import socket
 import subprocess
 import logging
 import psutil
 import time
-from pathlib import Path
 import config
-from telegram_notifier import send_telegram_message
+from telegram_notifier import send_telegram_message, send_telegram_video
 from security_manager import SecurityManager
 import threading
+import signal
+from collections import deque
 from datetime import datetime, timedelta
+from urllib.parse import urlsplit
+from restart_scheduler import RestartScheduler
+from ffmpeg_progress import ProgressMonitor
+from segment_catalog import SegmentCatalog, SegmentListFeed, CATALOG_FILENAME, SEGMENT_LIST_DIRNAME
+from recording_watcher import RecordingActivityTracker
+from storage_accountant import StorageAccountant
+from retention import RetentionEngine
+from deletion_worker import DeletionWorker
+from storage_layout import (LAYOUT_SHARDED, LayoutMigrator, ensure_day_directories, output_template,
+                            prune_empty_day_directories)
+from storage_pool import PLACEMENT_FILENAME, StoragePool
+from storage_tiering import TierMover, resolve_segment_path
+from ffmpeg_command import build_recording_command, container_extension, is_recording_command
+from clip_exporter import CLIPS_DIRNAME, ClipExporter
+from keyframe_index import KEYFRAMES_DIRNAME, KeyframeIndex
+from motion_detector import MotionMonitor
+from activity_timeline import TIMELINE_DIRNAME, ActivityTimeline
+from event_buffer import EVENTS_DIRNAME, EventClipRecorder
+from http_server import PlaybackServer
+from live_hls import LiveHLS
+from mosaic import Mosaic
+from thumbnail_cache import ThumbnailCache
 
 # ✅ Recupera REGISTRAZIONI_DIR e logga il valore
 REGISTRAZIONI_DIR = config.REGISTRAZIONI_DIR
+HOT_TIER_DIR = config.HOT_TIER_DIR  # Livello hot su cui scrive ffmpeg ("" = disattivato)
 logging.info(f"📂 REGISTRAZIONI_DIR usato in process_manager.py: {REGISTRAZIONI_DIR}")
 
 # ✅ Crea la cartella se non esiste
@@ -22,12 +47,29 @@ logging.info(f"📁 Verifica cartella registrazioni: {REGISTRAZIONI_DIR} (creata
 security_manager = SecurityManager(config.CONFIG_FILE)
 
 processes = []
+processes_lock = threading.Lock()
+ffmpeg_commands = []  # Configurazione telecamere usata per i riavvii su evento
+exit_events = deque(maxlen=500)  # Storico eventi di uscita dei processi ffmpeg
+health_alerts = {}  # Problema già notificato per telecamera, finché non si risolve
+stalled_alerted = set()  # Telecamere bloccate già notificate, finché il flusso non riparte
 FFMPEG_LOG_PATH = "logs/ffmpeg_records.log"
 restart_attempts = {}
 last_restart_time = {}  # Traccia l'ultimo riavvio per ogni telecamera
 MAX_ATTEMPTS = 5
 RESTART_COOLDOWN = 300  # 5 minuti di cooldown tra riavvii per la stessa telecamera
 HEALTH_CHECK_INTERVAL = 120  # Controlla la salute ogni 2 minuti (era 60)
+RESTART_VERIFY_DELAY = 15  # Attesa prima di verificare che un riavvio registri davvero
+STALL_CHECK_INTERVAL = 5  # Frequenza del controllo stallo basato sul contatore frame
+STARTUP_READY_TIMEOUT = 60  # Tempo massimo di attesa per il primo segmento all'avvio
+STARTUP_POLL_INTERVAL = 0.5  # Intervallo di controllo prontezza telecamere
+SAFE_FILE_AGE = 3600  # Non eliminare segmenti terminati da meno di 1 ora
+LAYOUT_MAINTENANCE_INTERVAL = 3600  # Creazione anticipata delle cartelle per giorno
+REBALANCE_INTERVAL = 600  # Controllo volumi pieni del pool
+BITRATE_WINDOW = 6 * 3600  # Finestra per il bitrate misurato dal catalogo
+SAFE_CANDIDATES_FACTOR = 4  # Candidati esaminati dalla pulizia di emergenza per scegliere prima gli inattivi
+KEYFRAME_BACKFILL_WINDOW = 24 * 3600  # Segmenti recenti da indicizzare all'avvio se senza indice
+RESTREAM_CHECK_INTERVAL = 5  # Controllo del server RTSP locale per ricollegare la ritrasmissione
+HTTP_BIND_RETRY_INTERVAL = 30  # Nuovo tentativo di avvio del server HTTP (es. IP Tailscale non ancora attivo)
 
 def reset_restart_counters():
     """Reset automatico dei contatori di riavvio ogni 24 ore"""
@@ -41,6 +83,124 @@ def reset_restart_counters():
             logging.info(f"🔄 Reset automatico contatori riavvio. Erano: {old_attempts}")
             send_telegram_message("🔄 Reset automatico contatori riavvio telecamere completato.")
 
+# Scheduler non bloccante dei riavvii per telecamera
+restart_scheduler = RestartScheduler()
+
+# Stato live (frame, fps, bitrate, out_time, speed) letto da -progress
+progress_monitor = ProgressMonitor(startup_grace=STARTUP_READY_TIMEOUT)
+
+# Catalogo persistente dei segmenti, alimentato dalle liste -segment_list di ffmpeg
+segment_catalog = SegmentCatalog(os.path.join(REGISTRAZIONI_DIR, CATALOG_FILENAME))
+segment_feed = SegmentListFeed(segment_catalog, os.path.join(REGISTRAZIONI_DIR, SEGMENT_LIST_DIRNAME))
+
+# Volumi di registrazione e assegnazione telecamera -> volume
+storage_pool = StoragePool(config.STORAGE_VOLUMES, os.path.join(REGISTRAZIONI_DIR, PLACEMENT_FILENAME),
+                           high_watermark=config.CLEANUP_HIGH_WATERMARK,
+                           rebalance_watermark=config.REBALANCE_WATERMARK)
+
+# Tutte le cartelle che contengono segmenti: volumi cold, cartella principale
+# precedente al pool (solo lettura/eliminazione) e l'eventuale livello hot
+LEGACY_RECORDINGS_DIR = config.LEGACY_RECORDINGS_DIR
+STORAGE_ROOTS = (storage_pool.volumes + ([LEGACY_RECORDINGS_DIR] if LEGACY_RECORDINGS_DIR else [])
+                 + ([HOT_TIER_DIR] if HOT_TIER_DIR else []))
+
+def _root_of(path):
+    """Volume (o livello hot, o cartella precedente al pool) che contiene il percorso"""
+    path = os.path.abspath(path)
+    for root in (HOT_TIER_DIR, LEGACY_RECORDINGS_DIR):
+        if root and path.startswith(root + os.sep):
+            return root
+    return storage_pool.volume_of(path)
+
+# Totali di utilizzo per telecamera mantenuti dal catalogo, riconciliati periodicamente
+storage_accountant = StorageAccountant(segment_catalog, STORAGE_ROOTS)
+storage_accountant.start_reconciler()
+
+# Motore di conservazione: età/quote per telecamera e soglie globali sul catalogo
+retention_engine = RetentionEngine(
+    segment_catalog, storage_accountant, REGISTRAZIONI_DIR,
+    default_policy={"quota_bytes": 0,
+                    "min_retention_days": config.DEFAULT_MIN_RETENTION_DAYS,
+                    "max_retention_days": config.DEFAULT_MAX_RETENTION_DAYS,
+                    "idle_retention_days": config.DEFAULT_IDLE_RETENTION_DAYS,
+                    "event_retention_days": config.DEFAULT_EVENT_RETENTION_DAYS},
+    high_watermark=config.CLEANUP_HIGH_WATERMARK,
+    low_watermark=config.CLEANUP_LOW_WATERMARK,
+    safe_age=SAFE_FILE_AGE,
+    activity=lambda segment, days=None: _segment_activity(segment, days),
+)
+
+# Indice dei keyframe, costruito alla chiusura di ogni segmento
+keyframe_index = KeyframeIndex(os.path.join(REGISTRAZIONI_DIR, KEYFRAMES_DIRNAME),
+                               workers=config.KEYFRAME_INDEX_WORKERS,
+                               resolve=lambda path: resolve_recording_path(path))
+if config.KEYFRAME_INDEX_WORKERS > 0:
+    segment_feed.add_listener(keyframe_index.submit)
+
+def _after_segment_delete(path):
+    """Pulizia accessoria dopo l'eliminazione di un segmento"""
+    keyframe_index.remove(path)
+    if config.STORAGE_LAYOUT == LAYOUT_SHARDED:
+        prune_empty_day_directories(path, _root_of(path) or REGISTRAZIONI_DIR)
+
+# Eliminazioni in background con priorità I/O idle e budget di byte/s
+deletion_worker = DeletionWorker(
+    segment_catalog,
+    bytes_per_second=int(config.DELETE_RATE_MB_S * 1024 ** 2),
+    truncate_step=int(config.DELETE_TRUNCATE_STEP_MB * 1024 ** 2),
+    after_delete=_after_segment_delete,
+)
+
+# Spostamento dei segmenti chiusi dal livello hot al volume cold della telecamera
+tier_mover = None
+if HOT_TIER_DIR:
+    tier_mover = TierMover(
+        segment_catalog, HOT_TIER_DIR,
+        destination=lambda camera: storage_pool.volume_for(camera) or storage_pool.volumes[0],
+        bytes_per_second=int(config.TIER_MOVE_RATE_MB_S * 1024 ** 2),
+        skip=deletion_worker.pending_paths,
+    )
+    tier_mover.start()
+
+# Esportazione di clip in stream copy dai segmenti del catalogo
+clip_exporter = ClipExporter(segment_catalog, os.path.join(REGISTRAZIONI_DIR, CLIPS_DIRNAME),
+                             resolve=lambda path: resolve_recording_path(path), keyframes=keyframe_index)
+
+# Rilevamento movimento sui flussi secondari (avviato da start_motion_detection)
+motion_monitor = MotionMonitor(fps=config.MOTION_FPS, width=config.MOTION_WIDTH, height=config.MOTION_HEIGHT,
+                               cooldown=config.MOTION_COOLDOWN)
+
+# Punteggi di movimento al secondo per telecamera e giorno
+activity_timeline = ActivityTimeline(os.path.join(REGISTRAZIONI_DIR, TIMELINE_DIRNAME))
+motion_monitor.add_score_listener(activity_timeline.record)
+
+# Clip degli eventi con anticipo, dai buffer circolari in memoria
+event_clips = EventClipRecorder(os.path.join(REGISTRAZIONI_DIR, EVENTS_DIRNAME),
+                                pre_seconds=config.EVENT_PRE_SECONDS, post_seconds=config.EVENT_POST_SECONDS)
+
+# Visione live HLS su richiesta, servita dal server HTTP
+live_hls = LiveHLS(config.HLS_DIR, idle_timeout=config.HLS_IDLE_TIMEOUT,
+                   segment_seconds=config.HLS_SEGMENT_SECONDS, max_streams=config.HLS_MAX_STREAMS)
+
+# Miniature dell'ultimo fotogramma dai segmenti in scrittura (cache su tmpfs condivisa con il bot)
+thumbnails = ThumbnailCache(max_age=config.THUMBNAIL_MAX_AGE, width=config.THUMBNAIL_WIDTH or None)
+
+# Mosaico delle telecamere (cache su tmpfs condivisa con il bot)
+mosaic = Mosaic(thumbnails=thumbnails)
+
+# Server HTTP di riproduzione (avviato da start_playback_server)
+playback_server = PlaybackServer(segment_catalog, resolve=lambda path: resolve_recording_path(path),
+                                 timeline=activity_timeline,
+                                 clip_dirs=[clip_exporter.output_dir, event_clips.output_dir],
+                                 max_connections=config.HTTP_MAX_CONNECTIONS, token=config.HTTP_TOKEN,
+                                 live=live_hls if config.HLS_ENABLED else None, mosaic=mosaic,
+                                 thumbnails=thumbnails)
+
+# Ultima scrittura per telecamera, aggiornata dagli eventi inotify
+activity_tracker = RecordingActivityTracker(REGISTRAZIONI_DIR)
+activity_tracker.add_segment_listener(thumbnails.publish_segment)
+activity_tracker.start()
+
 # Avvia il thread per il reset automatico
 reset_thread = threading.Thread(target=reset_restart_counters, daemon=True)
 reset_thread.start()
@@ -66,7 +226,6 @@ def is_ffmpeg_healthy(proc_info):
         return False, "Processo terminato"
 
     try:
-        # Controlla l'utilizzo CPU del processo
         process = psutil.Process(proc.pid)
         
         # Verifica se il processo è in stato zombie o simile
@@ -78,14 +237,10 @@ def is_ffmpeg_healthy(proc_info):
         if memory_info.rss > 1024 * 1024 * 1024:  # > 1GB
             logging.warning(f"⚠️ {name} sta usando molta memoria: {memory_info.rss / (1024**2):.1f} MB")
         
-        # Verifica che il processo abbia file aperti (segno che sta leggendo/scrivendo)
-        try:
-            open_files = process.open_files()
-            if not open_files:
-                return False, "Processo senza file aperti"
-        except (psutil.AccessDenied, psutil.NoSuchProcess):
-            # Se non possiamo accedere ai file aperti, assumiamo che sia OK
-            pass
+        # Verifica che il contatore frame del canale di avanzamento stia avanzando
+        stalled, since = progress_monitor.is_stalled(name)
+        if stalled:
+            return False, f"Flusso bloccato da {since:.0f}s"
         
         return True, "Processo sano"
     except psutil.NoSuchProcess:
@@ -93,108 +248,433 @@ def is_ffmpeg_healthy(proc_info):
     except Exception as e:
         return False, f"Errore controllo salute: {e}"
 
-def can_restart_process(name):
-    """Verifica se un processo può essere riavviato (rispetta cooldown)"""
-    if name in last_restart_time:
-        time_since_last = datetime.now() - last_restart_time[name]
-        if time_since_last.total_seconds() < RESTART_COOLDOWN:
-            remaining = RESTART_COOLDOWN - time_since_last.total_seconds()
-            logging.info(f"⏳ Cooldown attivo per {name}: {remaining:.0f} secondi rimanenti")
-            return False
-    return True
-
 def is_ffmpeg_running(proc_info):
     """ Controlla se ffmpeg sta funzionando correttamente con controlli avanzati. """
     healthy, reason = is_ffmpeg_healthy(proc_info)
     if not healthy:
         logging.error(f"[DEBUG] {proc_info['name']}: {reason}")
         # Invia notifica Telegram solo per problemi gravi
-        if reason not in ["Processo senza file aperti"]:  # Non notificare per problemi minori
+        # L'uscita del processo è già notificata dal thread di attesa (_watch_process_exit)
+        if reason not in ["Processo terminato"] and health_alerts.get(proc_info['name']) != reason:
             send_telegram_message(f"⚠️ {proc_info['name']}: {reason}")
+            health_alerts[proc_info['name']] = reason
+    else:
+        health_alerts.pop(proc_info['name'], None)
     return healthy
 
 def is_recording_active(camera_name, recordings_dir, timeout=59):
-    """ Verifica se c'è un file di registrazione recente per la telecamera specificata. """
-    recordings_path = Path(recordings_dir)
-    pattern = f"{camera_name}_*.mkv"
-    recent_files = [
-        file for file in recordings_path.glob(pattern)
-        if file.stat().st_mtime >= time.time() - timeout
-    ]
-
-    if recent_files:
+    """
+    Verifica se la telecamera ha scritto dati di recente.
+
+    Con inotify è una lettura in memoria dell'ultima scrittura; altrimenti
+    usa l'ultimo segmento chiuso nel catalogo e i byte scritti riportati dal
+    canale di avanzamento di ffmpeg.
+    """
+    active = activity_tracker.is_active(camera_name, timeout)
+    if active:
         return True
+
+    now = time.time()
+
+    if active is None:
+        latest = segment_catalog.latest_segment(camera_name)
+        if latest and latest["end_ts"] >= now - timeout:
+            return True
+
+        progress = progress_monitor.get(camera_name)
+        if progress and progress["total_size"] and progress["updated_at"] and \
+                progress["updated_at"] >= now - timeout and progress["last_advance_at"] >= now - timeout:
+            return True
+
+    logging.warning(f"[DEBUG] Nessun file recente trovato per {camera_name}.")
+    send_telegram_message(f"❌ File recente non trovato per {camera_name}")
+    return False
+
+def _read_log_tail(log_path, lines=5):
+    """Restituisce le ultime righe del log ffmpeg di una telecamera"""
+    try:
+        with open(log_path, "r") as log_file:
+            return ''.join(log_file.readlines()[-lines:]).strip()
+    except Exception as e:
+        logging.error(f"❌ Errore lettura log {log_path}: {e}")
+        return ""
+
+def _first_segment_since(output_template, since, until, cursor=None):
+    """
+    Cerca il primo segmento creato da ffmpeg a partire da `since`.
+
+    Il nome del segmento è generato con strftime all'apertura del file, quindi
+    basta verificare l'esistenza dei nomi attesi per ogni secondo trascorso
+    invece di scansionare l'intera cartella delle registrazioni.
+
+    Returns:
+        tuple: (percorso segmento o None, nuovo cursore in secondi)
+    """
+    second = int(since) - 1 if cursor is None else cursor
+    while second <= int(until):
+        candidate = time.strftime(output_template, time.localtime(second))
+        if os.path.exists(candidate):
+            return candidate, second
+        second += 1
+    # Il file del secondo corrente potrebbe essere creato a breve: ricontrolla gli ultimi 2 secondi
+    return None, max(int(since) - 1, int(until) - 2)
+
+def _spawn_ffmpeg(cmd):
+    """Avvia ffmpeg per una telecamera senza attese e restituisce il proc_info"""
+    # Lista CSV dei segmenti chiusi, propria di questo processo
+    segment_list = segment_feed.new_list_path(cmd["name"])
+    ffmpeg_cmd = build_recording_command(cmd, segment_list)
+    # Log sicuro del comando (nasconde credenziali)
+    safe_cmd = security_manager.sanitize_ffmpeg_command(ffmpeg_cmd)
+    logging.info(f"Avvio ffmpeg per {cmd['name']} con comando: {' '.join(safe_cmd)}")
+
+    # Genera il percorso del file log specifico per la telecamera
+    camera_log_file = f"logs/ffmpeg_{cmd['name']}.log"
+    os.makedirs(os.path.dirname(camera_log_file), exist_ok=True)
+
+    # stdout trasporta il canale di avanzamento, stderr resta sul log della telecamera
+    with open(camera_log_file, "a") as log_file:
+        proc = subprocess.Popen(ffmpeg_cmd, stdout=subprocess.PIPE, stderr=log_file)
+    progress_monitor.attach(cmd["name"], proc.pid, proc.stdout)
+    segment_feed.watch(cmd["name"], segment_list, cmd["output"])
+
+    proc_info = {
+        "name": cmd["name"],
+        "process": proc,
+        "output": cmd["output"],
+        "log_file": camera_log_file,
+        "segment_list": segment_list,
+        "started_at": time.time(),
+        "stopping": False,
+    }
+    threading.Thread(target=_watch_process_exit, args=(proc_info,),
+                     name=f"exit-watch-{cmd['name']}", daemon=True).start()
+    return proc_info
+
+def _signal_name(signum):
+    """Restituisce il nome del segnale (es. SIGKILL) o il suo numero"""
+    try:
+        return signal.Signals(signum).name
+    except ValueError:
+        return f"SIG{signum}"
+
+def _watch_process_exit(proc_info):
+    """
+    Attende l'uscita di un processo ffmpeg e la notifica come evento.
+
+    Un thread per processo resta bloccato in wait(): l'uscita viene rilevata
+    nell'istante in cui avviene e il riavvio viene pianificato subito, senza
+    aspettare il ciclo di monitoraggio.
+    """
+    proc = proc_info["process"]
+    name = proc_info["name"]
+    returncode = proc.wait()
+
+    # Registra gli ultimi segmenti chiusi dal processo prima di eliminarne la lista
+    segment_feed.finish(proc_info["segment_list"])
+
+    event = {
+        "name": name,
+        "pid": proc.pid,
+        "time": time.time(),
+        "uptime": time.time() - proc_info["started_at"],
+        "exit_code": returncode if returncode >= 0 else None,
+        "signal": _signal_name(-returncode) if returncode < 0 else None,
+        "expected": proc_info.get("stopping", False),
+    }
+    exit_events.append(event)
+
+    if event["expected"]:
+        logging.info(f"⏹ ffmpeg per {name} (PID {proc.pid}) terminato su richiesta")
+        return
+
+    if event["signal"]:
+        reason = f"ffmpeg terminato dal segnale {event['signal']} dopo {event['uptime']:.0f}s"
     else:
-        logging.warning(f"[DEBUG] Nessun file recente trovato per {camera_name}.")
-        send_telegram_message(f"❌ File recente non trovato per {camera_name}")
-        return False
+        reason = f"ffmpeg uscito con codice {event['exit_code']} dopo {event['uptime']:.0f}s"
+    last_errors = _read_log_tail(proc_info["log_file"], lines=3)
+    logging.error(f"❌ {name}: {reason}" + (f". Errore: {last_errors}" if last_errors else ""))
+    send_telegram_message(f"❌ {name}: {reason}")
+
+    if ffmpeg_commands:
+        schedule_restart(name, ffmpeg_commands, reason=reason)
+
+def get_exit_events(name=None):
+    """Restituisce gli eventi di uscita registrati (opzionalmente per telecamera)"""
+    return [event for event in exit_events if name is None or event["name"] == name]
+
+def wait_for_cameras_ready(proc_infos, timeout=STARTUP_READY_TIMEOUT):
+    """
+    Attende in parallelo che ogni telecamera produca il primo segmento.
+
+    Una telecamera è pronta quando ffmpeg crea il primo file di registrazione,
+    non dopo un'attesa fissa. Le telecamere lente non ritardano le altre.
+
+    Returns:
+        dict: report per telecamera con stato, motivo e tempo al primo segmento
+    """
+    report = {}
+    cursors = {}
+    pending = {info["name"]: info for info in proc_infos}
+    deadline = time.time() + timeout
+
+    while pending:
+        now = time.time()
+        for name, info in list(pending.items()):
+            proc = info["process"]
+
+            segment, cursors[name] = _first_segment_since(info["output"], info["started_at"], now, cursors.get(name))
+            if segment:
+                elapsed = now - info["started_at"]
+                progress = progress_monitor.get(name) or {}
+                first_frame_at = progress.get("first_frame_at")
+                report[name] = {"ready": True, "reason": "Primo segmento creato", "segment": segment,
+                                "time_to_first_segment": elapsed,
+                                "time_to_first_frame": first_frame_at - info["started_at"] if first_frame_at else None}
+                logging.info(f"✅ {name} pronto: primo segmento {os.path.basename(segment)} dopo {elapsed:.1f}s")
+                del pending[name]
+                continue
+
+            if proc.poll() is not None:
+                # Processo terminato, leggi l'errore dal log
+                last_errors = _read_log_tail(info["log_file"])
+                if last_errors:
+                    logging.error(f"❌ Processo ffmpeg per {name} terminato all'avvio. Errore: {last_errors}")
+                    send_telegram_message(f"❌ Avvio {name} fallito: {last_errors}")
+                else:
+                    logging.error(f"❌ Processo ffmpeg per {name} terminato all'avvio.")
+                    send_telegram_message(f"❌ Avvio {name} fallito: processo terminato immediatamente.")
+                report[name] = {"ready": False, "reason": f"Processo terminato (codice {proc.returncode})",
+                                "segment": None, "time_to_first_segment": None, "time_to_first_frame": None}
+                del pending[name]
+                continue
+
+            if now >= deadline:
+                logging.warning(f"⚠️ {name} avviato ma nessun segmento creato entro {timeout}s")
+                report[name] = {"ready": False, "reason": f"Nessun segmento entro {timeout}s",
+                                "segment": None, "time_to_first_segment": None, "time_to_first_frame": None}
+                del pending[name]
+
+        if pending:
+            time.sleep(STARTUP_POLL_INTERVAL)
+
+    return report
 
 def start_ffmpeg_processes(FFMPEG_COMMANDS):
-    global processes
+    """
+    Avvia contemporaneamente ffmpeg per tutte le telecamere e ne attende la prontezza.
+
+    Returns:
+        dict: report di prontezza per telecamera (vedi wait_for_cameras_ready)
+    """
+    global processes, ffmpeg_commands
     os.makedirs(os.path.dirname(FFMPEG_LOG_PATH), exist_ok=True)
+    ffmpeg_commands = FFMPEG_COMMANDS
+    place_cameras(FFMPEG_COMMANDS)
+    prepare_storage_layout(FFMPEG_COMMANDS)
 
+    started = []
     for cmd in FFMPEG_COMMANDS:
-        ffmpeg_cmd = [
-            "ffmpeg",
-            "-hide_banner",
-            "-y",
-            "-loglevel",
-            "error",
-            "-rtsp_transport",
-            "tcp",
-            "-use_wallclock_as_timestamps",
-            "1",
-            "-i",
-            cmd["url"],
-            "-vcodec",
-            "copy",
-            "-acodec",
-            "copy",
-            "-f",
-            "segment",
-            "-reset_timestamps",
-            "1",
-            "-segment_time",
-            "300",
-            "-segment_format",
-            "mkv",
-            "-segment_atclocktime",
-            "1",
-            "-strftime",
-            "1",
-            cmd["output"],
-        ]
-        # Log sicuro del comando (nasconde credenziali)
-        safe_cmd = security_manager.sanitize_ffmpeg_command(ffmpeg_cmd)
-        logging.info(f"Avvio ffmpeg per {cmd['name']} con comando: {' '.join(safe_cmd)}")
-        
-        # Genera il percorso del file log specifico per la telecamera
-        camera_log_file = f"logs/ffmpeg_{cmd['name']}.log"
-        os.makedirs(os.path.dirname(camera_log_file), exist_ok=True)
-        
-        with open(camera_log_file, "a") as log_file:
-            proc = subprocess.Popen(ffmpeg_cmd, stdout=log_file, stderr=log_file)
-            
-            # Controllo iniziale dello stato del processo
-            time.sleep(5)  # Aspetta che il processo si stabilizzi
-            
-            if proc.poll() is not None:
-                # Processo terminato, leggi l'errore dal log
-                try:
-                    with open(camera_log_file, "r") as error_file:
-                        error_lines = error_file.readlines()
-                        if error_lines:
-                            last_errors = ''.join(error_lines[-5:]).strip()  # Ultime 5 righe
-                            logging.error(f"❌ Processo ffmpeg per {cmd['name']} terminato all'avvio. Errore: {last_errors}")
-                            send_telegram_message(f"❌ Avvio {cmd['name']} fallito: {last_errors}")
-                        else:
-                            logging.error(f"❌ Processo ffmpeg per {cmd['name']} terminato all'avvio.")
-                            send_telegram_message(f"❌ Avvio {cmd['name']} fallito: processo terminato immediatamente.")
-                except Exception as e:
-                    logging.error(f"❌ Processo ffmpeg per {cmd['name']} terminato all'avvio. Errore lettura log: {e}")
-                    send_telegram_message(f"❌ Avvio {cmd['name']} fallito: processo terminato immediatamente.")
-            
-        processes.append({"name": cmd["name"], "process": proc, "output": cmd["output"]})
+        try:
+            proc_info = _spawn_ffmpeg(cmd)
+        except Exception as e:
+            logging.error(f"❌ Errore nell'avvio di ffmpeg per {cmd['name']}: {e}")
+            send_telegram_message(f"❌ Avvio {cmd['name']} fallito: {str(e)}")
+            continue
+        with processes_lock:
+            processes.append(proc_info)
+        started.append(proc_info)
+
+    report = wait_for_cameras_ready(started)
+    ready = sum(1 for status in report.values() if status["ready"])
+    logging.info(f"📹 Telecamere pronte: {ready}/{len(FFMPEG_COMMANDS)}")
+    return report
+
+def _camera_byte_rate(name):
+    """Byte/s della telecamera: bitrate live di -progress, altrimenti dal catalogo"""
+    state = progress_monitor.get(name)
+    if state and state.get("bitrate_kbps"):
+        return state["bitrate_kbps"] * 1000 / 8
+    return segment_catalog.byte_rate(name, time.time() - BITRATE_WINDOW)
+
+def _camera_rates(cameras):
+    rates = {}
+    for camera in cameras:
+        rate = _camera_byte_rate(camera["name"])
+        if rate:
+            rates[camera["name"]] = rate
+    return rates
+
+def _set_camera_volume(cmd, volume):
+    """
+    Aggiorna volume e percorso di output di una telecamera. Con il livello hot
+    ffmpeg scrive sempre lì e il volume è la destinazione del mover.
+    """
+    cmd["volume"] = volume
+    cmd["output"] = output_template(HOT_TIER_DIR or volume, cmd["name"], config.STORAGE_LAYOUT,
+                                    container_extension(cmd.get("container")))
+
+def place_cameras(cameras):
+    """Assegna ogni telecamera a un volume del pool e ne imposta l'output"""
+    assignments = storage_pool.assign([camera["name"] for camera in cameras], _camera_rates(cameras))
+    for cmd in cameras:
+        _set_camera_volume(cmd, assignments[cmd["name"]])
+
+def prepare_storage_layout(cameras):
+    """
+    Osserva con inotify le cartelle in cui scrivono le telecamere. Con il
+    layout per giorno crea prima le cartelle di oggi e domani (ffmpeg non le
+    crea) e osserva solo quelle.
+
+    Returns:
+        list: Cartelle osservate
+    """
+    directories = [HOT_TIER_DIR] if HOT_TIER_DIR else list(storage_pool.volumes)
+    if config.STORAGE_LAYOUT == LAYOUT_SHARDED:
+        for camera in cameras:
+            volume = HOT_TIER_DIR or camera.get("volume") or REGISTRAZIONI_DIR
+            directories += ensure_day_directories(volume, [camera["name"]])
+    activity_tracker.watch_only(directories)
+    return directories
+
+def relocate_camera(name):
+    """Riavvia una sola telecamera sul volume assegnato (le altre non si fermano)"""
+    cmd = next((cmd for cmd in ffmpeg_commands if cmd["name"] == name), None)
+    if cmd is None:
+        return
+    _terminate_camera_processes(name)
+    try:
+        proc_info = _spawn_ffmpeg(cmd)
+    except Exception as e:
+        logging.error(f"❌ Errore nell'avvio di ffmpeg per {name} su {cmd['volume']}: {e}")
+        schedule_restart(name, ffmpeg_commands, reason=str(e))
+        return
+    with processes_lock:
+        processes.append(proc_info)
+
+def rebalance_storage():
+    """
+    Sposta su un altro volume la telecamera più pesante di ogni volume oltre la
+    soglia di ribilanciamento. Solo la telecamera spostata viene riavviata.
+
+    Returns:
+        list: (telecamera, volume precedente, nuovo volume)
+    """
+    moves = storage_pool.rebalance(_camera_rates(ffmpeg_commands))
+    for name, old_volume, new_volume in moves:
+        cmd = next((cmd for cmd in ffmpeg_commands if cmd["name"] == name), None)
+        if cmd is None:
+            continue
+        logging.warning(f"💽 Volume {old_volume} pieno: {name} spostata su {new_volume}")
+        send_telegram_message(f"💽 Volume pieno: {name} ora registra su {new_volume}")
+        _set_camera_volume(cmd, new_volume)
+        if HOT_TIER_DIR:
+            continue  # cambia solo la destinazione del mover: nessun riavvio
+        prepare_storage_layout(ffmpeg_commands)
+        # Se è già pianificato un riavvio, userà comunque il nuovo percorso
+        restart_scheduler.schedule(name, 0, relocate_camera, name)
+    return moves
+
+def storage_rebalancer():
+    """Controlla periodicamente i volumi pieni del pool"""
+    while True:
+        time.sleep(REBALANCE_INTERVAL)
+        try:
+            if ffmpeg_commands:
+                rebalance_storage()
+        except Exception as e:
+            logging.error(f"❌ Errore ribilanciamento volumi: {e}")
+
+def layout_maintenance():
+    """Prepara in anticipo le cartelle del giorno successivo"""
+    while True:
+        time.sleep(LAYOUT_MAINTENANCE_INTERVAL)
+        try:
+            if ffmpeg_commands:
+                prepare_storage_layout(ffmpeg_commands)
+        except Exception as e:
+            logging.error(f"❌ Errore preparazione cartelle registrazioni: {e}")
+
+def start_layout_migration():
+    """
+    Avvia in background lo spostamento dei segmenti flat nelle cartelle per
+    giorno, se il layout per giorno è attivo e ci sono segmenti da spostare.
+
+    Returns:
+        bool: True se la migrazione è stata avviata
+    """
+    if config.STORAGE_LAYOUT != LAYOUT_SHARDED:
+        return False
+    migrators = [LayoutMigrator(segment_catalog, volume) for volume in STORAGE_ROOTS]
+    migrators = [migrator for migrator in migrators if migrator.pending()]
+    if not migrators:
+        return False
+    logging.info("📦 Migrazione al layout per giorno avviata in background")
+    threading.Thread(target=lambda: [migrator.run() for migrator in migrators],
+                     name="layout-migrator", daemon=True).start()
+    return True
+
+def _motion_caption(event):
+    return f"🏃 Movimento rilevato: {event['camera']} alle {time.strftime('%H:%M:%S', time.localtime(event['ts']))}"
+
+def _notify_motion(event):
+    if event["type"] == "start":
+        send_telegram_message(_motion_caption(event))
+
+def _notify_event_clip(event, path):
+    """Avviso con la clip dell'evento (solo testo se la clip non è disponibile)"""
+    if path is None or not send_telegram_video(path, caption=_motion_caption(event)):
+        send_telegram_message(_motion_caption(event))
+
+def start_motion_detection(cameras):
+    """
+    Avvia l'analisi del movimento sui flussi secondari delle telecamere abilitate.
+
+    Returns:
+        int: Telecamere analizzate
+    """
+    if not any(camera.get("motion") for camera in cameras):
+        return 0
+    if config.EVENT_CLIPS:
+        motion_monitor.add_listener(event_clips.on_motion)
+        if config.MOTION_NOTIFY:
+            event_clips.add_listener(_notify_event_clip)
+    elif config.MOTION_NOTIFY:
+        motion_monitor.add_listener(_notify_motion)
+    started = motion_monitor.start(cameras)
+    if started:
+        activity_timeline.start()
+        logging.info(f"👁️ Rilevamento movimento attivo su {started} telecamere")
+    if config.EVENT_CLIPS:
+        # Buffer solo per le telecamere con un rilevatore avviato: le altre non generano eventi
+        detected = [camera for camera in cameras if camera["name"] in motion_monitor.detectors]
+        rings = event_clips.start(detected, source=config.EVENT_CLIP_SOURCE)
+        logging.info(f"🎞️ Buffer eventi ({config.EVENT_PRE_SECONDS:.0f}s di anticipo) attivo su {rings} telecamere")
+    return started
+
+def start_playback_server(cameras):
+    """Avvia il server HTTP di riproduzione (e la visione live HLS) se abilitati in config.ini"""
+    if not config.HTTP_ENABLED:
+        return
+    if config.HLS_ENABLED:
+        live_hls.set_sources(cameras)
+    mosaic.set_sources(cameras)
+    try:
+        playback_server.start(config.HTTP_BIND, config.HTTP_PORT)
+    except OSError as e:
+        # L'IP Tailscale esiste solo dopo /tailscale_start: si riprova finché non è disponibile
+        logging.warning(f"⚠️ Server di riproduzione non avviato su {config.HTTP_BIND}:{config.HTTP_PORT} ({e}), "
+                        f"nuovo tentativo ogni {HTTP_BIND_RETRY_INTERVAL}s")
+        threading.Thread(target=_retry_playback_server, name="http-bind-retry", daemon=True).start()
+
+def _retry_playback_server():
+    while True:
+        time.sleep(HTTP_BIND_RETRY_INTERVAL)
+        try:
+            playback_server.start(config.HTTP_BIND, config.HTTP_PORT)
+            return
+        except OSError:
+            continue
 
 def stop_ffmpeg_processes():
     """ Termina tutti i processi ffmpeg attivi. """
@@ -202,6 +682,8 @@ def stop_ffmpeg_processes():
     for proc_info in processes:
         proc = proc_info["process"]
         name = proc_info["name"]
+        proc_info["stopping"] = True  # Uscita attesa: nessun riavvio
+        restart_scheduler.cancel(name)
         if proc.poll() is None:
             logging.info(f"Terminazione del processo {name} (PID {proc.pid})")
             proc.terminate()
@@ -213,122 +695,128 @@ def stop_ffmpeg_processes():
                 proc.kill()
     processes.clear()
 
-def restart_ffmpeg_process(name, FFMPEG_COMMANDS):
-    """ Riavvia il processo ffmpeg con controlli avanzati e backoff esponenziale. """
+def schedule_restart(name, FFMPEG_COMMANDS, reason=None):
+    """
+    Pianifica il riavvio di ffmpeg per una telecamera senza bloccare il chiamante.
+
+    Il backoff esponenziale e il cooldown diventano una scadenza nello scheduler:
+    il ciclo di supervisione prosegue subito con le altre telecamere.
+
+    Returns:
+        bool: True se è stato pianificato un nuovo riavvio
+    """
     global restart_attempts, last_restart_time
 
-    # Controlla cooldown
-    if not can_restart_process(name):
-        return
+    if restart_attempts.get(name) == -1:
+        logging.info(f"⏹ Riavvio automatico disattivato per {name}")
+        return False
 
-    if name not in restart_attempts:
-        restart_attempts[name] = 0
+    if restart_scheduler.is_pending(name):
+        logging.info(f"⏳ Riavvio di {name} già pianificato")
+        return False
 
-    restart_attempts[name] += 1
-    last_restart_time[name] = datetime.now()
+    restart_attempts[name] = restart_attempts.get(name, 0) + 1
 
     if restart_attempts[name] >= MAX_ATTEMPTS:
         logging.error(f"❌ Troppi riavvii per {name}, disattivato il riavvio automatico.")
         send_telegram_message(f"❌ Impossibile riavviare ffmpeg per {name}. Troppi tentativi falliti ({MAX_ATTEMPTS}).")
         restart_attempts[name] = -1  # Disabilita il riavvio per questa telecamera
-        return
+        return False
 
-    # Calcola ritardo con backoff esponenziale
+    # Il ritardo è il maggiore tra backoff esponenziale e cooldown residuo
     delay = get_backoff_delay(restart_attempts[name])
+    if name in last_restart_time:
+        elapsed = (datetime.now() - last_restart_time[name]).total_seconds()
+        delay = max(delay, RESTART_COOLDOWN - elapsed)
+
+    if reason:
+        logging.warning(f"⚠️ {name}: {reason}")
     if delay > 0:
-        logging.info(f"⏳ Attesa {delay}s prima del riavvio di {name} (tentativo {restart_attempts[name]}/{MAX_ATTEMPTS})")
-        time.sleep(delay)
+        logging.info(f"⏳ Riavvio di {name} pianificato tra {delay:.0f}s (tentativo {restart_attempts[name]}/{MAX_ATTEMPTS})")
 
-    for cmd in FFMPEG_COMMANDS:
-        if cmd["name"] == name:
-            logging.info(f"🔄 Riavvio di ffmpeg per {cmd['name']} (tentativo {restart_attempts[name]}/{MAX_ATTEMPTS})")
-
-            # Termina il processo esistente con controlli migliorati
-            for proc_info in list(processes):
-                if proc_info["name"] == name:
-                    proc = proc_info["process"]
-                    if proc.poll() is None:
-                        logging.info(f"⏹ Terminazione del processo {name} (PID {proc.pid})")
-                        proc.terminate()
-                        try:
-                            proc.wait(timeout=15)  # Aumentato timeout
-                            logging.info(f"✅ Processo {name} terminato correttamente.")
-                        except subprocess.TimeoutExpired:
-                            logging.warning(f"⚠️ Forzatura della terminazione del processo {name} (PID {proc.pid})")
-                            proc.kill()
-                            try:
-                                proc.wait(timeout=5)
-                            except subprocess.TimeoutExpired:
-                                logging.error(f"❌ Impossibile terminare {name} (PID {proc.pid})")
-                    processes.remove(proc_info)
-
-            # Genera il percorso del file log specifico per la telecamera
-            camera_log_file = f"logs/ffmpeg_{name}.log"
-            os.makedirs(os.path.dirname(camera_log_file), exist_ok=True)
-
-            # Prepara comando ffmpeg compatibile con versioni più vecchie
-            ffmpeg_cmd = [
-                "ffmpeg",
-                "-hide_banner",
-                "-y",
-                "-loglevel", "error",
-                "-rtsp_transport", "tcp",
-                "-use_wallclock_as_timestamps", "1",
-                "-i", cmd["url"],
-                "-vcodec", "copy",
-                "-acodec", "copy",
-                "-f", "segment",
-                "-reset_timestamps", "1",
-                "-segment_time", "300",
-                "-segment_format", "mkv",
-                "-segment_atclocktime", "1",
-                "-strftime", "1",
-                cmd["output"],
-            ]
-
-            # Avvia il nuovo processo ffmpeg
-            with open(camera_log_file, "a") as log_file:
-                safe_cmd = security_manager.sanitize_ffmpeg_command(ffmpeg_cmd)
-                logging.info(f"▶️ Avvio ffmpeg per {cmd['name']} con comando: {' '.join(safe_cmd)}")
-                send_telegram_message(f"⚠️ Riavvio ffmpeg per {cmd['name']} ({restart_attempts[name]}/{MAX_ATTEMPTS}).")
-                
+    return restart_scheduler.schedule(name, delay, restart_ffmpeg_process, name, FFMPEG_COMMANDS)
+
+def _terminate_camera_processes(name):
+    """Termina e rimuove dalla lista i processi ffmpeg di una telecamera"""
+    with processes_lock:
+        targets = [proc_info for proc_info in processes if proc_info["name"] == name]
+        for proc_info in targets:
+            processes.remove(proc_info)
+
+    for proc_info in targets:
+        proc = proc_info["process"]
+        proc_info["stopping"] = True  # Uscita attesa: nessun riavvio
+        if proc.poll() is None:
+            logging.info(f"⏹ Terminazione del processo {name} (PID {proc.pid})")
+            proc.terminate()
+            try:
+                proc.wait(timeout=15)  # Aumentato timeout
+                logging.info(f"✅ Processo {name} terminato correttamente.")
+            except subprocess.TimeoutExpired:
+                logging.warning(f"⚠️ Forzatura della terminazione del processo {name} (PID {proc.pid})")
+                proc.kill()
                 try:
-                    proc = subprocess.Popen(ffmpeg_cmd, stdout=log_file, stderr=log_file)
-                    
-                    # Attesa e controllo iniziale
-                    time.sleep(10)  # Aspetta più tempo per stabilizzazione
-                    
-                    if proc.poll() is None:
-                        # Processo ancora attivo, controlla se sta davvero registrando
-                        time.sleep(5)  # Attesa aggiuntiva
-                        if is_recording_active(name, REGISTRAZIONI_DIR, timeout=30):
-                            logging.info(f"✅ Processo ffmpeg per {name} avviato e registra correttamente.")
-                            restart_attempts[name] = 0  # Reset conteggio errori
-                            send_telegram_message(f"✅ {name} riavviato con successo e sta registrando.")
-                        else:
-                            logging.warning(f"⚠️ {name} avviato ma non sta registrando ancora.")
-                    else:
-                        # Processo terminato, leggi l'errore dal log
-                        try:
-                            with open(camera_log_file, "r") as error_file:
-                                error_lines = error_file.readlines()
-                                if error_lines:
-                                    last_errors = ''.join(error_lines[-5:]).strip()  # Ultime 5 righe
-                                    logging.error(f"❌ Processo ffmpeg per {name} terminato immediatamente. Errore: {last_errors}")
-                                    send_telegram_message(f"❌ Riavvio {name} fallito: {last_errors}")
-                                else:
-                                    logging.error(f"❌ Processo ffmpeg per {name} terminato immediatamente.")
-                                    send_telegram_message(f"❌ Riavvio {name} fallito: processo terminato immediatamente.")
-                        except Exception as e:
-                            logging.error(f"❌ Processo ffmpeg per {name} terminato immediatamente. Errore lettura log: {e}")
-                            send_telegram_message(f"❌ Riavvio {name} fallito: processo terminato immediatamente.")
-                    
-                    processes.append({"name": cmd["name"], "process": proc, "output": cmd["output"]})
-                    
-                except Exception as e:
-                    logging.error(f"❌ Errore nell'avvio di ffmpeg per {name}: {e}")
-                    send_telegram_message(f"❌ Errore riavvio {name}: {str(e)}")
-            break
+                    proc.wait(timeout=5)
+                except subprocess.TimeoutExpired:
+                    logging.error(f"❌ Impossibile terminare {name} (PID {proc.pid})")
+
+def restart_ffmpeg_process(name, FFMPEG_COMMANDS):
+    """
+    Riavvia il processo ffmpeg di una telecamera.
+
+    Eseguito dallo scheduler in un thread dedicato alla telecamera: la verifica
+    di stabilizzazione è pianificata come scadenza separata, senza attese.
+    """
+    global last_restart_time
+
+    cmd = next((cmd for cmd in FFMPEG_COMMANDS if cmd["name"] == name), None)
+    if cmd is None:
+        logging.error(f"❌ Telecamera {name} non trovata nella configurazione")
+        return
+
+    last_restart_time[name] = datetime.now()
+    logging.info(f"🔄 Riavvio di ffmpeg per {name} (tentativo {restart_attempts.get(name, 0)}/{MAX_ATTEMPTS})")
+
+    # Termina il processo esistente con controlli migliorati
+    _terminate_camera_processes(name)
+
+    send_telegram_message(f"⚠️ Riavvio ffmpeg per {name} ({restart_attempts.get(name, 0)}/{MAX_ATTEMPTS}).")
+    try:
+        proc_info = _spawn_ffmpeg(cmd)
+    except Exception as e:
+        logging.error(f"❌ Errore nell'avvio di ffmpeg per {name}: {e}")
+        send_telegram_message(f"❌ Errore riavvio {name}: {str(e)}")
+        return
+
+    with processes_lock:
+        processes.append(proc_info)
+
+    # Controllo di stabilizzazione pianificato, non bloccante
+    restart_scheduler.schedule(f"{name}:verify", RESTART_VERIFY_DELAY, _verify_restart, proc_info)
+
+def _verify_restart(proc_info):
+    """Verifica che un processo riavviato sia attivo e stia registrando"""
+    name = proc_info["name"]
+    proc = proc_info["process"]
+
+    if proc.poll() is None:
+        # Processo ancora attivo, controlla se sta davvero registrando
+        if is_recording_active(name, REGISTRAZIONI_DIR, timeout=30):
+            logging.info(f"✅ Processo ffmpeg per {name} avviato e registra correttamente.")
+            restart_attempts[name] = 0  # Reset conteggio errori
+            send_telegram_message(f"✅ {name} riavviato con successo e sta registrando.")
+        else:
+            logging.warning(f"⚠️ {name} avviato ma non sta registrando ancora.")
+        return
+
+    # Processo terminato, leggi l'errore dal log
+    last_errors = _read_log_tail(proc_info["log_file"])
+    if last_errors:
+        logging.error(f"❌ Processo ffmpeg per {name} terminato immediatamente. Errore: {last_errors}")
+        send_telegram_message(f"❌ Riavvio {name} fallito: {last_errors}")
+    else:
+        logging.error(f"❌ Processo ffmpeg per {name} terminato immediatamente.")
+        send_telegram_message(f"❌ Riavvio {name} fallito: processo terminato immediatamente.")
 
 def get_storage_usage_gb():
     """ Restituisce l'uso dello storage in GB con informazioni dettagliate. """
@@ -347,17 +835,158 @@ def get_storage_usage_gb():
         logging.error(f"❌ Errore durante la lettura dello spazio su {REGISTRAZIONI_DIR}: {e}")
         return 0
 
+def sync_segment_catalog(background=True):
+    """
+    Allinea il catalogo dei segmenti con il disco.
+
+    Al primo avvio (catalogo vuoto) la ricostruzione è sincrona, così pulizia
+    e statistiche partono con dati completi; altrimenti avviene in background.
+    """
+    def _sync():
+        try:
+            segment_catalog.rebuild_from_disk(STORAGE_ROOTS)
+        except Exception as e:
+            logging.error(f"❌ Errore sincronizzazione catalogo segmenti: {e}")
+            return
+        if config.KEYFRAME_INDEX_WORKERS > 0:
+            # Segmenti chiusi mentre l'NVR era fermo
+            keyframe_index.backfill(segment_catalog, since=time.time() - KEYFRAME_BACKFILL_WINDOW)
+
+    if background and not segment_catalog.is_empty():
+        threading.Thread(target=_sync, name="catalog-sync", daemon=True).start()
+    else:
+        _sync()
+
+def _delete_segment(segment):
+    """
+    Accoda un segmento al thread di eliminazione (disco e catalogo).
+
+    Returns:
+        int: Byte che verranno liberati (0 se il segmento era già in coda)
+    """
+    if not deletion_worker.enqueue(segment):
+        return 0
+    return segment["size"]
+
+def _segment_activity(segment, days=None):
+    """Movimento nel segmento: True, False (inattivo) o None (mai analizzato)"""
+    return activity_timeline.has_activity(segment["camera"], segment["start_ts"], segment["end_ts"], days=days)
+
+def _safe_oldest_segments(limit, volume=None):
+    """
+    Segmenti più vecchi terminati da almeno SAFE_FILE_AGE e non già in coda.
+
+    Tra i più vecchi (una finestra di SAFE_CANDIDATES_FACTOR volte il limite)
+    vengono scelti prima quelli senza movimento e per ultimi quelli con movimento.
+    """
+    pending = deletion_worker.pending_paths()
+    candidates = segment_catalog.oldest_segments(limit=limit * SAFE_CANDIDATES_FACTOR + len(pending),
+                                                 ended_before=time.time() - SAFE_FILE_AGE,
+                                                 directory=volume)
+    candidates = [segment for segment in candidates if segment["path"] not in pending]
+    rank = {False: 0, None: 1, True: 2}
+    candidates.sort(key=lambda segment: (rank[_segment_activity(segment)], segment["start_ts"]))
+    return candidates[:limit]
+
+def _retention_engine_for(path):
+    """Motore di conservazione limitato al volume che contiene `path`"""
+    volume = _root_of(path)
+    if len(STORAGE_ROOTS) < 2 or volume is None:
+        return retention_engine
+    return RetentionEngine(
+        segment_catalog, storage_accountant, volume,
+        policies=retention_engine.policies,
+        default_policy=retention_engine.default_policy,
+        high_watermark=retention_engine.high_watermark,
+        low_watermark=retention_engine.low_watermark,
+        safe_age=SAFE_FILE_AGE,
+        volume_only=True,
+        activity=retention_engine.activity,
+    )
+
+def get_volume_usage():
+    """
+    Restituisce l'utilizzo percentuale di ogni volume del pool.
+
+    Returns:
+        dict: volume -> percentuale
+    """
+    usage = {}
+    for volume in STORAGE_ROOTS:
+        try:
+            usage[volume] = storage_pool.usage_percent(volume)
+        except OSError as e:
+            logging.error(f"❌ Errore lettura spazio del volume {volume}: {e}")
+    return usage
+
+def resolve_recording_path(path):
+    """Percorso attuale di un segmento del catalogo, sul livello hot o cold"""
+    return resolve_segment_path(path, HOT_TIER_DIR, storage_pool.volumes)
+
+def export_clip(camera, start_ts, end_ts):
+    """
+    Esporta senza ricodifica la registrazione di una telecamera tra due istanti.
+
+    Returns:
+        dict: path, start_ts, end_ts, segments, size, elapsed, cached (vedi ClipExporter.export)
+
+    Raises:
+        ClipExportError: intervallo non valido, nessun segmento o errore ffmpeg
+    """
+    return clip_exporter.export(camera, start_ts, end_ts)
+
+def get_deletion_metrics():
+    """Profondità della coda di eliminazione e latenze di unlink"""
+    return deletion_worker.metrics()
+
+def configure_retention(cameras):
+    """Imposta le politiche di conservazione per telecamera dalla configurazione"""
+    retention_engine.policies = {
+        camera["name"]: {
+            "quota_bytes": camera.get("quota_bytes", 0),
+            "min_retention_days": camera.get("min_retention_days", 0),
+            "max_retention_days": camera.get("max_retention_days", 0),
+            "idle_retention_days": camera.get("idle_retention_days", 0),
+            "event_retention_days": camera.get("event_retention_days", 0),
+        }
+        for camera in cameras
+    }
+
+def enforce_retention_policies():
+    """
+    Applica età massima e quote per telecamera (indipendentemente dalle soglie disco).
+
+    Returns:
+        int: Numero di segmenti eliminati
+    """
+    victims = retention_engine.policy_victims(exclude=deletion_worker.pending_paths())
+    if not victims:
+        return 0
+
+    deleted_count = 0
+    bytes_freed = 0
+    reasons = {}
+    for segment, reason in victims:
+        try:
+            bytes_freed += _delete_segment(segment)
+            deleted_count += 1
+            reasons[reason] = reasons.get(reason, 0) + 1
+        except Exception as e:
+            logging.error(f"❌ Errore eliminazione {os.path.basename(segment['path'])}: {e}")
+
+    details = ", ".join(f"{count} per {reason}" for reason, count in reasons.items())
+    logging.info(f"🗑️ Conservazione: {deleted_count} segmenti in eliminazione ({details}), {bytes_freed / (1024**3):.2f} GB da liberare")
+    return deleted_count
+
 def get_storage_statistics():
     """Restituisce statistiche dettagliate dello storage"""
     try:
         usage = psutil.disk_usage(REGISTRAZIONI_DIR)
-        files = list(Path(REGISTRAZIONI_DIR).glob("*.mkv"))
+        totals = storage_accountant.usage()
         
-        total_files = len(files)
+        total_files = totals["files"]
         if total_files > 0:
-            oldest_file = min(files, key=lambda f: f.stat().st_mtime)
-            newest_file = max(files, key=lambda f: f.stat().st_mtime)
-            avg_file_size = sum(f.stat().st_size for f in files) / total_files / (1024**2)  # MB
+            avg_file_size = totals["bytes"] / total_files / (1024**2)  # MB
             
             return {
                 'total_gb': usage.total / (1024 ** 3),
@@ -365,14 +994,35 @@ def get_storage_statistics():
                 'free_gb': usage.free / (1024 ** 3),
                 'usage_percent': (usage.used / usage.total) * 100,
                 'total_files': total_files,
-                'oldest_file': oldest_file.name,
-                'newest_file': newest_file.name,
-                'avg_file_size_mb': avg_file_size
+                'oldest_file': os.path.basename(totals["oldest_path"]),
+                'newest_file': os.path.basename(totals["newest_path"]),
+                'avg_file_size_mb': avg_file_size,
+                'recordings_gb': totals["bytes"] / (1024 ** 3),
+                'cameras': {camera: {'files': row["files"], 'gb': row["bytes"] / (1024 ** 3)}
+                            for camera, row in storage_accountant.per_camera().items()},
+                'volumes': _volume_statistics()
             }
     except Exception as e:
         logging.error(f"❌ Errore calcolo statistiche storage: {e}")
         return None
 
+def _volume_statistics():
+    """Spazio, registrazioni e telecamere assegnate per ogni volume del pool"""
+    volumes = {}
+    for volume in STORAGE_ROOTS:
+        usage = storage_pool.usage(volume)
+        totals = segment_catalog.directory_totals(volume)
+        volumes[volume] = {
+            'total_gb': usage.total / (1024 ** 3),
+            'used_gb': usage.used / (1024 ** 3),
+            'free_gb': usage.free / (1024 ** 3),
+            'usage_percent': (usage.used / usage.total) * 100,
+            'files': totals["files"],
+            'recordings_gb': totals["bytes"] / (1024 ** 3),
+            'cameras': sorted(camera for camera, assigned in storage_pool.assignments.items() if assigned == volume),
+        }
+    return volumes
+
 def smart_cleanup(path, target_usage_percent=90):
     """
     Pulizia intelligente basata su percentuale di utilizzo target.
@@ -400,23 +1050,10 @@ def smart_cleanup(path, target_usage_percent=90):
             logging.info("log:logs.space_ok_no_cleanup:%s:%s" % (current_usage_percent, target_usage_percent))
             return 0
         
-        files = list(Path(path).glob("*.mkv"))
-        if not files:
+        if segment_catalog.is_empty():
             logging.warning("log:logs.no_mkv_files")
             return 0
         
-        # Protezione: non eliminare file più recenti di 1 ora
-        current_time = time.time()
-        safe_files = [f for f in files if current_time - f.stat().st_mtime > 3600]
-        
-        if not safe_files:
-            logging.warning("log:logs.no_safe_files")
-            send_telegram_message("⚠️ Pulizia automatica: nessun file sicuro da eliminare (tutti recenti)")
-            return 0
-        
-        # Ordina per data di modifica (più vecchi per primi)
-        safe_files.sort(key=lambda f: f.stat().st_mtime)
-        
         # Calcola quanti byte liberare per raggiungere la percentuale target
         target_used_bytes = (target_usage_percent / 100) * usage.total
         bytes_to_free = usage.used - target_used_bytes
@@ -424,36 +1061,42 @@ def smart_cleanup(path, target_usage_percent=90):
         logging.info("log:logs.cleanup_objective:%s:%s" % (current_usage_percent, target_usage_percent))
         logging.info("log:logs.bytes_to_free:%s" % (bytes_to_free / (1024**3)))
         
+        # Vittime scelte dal motore di conservazione: rispetta età minime e
+        # quote per telecamera invece di trattare tutte le telecamere come un unico insieme
+        metrics = deletion_worker.metrics()
+        victims = _retention_engine_for(path).plan(target_usage_percent,
+                                        exclude=deletion_worker.pending_paths(),
+                                        pending_bytes=metrics["pending_bytes"])
+        
+        if not victims:
+            logging.warning("log:logs.no_safe_files")
+            send_telegram_message("⚠️ Pulizia automatica: nessun file sicuro da eliminare (tutti recenti)")
+            return 0
+        
         deleted_count = 0
         bytes_freed = 0
         
-        for file in safe_files:
+        for segment, reason in victims:
             try:
-                file_size = file.stat().st_size
-                file.unlink()
-                bytes_freed += file_size
+                bytes_freed += _delete_segment(segment)
                 deleted_count += 1
                 
-                logging.info("log:logs.file_deleted:%s:%s" % (file.name, file_size / (1024**2)))
-                
-                # Controlla se abbiamo liberato abbastanza spazio
-                if bytes_freed >= bytes_to_free:
-                    break
+                logging.info("log:logs.file_deleted:%s:%s" % (os.path.basename(segment["path"]), segment["size"] / (1024**2)))
                     
             except Exception as e:
-                logging.error(f"❌ Errore eliminazione {file.name}: {e}")
+                logging.error(f"❌ Errore eliminazione {os.path.basename(segment['path'])}: {e}")
         
-        # Verifica finale
-        final_usage = psutil.disk_usage(path)
-        final_usage_percent = (final_usage.used / final_usage.total) * 100
+        # Le eliminazioni sono solo accodate (il worker è limitato in banda):
+        # misurare il disco ora darebbe lo stesso utilizzo di prima
+        expected_usage_percent = max(usage.used - bytes_freed, 0) / usage.total * 100
         
-        logging.info("log:logs.cleanup_summary:%s:%s" % (deleted_count, bytes_freed / (1024**3)))
-        logging.info("log:logs.final_usage:%s" % final_usage_percent)
+        logging.info("log:logs.cleanup_scheduled:%s:%s" % (deleted_count, bytes_freed / (1024**3)))
+        logging.info("log:logs.expected_usage:%s" % expected_usage_percent)
         
-        send_telegram_message(f"🗑️ Pulizia automatica completata:\n"
-                            f"• {deleted_count} file eliminati\n"
-                            f"• {bytes_freed / (1024**3):.1f} GB liberati\n"
-                            f"• Utilizzo: {current_usage_percent:.1f}% → {final_usage_percent:.1f}%")
+        send_telegram_message(f"🗑️ Pulizia automatica avviata:\n"
+                            f"• {deleted_count} file in coda di eliminazione\n"
+                            f"• {bytes_freed / (1024**3):.1f} GB da liberare\n"
+                            f"• Utilizzo: {current_usage_percent:.1f}% → {expected_usage_percent:.1f}% previsto")
         
         return deleted_count
         
@@ -468,31 +1111,26 @@ def delete_oldest_files(path, files_to_delete=6):
         logging.error(f"⚠️ Percorso non valido o inesistente: {path}")
         return 0
 
-    files = list(Path(path).glob("*.mkv"))
-    if not files:
-        logging.warning("📂 Nessun file .mkv da eliminare nella directory.")
+    if segment_catalog.is_empty():
+        logging.warning("📂 Nessun segmento da eliminare nella directory.")
         return 0
 
-    # Protezione: non eliminare file più recenti di 1 ora
-    current_time = time.time()
-    safe_files = [f for f in files if current_time - f.stat().st_mtime > 3600]
+    # Protezione: non eliminare file terminati da meno di 1 ora
+    safe_files = _safe_oldest_segments(files_to_delete, volume=_root_of(path))
     
     if not safe_files:
         logging.warning("⚠️ Nessun file sicuro da eliminare (tutti i file sono più recenti di 1 ora)")
         return 0
 
-    files.sort(key=lambda f: f.stat().st_mtime)
     deleted_count = 0
     
-    for i in range(min(files_to_delete, len(safe_files))):
-        oldest = safe_files[i]
+    for oldest in safe_files:
         try:
-            file_size = oldest.stat().st_size
-            oldest.unlink()
+            file_size = _delete_segment(oldest)
             deleted_count += 1
-            logging.info(f"🗑️ Eliminato: {oldest.name} ({file_size / (1024**2):.1f} MB)")
+            logging.info(f"🗑️ In coda di eliminazione: {os.path.basename(oldest['path'])} ({file_size / (1024**2):.1f} MB)")
         except Exception as e:
-            logging.error(f"❌ Errore nell'eliminazione del file {oldest}: {e}")
+            logging.error(f"❌ Errore nell'eliminazione del file {oldest['path']}: {e}")
     
     return deleted_count
 
@@ -523,9 +1161,10 @@ def system_health_check():
                 logging.critical(f"🔥 Disco quasi pieno: {disk_percent_manual:.1f}%")
                 send_telegram_message(f"🔥 CRITICO: Disco quasi pieno: {disk_percent_manual:.1f}%")
             
-            # Verifica processi orfani ffmpeg
+            # Verifica processi orfani ffmpeg di registrazione (gli ffmpeg ausiliari di
+            # clip, istantanee e analisi del movimento non scrivono liste di segmenti)
             ffmpeg_processes = [p for p in psutil.process_iter(['pid', 'name', 'cmdline']) 
-                              if 'ffmpeg' in p.info['name'].lower()]
+                              if 'ffmpeg' in p.info['name'].lower() and is_recording_command(p.info['cmdline'])]
             
             active_pids = [proc_info["process"].pid for proc_info in processes if proc_info["process"].poll() is None]
             
@@ -549,6 +1188,93 @@ def system_health_check():
 health_thread = threading.Thread(target=system_health_check, daemon=True)
 health_thread.start()
 
+def stall_watchdog():
+    """Rileva in pochi secondi i flussi bloccati tramite il contatore frame di -progress"""
+    while True:
+        time.sleep(STALL_CHECK_INTERVAL)
+        try:
+            with processes_lock:
+                current = list(processes)
+            for proc_info in current:
+                name = proc_info["name"]
+                if proc_info.get("stopping") or proc_info["process"].poll() is not None:
+                    continue
+                stalled, since = progress_monitor.is_stalled(name)
+                if not stalled:
+                    stalled_alerted.discard(name)
+                elif not restart_scheduler.is_pending(name) and ffmpeg_commands:
+                    reason = f"flusso bloccato: nessun nuovo frame da {since:.0f}s"
+                    # Una sola notifica per blocco, e solo se un riavvio è stato davvero pianificato
+                    if schedule_restart(name, ffmpeg_commands, reason=reason) and name not in stalled_alerted:
+                        send_telegram_message(f"⚠️ {name}: {reason}")
+                        stalled_alerted.add(name)
+        except Exception as e:
+            logging.error(f"❌ Errore controllo stallo flussi: {e}")
+
+def _relay_address(url):
+    """(host, porta) del server RTSP di un URL di ritrasmissione"""
+    parts = urlsplit(url)
+    return parts.hostname or "127.0.0.1", parts.port or 554
+
+def _relay_reachable(address):
+    try:
+        with socket.create_connection(address, timeout=1):
+            return True
+    except OSError:
+        return False
+
+def restream_watchdog():
+    """
+    Ricollega la ritrasmissione quando il server RTSP locale torna disponibile.
+
+    Con onfail=ignore l'uscita RTSP del tee resta chiusa dopo un arresto di
+    MediaMTX (anche /stop_rtsp seguito da /start_rtsp): la registrazione
+    prosegue, ma visione remota e buffer eventi sul flusso ritrasmesso no.
+    Al ritorno del server si riavviano solo le telecamere che vi pubblicano.
+    """
+    available = {}  # (host, porta) -> raggiungibile all'ultimo controllo
+    while True:
+        time.sleep(RESTREAM_CHECK_INTERVAL)
+        try:
+            relays = {}
+            for cmd in ffmpeg_commands:
+                if cmd.get("restream_url"):
+                    relays.setdefault(_relay_address(cmd["restream_url"]), []).append(cmd["name"])
+            for address, names in relays.items():
+                reachable = _relay_reachable(address)
+                if reachable and available.get(address) is False:
+                    logging.info(f"📡 Server RTSP {address[0]}:{address[1]} di nuovo disponibile: "
+                                 f"ritrasmissione ricollegata per {', '.join(names)}")
+                    send_telegram_message(f"📡 Server RTSP di nuovo attivo: ritrasmissione ricollegata "
+                                          f"({len(names)} telecamere)")
+                    for name in names:
+                        restart_scheduler.schedule(name, 0, relocate_camera, name)
+                        event_clips.reconnect(name)
+                elif not reachable and available.get(address) is not False:
+                    logging.warning(f"⚠️ Server RTSP {address[0]}:{address[1]} non raggiungibile: "
+                                    f"ritrasmissione sospesa, la registrazione continua")
+                available[address] = reachable
+        except Exception as e:
+            logging.error(f"❌ Errore controllo server RTSP: {e}")
+
+# Avvia il thread di rilevamento stallo
+stall_thread = threading.Thread(target=stall_watchdog, daemon=True)
+stall_thread.start()
+
+# Avvia il controllo del server RTSP della ritrasmissione
+restream_thread = threading.Thread(target=restream_watchdog, daemon=True)
+restream_thread.start()
+
+# Avvia il ribilanciamento dei volumi del pool
+if len(storage_pool.volumes) > 1:
+    rebalance_thread = threading.Thread(target=storage_rebalancer, daemon=True)
+    rebalance_thread.start()
+
+# Avvia la preparazione periodica delle cartelle per giorno
+if config.STORAGE_LAYOUT == LAYOUT_SHARDED:
+    layout_thread = threading.Thread(target=layout_maintenance, daemon=True)
+    layout_thread.start()
+
 def debug_storage_thresholds():
     """Funzione di debug per verificare le soglie di storage NVR"""
     try:
@@ -617,49 +1343,40 @@ def simple_nvr_cleanup(path, files_to_delete=20):
         logging.info("log:logs.nvr_cleanup_state_before:%s" % usage_percent_before)
         logging.info("log:logs.nvr_cleanup_target_files:%s" % files_to_delete)
         
-        files = list(Path(path).glob("*.mkv"))
-        if not files:
+        if segment_catalog.is_empty():
             logging.warning("log:logs.nvr_cleanup_no_files")
             return 0
         
-        # Protezione: non eliminare file più recenti di 1 ora
-        current_time = time.time()
-        safe_files = [f for f in files if current_time - f.stat().st_mtime > 3600]
+        # Protezione: non eliminare file terminati da meno di 1 ora (già ordinati dal catalogo)
+        safe_files = _safe_oldest_segments(files_to_delete, volume=_root_of(path))
         
         if not safe_files:
             logging.warning("log:logs.nvr_cleanup_no_safe_files")
             send_telegram_message("⚠️ Pulizia NVR: nessun file sicuro da eliminare (tutti recenti)")
             return 0
         
-        # Ordina per data di modifica (più vecchi per primi)
-        safe_files.sort(key=lambda f: f.stat().st_mtime)
-        
         # Elimina i file più vecchi
         deleted_count = 0
         total_size_freed = 0
-        files_to_process = min(files_to_delete, len(safe_files))
         
-        for i in range(files_to_process):
-            file = safe_files[i]
+        for segment in safe_files:
             try:
-                file_size = file.stat().st_size
-                file.unlink()
+                file_size = _delete_segment(segment)
                 total_size_freed += file_size
                 deleted_count += 1
                 
-                logging.info("log:logs.nvr_cleanup_file_deleted:%s:%s" % (file.name, file_size / (1024**2)))
+                logging.info("log:logs.nvr_cleanup_file_scheduled:%s:%s" % (os.path.basename(segment["path"]), file_size / (1024**2)))
                 
             except Exception as e:
-                logging.error(f"❌ Errore eliminazione {file.name}: {e}")
+                logging.error(f"❌ Errore eliminazione {os.path.basename(segment['path'])}: {e}")
         
-        # Verifica finale
-        usage_after = psutil.disk_usage(path)
-        usage_percent_after = (usage_after.used / usage_after.total) * 100
+        # Le eliminazioni sono solo accodate: l'utilizzo finale è quello previsto
+        usage_percent_after = max(usage_before.used - total_size_freed, 0) / usage_before.total * 100
         
-        logging.info("log:logs.nvr_cleanup_summary")
-        logging.info("log:logs.nvr_cleanup_files_deleted:%s:%s" % (deleted_count, files_to_delete))
-        logging.info("log:logs.nvr_cleanup_space_freed:%s" % (total_size_freed / (1024**3)))
-        logging.info("log:logs.nvr_cleanup_usage_change:%s:%s" % (usage_percent_before, usage_percent_after))
+        logging.info("log:logs.nvr_cleanup_scheduled_summary")
+        logging.info("log:logs.nvr_cleanup_files_scheduled:%s:%s" % (deleted_count, files_to_delete))
+        logging.info("log:logs.nvr_cleanup_space_scheduled:%s" % (total_size_freed / (1024**3)))
+        logging.info("log:logs.nvr_cleanup_expected_usage:%s:%s" % (usage_percent_before, usage_percent_after))
         
         return deleted_count
         
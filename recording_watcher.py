@@ -0,0 +1,214 @@
+"""
+Tracciamento dell'attività di registrazione tramite inotify.
+
+Un thread riceve dal kernel gli eventi IN_CREATE / IN_MODIFY / IN_CLOSE_WRITE
+della cartella delle registrazioni e mantiene in memoria, per telecamera,
+l'ultimo istante di scrittura e i byte scritti. Il controllo di attività
+diventa una lettura O(1) invece di una scansione dei file.
+"""
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import struct
+import threading
+import time
+
+from segment_catalog import parse_segment_name
+
+# Costanti inotify (linux/inotify.h)
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+_EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+
+# Intervallo minimo tra due stat() dello stesso segmento su IN_MODIFY
+SIZE_REFRESH_INTERVAL = 1.0
+
+
+class RecordingActivityTracker:
+    """Ultima scrittura e byte scritti per telecamera, aggiornati da inotify."""
+
+    def __init__(self, directory):
+        """
+        Args:
+            directory (str): Cartella delle registrazioni da osservare
+        """
+        self.directory = directory
+        self.available = False
+        self._fd = None
+        self._libc = None
+        self._watches = {}  # wd -> cartella
+        self._state = {}
+        self._segment_listeners = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Avvia il thread di osservazione.
+
+        Returns:
+            bool: False se inotify non è disponibile (il chiamante usa il fallback)
+        """
+        try:
+            libc_name = ctypes.util.find_library("c")
+            self._libc = ctypes.CDLL(libc_name, use_errno=True)
+            fd = self._libc.inotify_init1(IN_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+            self._fd = fd
+            self.add_watch(self.directory)
+        except (OSError, AttributeError) as e:
+            logging.warning(f"⚠️ inotify non disponibile, uso il controllo tramite catalogo: {e}")
+            return False
+
+        self.available = True
+        threading.Thread(target=self._read_loop, name="recording-watcher", daemon=True).start()
+        logging.info(f"👁️ Osservazione attività registrazioni avviata su {self.directory}")
+        return True
+
+    def add_segment_listener(self, callback):
+        """Registra una funzione chiamata con (telecamera, percorso) alla creazione di ogni nuovo segmento"""
+        self._segment_listeners.append(callback)
+
+    def add_watch(self, directory):
+        """Aggiunge una cartella all'osservazione (nessun effetto se già osservata)"""
+        for wd, watched in self._watches.items():
+            if watched == directory:
+                return wd
+        mask = IN_CREATE | IN_MODIFY | IN_CLOSE_WRITE
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f"inotify_add_watch {directory}: {os.strerror(errno)}")
+        self._watches[wd] = directory
+        return wd
+
+    def watch_only(self, directories):
+        """
+        Osserva la cartella principale più `directories` e smette di osservare
+        le altre (es. le cartelle dei giorni passati nel layout per giorno).
+        """
+        if not self.available:
+            return
+        keep = set(directories) | {self.directory}
+        for wd, watched in list(self._watches.items()):
+            if watched not in keep:
+                self._libc.inotify_rm_watch(self._fd, wd)
+                self._watches.pop(wd, None)
+        for directory in keep:
+            try:
+                self.add_watch(directory)
+            except OSError as e:
+                logging.warning(f"⚠️ Impossibile osservare {directory}: {e}")
+
+    def _read_loop(self):
+        """Legge e smista gli eventi inotify"""
+        while True:
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except InterruptedError:
+                continue
+            except OSError as e:
+                logging.error(f"❌ Errore lettura eventi inotify: {e}")
+                time.sleep(1)
+                continue
+
+            offset = 0
+            while offset + _EVENT_HEADER.size <= len(data):
+                wd, mask, _cookie, length = _EVENT_HEADER.unpack_from(data, offset)
+                raw_name = data[offset + _EVENT_HEADER.size:offset + _EVENT_HEADER.size + length]
+                offset += _EVENT_HEADER.size + length
+                name = raw_name.rstrip(b"\0").decode("utf-8", errors="replace")
+
+                if mask & IN_Q_OVERFLOW:
+                    logging.warning("⚠️ Coda eventi inotify piena: alcuni eventi sono stati persi")
+                    continue
+                if not name or mask & IN_ISDIR:
+                    continue
+                self._handle_event(self._watches.get(wd, self.directory), name, mask)
+
+    def _handle_event(self, directory, name, mask):
+        """Aggiorna lo stato della telecamera a cui appartiene il file"""
+        camera, _ = parse_segment_name(name)
+        if camera is None:
+            return
+
+        now = time.time()
+        path = os.path.join(directory, name)
+        with self._lock:
+            state = self._state.setdefault(camera, {
+                "last_write": now,
+                "segment": path,
+                "segment_bytes": 0,
+                "closed_bytes": 0,
+                "size_checked_at": 0.0,
+            })
+            state["last_write"] = now
+
+            if mask & IN_CREATE or state["segment"] != path:
+                state["segment"] = path
+                state["segment_bytes"] = 0
+                state["size_checked_at"] = 0.0
+
+            refresh = mask & IN_CLOSE_WRITE or now - state["size_checked_at"] >= SIZE_REFRESH_INTERVAL
+            if refresh:
+                state["size_checked_at"] = now
+
+        if mask & IN_CREATE:
+            for listener in self._segment_listeners:
+                try:
+                    listener(camera, path)
+                except Exception as e:
+                    logging.error(f"❌ Errore notifica nuovo segmento {camera}: {e}")
+
+        if not refresh:
+            return
+        try:
+            size = os.stat(path).st_size
+        except FileNotFoundError:
+            return
+        with self._lock:
+            if state["segment"] != path:
+                return
+            if mask & IN_CLOSE_WRITE:
+                state["closed_bytes"] += size
+                state["segment_bytes"] = 0
+            else:
+                state["segment_bytes"] = size
+
+    def get(self, camera):
+        """
+        Restituisce lo stato di scrittura della telecamera.
+
+        Returns:
+            dict: last_write, segment, segment_bytes, bytes_written (o None)
+        """
+        with self._lock:
+            state = self._state.get(camera)
+            if not state:
+                return None
+            return {
+                "last_write": state["last_write"],
+                "segment": state["segment"],
+                "segment_bytes": state["segment_bytes"],
+                "bytes_written": state["closed_bytes"] + state["segment_bytes"],
+            }
+
+    def is_active(self, camera, timeout):
+        """
+        Indica se la telecamera ha scritto negli ultimi `timeout` secondi.
+
+        Returns:
+            bool | None: None se inotify non è disponibile
+        """
+        if not self.available:
+            return None
+        with self._lock:
+            state = self._state.get(camera)
+            return bool(state) and state["last_write"] >= time.time() - timeout
@@ -0,0 +1,103 @@
+"""
+Scheduler dei riavvii per il sistema NVR.
+
+Mantiene una coda temporizzata (min-heap di scadenze) gestita da un singolo
+thread. Ogni azione in scadenza viene eseguita in un thread dedicato, così
+il backoff di una telecamera è solo una scadenza e un riavvio lento non
+blocca la supervisione delle altre telecamere.
+"""
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+
+class RestartScheduler:
+    """Coda di azioni temporizzate con al massimo un'azione per chiave."""
+
+    def __init__(self, name="restart-scheduler"):
+        """
+        Inizializza lo scheduler e avvia il thread di dispatch.
+
+        Args:
+            name (str): Nome del thread di dispatch
+        """
+        self._heap = []  # (scadenza, sequenza, chiave)
+        self._jobs = {}  # chiave -> (scadenza, sequenza, callback, argomenti)
+        self._running = set()  # chiavi con un'azione in esecuzione
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._dispatch_loop, name=name, daemon=True)
+        self._thread.start()
+
+    def schedule(self, key, delay, callback, *args):
+        """
+        Pianifica `callback(*args)` tra `delay` secondi.
+
+        Se per la chiave esiste già un'azione pianificata o in esecuzione,
+        la nuova richiesta viene ignorata.
+
+        Returns:
+            bool: True se l'azione è stata pianificata
+        """
+        with self._cond:
+            if key in self._jobs or key in self._running:
+                return False
+            deadline = time.monotonic() + max(0, delay)
+            seq = next(self._counter)
+            self._jobs[key] = (deadline, seq, callback, args)
+            heapq.heappush(self._heap, (deadline, seq, key))
+            self._cond.notify()
+            return True
+
+    def cancel(self, key):
+        """Annulla l'azione pianificata per la chiave (se presente)"""
+        with self._cond:
+            return self._jobs.pop(key, None) is not None
+
+    def is_pending(self, key):
+        """Indica se per la chiave c'è un'azione pianificata o in esecuzione"""
+        with self._cond:
+            return key in self._jobs or key in self._running
+
+    def pending(self):
+        """Restituisce i secondi mancanti per ogni azione pianificata"""
+        now = time.monotonic()
+        with self._cond:
+            return {key: max(0.0, job[0] - now) for key, job in self._jobs.items()}
+
+    def _dispatch_loop(self):
+        """Attende la prossima scadenza e avvia le azioni dovute"""
+        while True:
+            with self._cond:
+                while True:
+                    # Scarta le voci annullate o sostituite
+                    while self._heap and self._jobs.get(self._heap[0][2], (None, None))[1] != self._heap[0][1]:
+                        heapq.heappop(self._heap)
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    timeout = self._heap[0][0] - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    self._cond.wait(timeout)
+
+                _, _, key = heapq.heappop(self._heap)
+                _, _, callback, args = self._jobs.pop(key)
+                self._running.add(key)
+
+            worker = threading.Thread(target=self._execute, args=(key, callback, args),
+                                      name=f"restart-{key}", daemon=True)
+            worker.start()
+
+    def _execute(self, key, callback, args):
+        """Esegue un'azione e libera la chiave al termine"""
+        try:
+            callback(*args)
+        except Exception as e:
+            logging.error(f"❌ Errore nell'azione pianificata {key}: {e}")
+        finally:
+            with self._cond:
+                self._running.discard(key)
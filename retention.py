@@ -0,0 +1,300 @@
+"""
+Motore di conservazione delle registrazioni.
+
+Sceglie i segmenti da eliminare senza scansionare la cartella: per ogni
+telecamera legge i segmenti più vecchi dall'indice ordinato del catalogo e
+mantiene le teste delle telecamere in un min-heap. La prossima vittima si
+ottiene in O(log n). Politiche applicate, in ordine:
+
+1. età massima per telecamera (max_retention_days), estesa fino a
+   event_retention_days per i segmenti con movimento;
+2. quota in byte per telecamera (quota_bytes);
+3. soglia globale: oltre la soglia alta si elimina fino alla soglia bassa,
+   prima i segmenti senza movimento più vecchi di idle_retention_days, poi
+   gli altri in ordine di età, per ultimi quelli con movimento ancora entro
+   event_retention_days.
+
+L'attività di un segmento viene dalla timeline del rilevamento movimento;
+i segmenti mai analizzati (telecamere senza rilevamento) non sono né
+inattivi né con eventi e seguono il solo ordine di età.
+
+Un segmento non viene mai eliminato se è più recente dell'età minima della
+sua telecamera (min_retention_days) o se è terminato da meno di `safe_age`.
+I segmenti già in coda di eliminazione si passano in `exclude` e contano
+come già liberati.
+"""
+
+import heapq
+import logging
+import time
+
+import psutil
+
+DAY = 86400
+
+# Segmenti letti dal catalogo per ogni richiesta di una telecamera
+_PAGE_SIZE = 64
+
+
+class _CameraCursor:
+    """Scorre in ordine di inizio i segmenti di una telecamera, a pagine."""
+
+    def __init__(self, catalog, camera, ended_before, directory=None):
+        self.catalog = catalog
+        self.camera = camera
+        self.ended_before = ended_before
+        self.directory = directory
+        self._buffer = []
+        self._last_key = None
+        self._exhausted = False
+
+    def peek(self):
+        """Restituisce il prossimo segmento senza consumarlo (None se finiti)"""
+        if not self._buffer and not self._exhausted:
+            page = self.catalog.oldest_segments(limit=_PAGE_SIZE, camera=self.camera,
+                                                ended_before=self.ended_before,
+                                                started_after=self._last_key,
+                                                directory=self.directory)
+            if len(page) < _PAGE_SIZE:
+                self._exhausted = True
+            if page:
+                self._last_key = (page[-1]["start_ts"], page[-1]["id"])
+            self._buffer = page[::-1]
+        return self._buffer[-1] if self._buffer else None
+
+    def pop(self):
+        segment = self.peek()
+        if segment is not None:
+            self._buffer.pop()
+        return segment
+
+
+class RetentionEngine:
+    """Selezione delle vittime per età, quota per telecamera e soglie globali."""
+
+    def __init__(self, catalog, accountant, directory, policies=None, default_policy=None,
+                 high_watermark=94.0, low_watermark=92.0, safe_age=3600, volume_only=False, activity=None):
+        """
+        Args:
+            catalog (SegmentCatalog): Catalogo dei segmenti
+            accountant (StorageAccountant): Totali per telecamera
+            directory (str): Cartella delle registrazioni (per l'utilizzo disco)
+            policies (dict): telecamera -> {quota_bytes, min_retention_days, max_retention_days}
+            default_policy (dict): Politica per le telecamere non configurate
+            high_watermark (float): Percentuale disco oltre la quale si pulisce
+            low_watermark (float): Percentuale disco da raggiungere con la pulizia
+            safe_age (int): Secondi dalla fine sotto i quali un segmento è protetto
+            volume_only (bool): Considera solo i segmenti sotto `directory` (un volume del pool)
+            activity (callable): (segmento, days) -> True (movimento), False (inattivo), None (non
+                analizzato); `days` è una cache dei giorni di timeline letti, valida per una sola pulizia
+        """
+        self.catalog = catalog
+        self.accountant = accountant
+        self.directory = directory
+        self.policies = policies or {}
+        self.default_policy = default_policy or {"quota_bytes": 0, "min_retention_days": 0, "max_retention_days": 0}
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.safe_age = safe_age
+        self.volume_only = volume_only
+        self.activity = activity or (lambda segment, days=None: None)
+
+    def policy(self, camera):
+        """Restituisce la politica di conservazione di una telecamera"""
+        return self.policies.get(camera, self.default_policy)
+
+    def _protected_after(self, camera, now):
+        """Inizio oltre il quale i segmenti della telecamera sono protetti"""
+        min_days = self.policy(camera).get("min_retention_days") or 0
+        return now - min_days * DAY
+
+    def _event_kept_until(self, camera, now):
+        """Inizio oltre il quale i segmenti con movimento restano fino all'età estesa (None = nessuna estensione)"""
+        event_days = self.policy(camera).get("event_retention_days") or 0
+        return now - event_days * DAY if event_days else None
+
+    def _tiers(self, camera, now, activity):
+        """
+        Passaggi della pulizia per soglia, in ordine di eliminazione:
+        inattivi oltre idle_retention_days, ordinari, con movimento recente.
+
+        Returns:
+            list: 3 voci (motivo, filtro segmento -> bool o None, inizio da cui il
+            passaggio si ferma o None) oppure None se il passaggio non riguarda la telecamera
+        """
+        policy = self.policy(camera)
+        idle_days = policy.get("idle_retention_days") or 0
+        event_after = self._event_kept_until(camera, now)
+        idle = None
+        if idle_days:
+            # I cursori sono in ordine di inizio: oltre idle_before non ci sono più inattivi da cercare
+            idle_before = now - idle_days * DAY
+            idle = ("inattivo", lambda s: activity(s) is False, idle_before)
+        if event_after is None:
+            return [idle, ("soglia disco", None, None), None]
+        return [idle,
+                ("soglia disco", lambda s: not (s["start_ts"] >= event_after and activity(s)), None),
+                ("soglia disco (evento)", None, None)]
+
+    def _cursor(self, camera, now):
+        return _CameraCursor(self.catalog, camera, ended_before=now - self.safe_age,
+                             directory=self.directory if self.volume_only else None)
+
+    def disk_usage_percent(self):
+        usage = psutil.disk_usage(self.directory)
+        return (usage.used / usage.total) * 100, usage
+
+    def policy_victims(self, now=None, exclude=()):
+        """
+        Segmenti oltre l'età massima o oltre la quota della loro telecamera.
+
+        Returns:
+            list: (segmento, motivo) in ordine di eliminazione
+        """
+        now = now or time.time()
+        excluded = set(exclude)
+        days = {}  # Giorni di timeline già letti
+        victims = []
+        for camera, totals in self.accountant.per_camera().items():
+            policy = self.policy(camera)
+            max_days = policy.get("max_retention_days") or 0
+            quota = policy.get("quota_bytes") or 0
+            if not max_days and not (quota and totals["bytes"] > quota):
+                continue
+
+            protected_after = self._protected_after(camera, now)
+            expire_before = now - max_days * DAY if max_days else None
+            event_after = self._event_kept_until(camera, now) if max_days else None
+            remaining = totals["bytes"]
+            cursor = self._cursor(camera, now)
+
+            while True:
+                segment = cursor.peek()
+                if segment is None or segment["start_ts"] >= protected_after:
+                    break
+                if expire_before is not None and segment["start_ts"] < expire_before:
+                    if event_after is not None and segment["start_ts"] >= event_after and \
+                            self.activity(segment, days):
+                        # Con movimento: resta fino all'età estesa (salvo quota superata)
+                        if not (quota and remaining > quota):
+                            cursor.pop()
+                            continue
+                        reason = "quota telecamera"
+                    else:
+                        reason = "età massima"
+                elif quota and remaining > quota:
+                    reason = "quota telecamera"
+                else:
+                    break
+                cursor.pop()
+                remaining -= segment["size"]
+                if segment["path"] not in excluded:
+                    victims.append((segment, reason))
+        return victims
+
+    def watermark_victims(self, bytes_to_free, now=None, exclude=()):
+        """
+        Segmenti globalmente più vecchi fino a liberare `bytes_to_free`,
+        prima gli inattivi e per ultimi quelli con movimento recente.
+
+        Le teste di ogni telecamera stanno in un min-heap: ogni estrazione
+        costa O(log telecamere) più una lettura indicizzata del catalogo.
+
+        Returns:
+            list: (segmento, motivo) in ordine di eliminazione
+        """
+        now = now or time.time()
+        excluded = set(exclude)
+        cameras = list(self.accountant.per_camera())
+        days = {}  # Giorni di timeline letti una sola volta per tutti i passaggi
+        tiers = {camera: self._tiers(camera, now, lambda s: self.activity(s, days)) for camera in cameras}
+
+        victims = []
+        freed = 0
+        # Un passaggio per livello (inattivi, ordinari, con movimento): ognuno
+        # è una fusione per età delle telecamere, con un cursore nuovo
+        for level in range(3):
+            heap = []
+            cursors = {}
+            for camera in cameras:
+                if tiers[camera][level] is None:
+                    continue
+                reason, accept, until = tiers[camera][level]
+                cursor = self._cursor(camera, now)
+                cursors[camera] = (cursor, reason, accept, until)
+                self._push_head(heap, cursor, excluded, now, accept, until)
+
+            while heap and freed < bytes_to_free:
+                _, _, camera = heapq.heappop(heap)
+                cursor, reason, accept, until = cursors[camera]
+                segment = cursor.pop()
+                victims.append((segment, reason))
+                excluded.add(segment["path"])
+                freed += segment["size"]
+                self._push_head(heap, cursor, excluded, now, accept, until)
+            if freed >= bytes_to_free:
+                break
+        return victims
+
+    def _push_head(self, heap, cursor, excluded, now, accept=None, until=None):
+        """Inserisce nel heap la prossima vittima ammissibile della telecamera (con inizio prima di `until`)"""
+        limit = self._protected_after(cursor.camera, now)
+        if until is not None:
+            limit = min(limit, until)
+        while True:
+            segment = cursor.peek()
+            if segment is None or segment["start_ts"] >= limit:
+                return
+            if segment["path"] in excluded or (accept is not None and not accept(segment)):
+                cursor.pop()
+                continue
+            heapq.heappush(heap, (segment["start_ts"], segment["id"], cursor.camera))
+            return
+
+    def plan(self, target_usage_percent=None, now=None, exclude=(), pending_bytes=0):
+        """
+        Calcola l'elenco completo delle vittime secondo tutte le politiche.
+
+        Args:
+            target_usage_percent (float): Soglia da raggiungere (default: soglia bassa),
+                applicata solo se l'utilizzo supera la soglia alta o il target stesso
+            exclude (iterable): Percorsi già in coda di eliminazione
+            pending_bytes (int): Byte che la coda di eliminazione libererà
+
+        Returns:
+            list: (segmento, motivo) in ordine di eliminazione
+        """
+        now = now or time.time()
+        excluded = set(exclude)
+        victims = self.policy_victims(now, exclude=excluded)
+
+        usage_percent, usage = self.disk_usage_percent()
+        target = self.low_watermark if target_usage_percent is None else target_usage_percent
+        trigger = self.high_watermark if target_usage_percent is None else target_usage_percent
+        if usage_percent > trigger:
+            freed_by_policy = sum(segment["size"] for segment, _ in victims)
+            bytes_to_free = usage.used - (target / 100) * usage.total - freed_by_policy - pending_bytes
+            if bytes_to_free > 0:
+                excluded.update(segment["path"] for segment, _ in victims)
+                victims += self.watermark_victims(bytes_to_free, now, exclude=excluded)
+        return victims
+
+    def run(self, delete, target_usage_percent=None):
+        """
+        Applica le politiche eliminando le vittime con la funzione `delete`.
+
+        Args:
+            delete (callable): Riceve il segmento, restituisce i byte liberati (o accodati)
+
+        Returns:
+            dict: deleted, bytes_freed, reasons (conteggio per motivo)
+        """
+        result = {"deleted": 0, "bytes_freed": 0, "reasons": {}}
+        for segment, reason in self.plan(target_usage_percent):
+            try:
+                result["bytes_freed"] += delete(segment)
+                result["deleted"] += 1
+                result["reasons"][reason] = result["reasons"].get(reason, 0) + 1
+            except Exception as e:
+                logging.error(f"❌ Errore eliminazione {segment['path']}: {e}")
+        return result
@@ -126,7 +126,7 @@ def migrate_config_to_encrypted(config_file):
     
     # Cifra le password delle telecamere
     for section in config.sections():
-        if section.lower() not in ['logging', 'telegram', 'storage']:
+        if section.lower() not in ['logging', 'telegram', 'storage', 'language', 'motion', 'restream', 'http', 'hls', 'thumbnails']:
             if config.has_option(section, 'password'):
                 password = config.get(section, 'password')
                 if not password.startswith('ENC:'):  # Se non è già cifrata
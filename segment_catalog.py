@@ -0,0 +1,540 @@
+"""
+Catalogo persistente dei segmenti registrati (SQLite).
+
+Ogni segmento chiuso da ffmpeg viene annunciato nella sua lista CSV
+(-segment_list) e registrato qui con telecamera, inizio, fine, dimensione e
+percorso. Pulizia, statistiche e controlli di attività interrogano il
+catalogo tramite indici invece di scansionare la cartella delle registrazioni.
+Al primo avvio (o per riconciliazione) il catalogo può essere ricostruito
+con una sola scansione del disco.
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+from ffmpeg_command import segment_extensions
+
+# Nome del database nella cartella delle registrazioni
+CATALOG_FILENAME = ".nvr_catalog.db"
+
+# Cartella (nella cartella registrazioni) con le liste CSV scritte da ffmpeg
+SEGMENT_LIST_DIRNAME = ".segments"
+
+# Estensioni dei file di registrazione riconosciute (mkv, mp4 frammentato, mpegts)
+SEGMENT_EXTENSIONS = segment_extensions()
+
+# Formato del timestamp nel nome dei segmenti ({camera}_%Y%m%dT%H%M%S.{estensione})
+SEGMENT_TIME_FORMAT = "%Y%m%dT%H%M%S"
+
+# Durata massima ammessa di un segmento (per le ricerche per intervallo)
+MAX_SEGMENT_SPAN = 2 * 3600
+
+# Frequenza di lettura delle liste dei segmenti
+FEED_POLL_INTERVAL = 2
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS segments (
+    id INTEGER PRIMARY KEY,
+    camera TEXT NOT NULL,
+    path TEXT NOT NULL UNIQUE,
+    start_ts REAL NOT NULL,
+    end_ts REAL NOT NULL,
+    size INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL DEFAULT 0  -- ultima scrittura da feed o spostamento (0 = scansione del disco)
+);
+CREATE INDEX IF NOT EXISTS idx_segments_start ON segments(start_ts);
+CREATE INDEX IF NOT EXISTS idx_segments_end ON segments(end_ts);
+CREATE INDEX IF NOT EXISTS idx_segments_camera_start ON segments(camera, start_ts);
+
+-- Totali per telecamera mantenuti dai trigger a ogni chiusura/eliminazione di segmento
+CREATE TABLE IF NOT EXISTS camera_totals (
+    camera TEXT PRIMARY KEY,
+    files INTEGER NOT NULL DEFAULT 0,
+    bytes INTEGER NOT NULL DEFAULT 0,
+    oldest_ts REAL,
+    oldest_path TEXT,
+    newest_ts REAL,
+    newest_path TEXT
+);
+
+CREATE TRIGGER IF NOT EXISTS segments_totals_insert AFTER INSERT ON segments BEGIN
+    INSERT OR IGNORE INTO camera_totals (camera) VALUES (NEW.camera);
+    UPDATE camera_totals SET
+        files = files + 1,
+        bytes = bytes + NEW.size,
+        oldest_path = CASE WHEN oldest_ts IS NULL OR NEW.start_ts < oldest_ts THEN NEW.path ELSE oldest_path END,
+        oldest_ts = CASE WHEN oldest_ts IS NULL OR NEW.start_ts < oldest_ts THEN NEW.start_ts ELSE oldest_ts END,
+        newest_path = CASE WHEN newest_ts IS NULL OR NEW.start_ts >= newest_ts THEN NEW.path ELSE newest_path END,
+        newest_ts = CASE WHEN newest_ts IS NULL OR NEW.start_ts >= newest_ts THEN NEW.start_ts ELSE newest_ts END
+    WHERE camera = NEW.camera;
+END;
+
+CREATE TRIGGER IF NOT EXISTS segments_totals_update AFTER UPDATE OF size ON segments BEGIN
+    UPDATE camera_totals SET bytes = bytes + NEW.size - OLD.size WHERE camera = NEW.camera;
+END;
+
+CREATE TRIGGER IF NOT EXISTS segments_totals_path AFTER UPDATE OF path ON segments BEGIN
+    UPDATE camera_totals SET oldest_path = NEW.path WHERE camera = NEW.camera AND oldest_path = OLD.path;
+    UPDATE camera_totals SET newest_path = NEW.path WHERE camera = NEW.camera AND newest_path = OLD.path;
+END;
+
+CREATE TRIGGER IF NOT EXISTS segments_totals_delete AFTER DELETE ON segments BEGIN
+    UPDATE camera_totals SET files = files - 1, bytes = bytes - OLD.size WHERE camera = OLD.camera;
+    UPDATE camera_totals SET
+        oldest_ts = (SELECT start_ts FROM segments WHERE camera = OLD.camera ORDER BY start_ts LIMIT 1),
+        oldest_path = (SELECT path FROM segments WHERE camera = OLD.camera ORDER BY start_ts LIMIT 1)
+    WHERE camera = OLD.camera AND oldest_path = OLD.path;
+    UPDATE camera_totals SET
+        newest_ts = (SELECT start_ts FROM segments WHERE camera = OLD.camera ORDER BY start_ts DESC LIMIT 1),
+        newest_path = (SELECT path FROM segments WHERE camera = OLD.camera ORDER BY start_ts DESC LIMIT 1)
+    WHERE camera = OLD.camera AND newest_path = OLD.path;
+    DELETE FROM camera_totals WHERE camera = OLD.camera AND files <= 0;
+END;
+"""
+
+
+def parse_segment_name(filename):
+    """
+    Estrae telecamera e inizio dal nome di un segmento.
+
+    Args:
+        filename (str): Nome file, es. 'Ingresso_20250101T120000.mkv'
+
+    Returns:
+        tuple: (telecamera, timestamp inizio) oppure (None, None)
+    """
+    stem, ext = os.path.splitext(os.path.basename(filename))
+    if ext.lower() not in SEGMENT_EXTENSIONS or "_" not in stem:
+        return None, None
+    camera, stamp = stem.rsplit("_", 1)
+    try:
+        start = datetime.strptime(stamp, SEGMENT_TIME_FORMAT).timestamp()
+    except ValueError:
+        return None, None
+    return camera, start
+
+
+class SegmentCatalog:
+    """Indice persistente dei segmenti su SQLite, condivisibile tra processi."""
+
+    def __init__(self, db_path):
+        """
+        Apre (o crea) il catalogo.
+
+        Args:
+            db_path (str): Percorso del database SQLite
+        """
+        self.db_path = db_path
+        self._lock = threading.RLock()
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock:
+            # WAL: il bot Telegram legge mentre l'NVR scrive
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(_SCHEMA)
+            # Cataloghi creati prima di updated_at
+            columns = [row["name"] for row in self._conn.execute("PRAGMA table_info(segments)")]
+            if "updated_at" not in columns:
+                self._conn.execute("ALTER TABLE segments ADD COLUMN updated_at REAL NOT NULL DEFAULT 0")
+            # Cataloghi creati prima dei totali: inizializzali una volta
+            if not self._conn.execute("SELECT 1 FROM camera_totals LIMIT 1").fetchone() and \
+                    self._conn.execute("SELECT 1 FROM segments LIMIT 1").fetchone():
+                self.recompute_totals()
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params)
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return [dict(row) for row in self._conn.execute(sql, params).fetchall()]
+
+    # --- Scrittura ---
+
+    def add_segment(self, camera, path, start_ts, end_ts, size):
+        """Registra (o aggiorna) un segmento"""
+        self._execute(
+            "INSERT INTO segments (camera, path, start_ts, end_ts, size, updated_at) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(path) DO UPDATE SET end_ts = excluded.end_ts, size = excluded.size, "
+            "updated_at = excluded.updated_at",
+            (camera, path, start_ts, end_ts, size, time.time()),
+        )
+
+    def remove_segment(self, path):
+        """Rimuove un segmento dal catalogo"""
+        self._execute("DELETE FROM segments WHERE path = ?", (path,))
+
+    def move_segment(self, old_path, new_path, register_missing=False):
+        """
+        Aggiorna il percorso di un segmento spostato.
+
+        Senza la voce di partenza (segmento eliminato durante lo spostamento)
+        non fa nulla, a meno di `register_missing`: in quel caso registra il
+        file come segmento non ancora catalogato.
+
+        Returns:
+            bool: True se il catalogo è stato aggiornato
+        """
+        if self._execute("UPDATE segments SET path = ?, updated_at = ? WHERE path = ?",
+                         (new_path, time.time(), old_path)).rowcount:
+            return True
+        camera, start_ts = parse_segment_name(os.path.basename(new_path))
+        if not register_missing or camera is None:
+            return False
+        st = os.stat(new_path)
+        self.add_segment(camera, new_path, start_ts, max(st.st_mtime, start_ts), st.st_size)
+        return True
+
+    def remove_segments(self, paths):
+        """Rimuove più segmenti in un'unica transazione"""
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany("DELETE FROM segments WHERE path = ?", [(p,) for p in paths])
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    # --- Lettura ---
+
+    @staticmethod
+    def _prefix_range(directory):
+        """Intervallo [inizio, fine) dei percorsi sotto `directory` (usa l'indice su path)"""
+        prefix = directory.rstrip(os.sep) + os.sep
+        return prefix, prefix[:-1] + chr(ord(os.sep) + 1)
+
+    def oldest_segments(self, limit=100, ended_before=None, camera=None, started_after=None, directory=None):
+        """
+        Restituisce i segmenti più vecchi in ordine di inizio.
+
+        Args:
+            limit (int): Numero massimo di segmenti
+            ended_before (float): Solo segmenti terminati prima di questo timestamp
+            camera (str): Filtra per telecamera
+            started_after (tuple): (start_ts, id) dell'ultimo segmento già letto, per paginare
+            directory (str): Solo segmenti sotto questa cartella (volume)
+        """
+        clauses, params = [], []
+        if directory is not None:
+            clauses.append("path >= ? AND path < ?")
+            params.extend(self._prefix_range(directory))
+        if started_after is not None:
+            clauses.append("(start_ts, id) > (?, ?)")
+            params.extend(started_after)
+        if ended_before is not None:
+            clauses.append("end_ts < ?")
+            params.append(ended_before)
+        if camera is not None:
+            clauses.append("camera = ?")
+            params.append(camera)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        params.append(limit)
+        return self._query(f"SELECT * FROM segments {where} ORDER BY start_ts, id LIMIT ?", params)
+
+    def latest_segment(self, camera=None):
+        """Restituisce il segmento più recente (globale o per telecamera)"""
+        if camera is None:
+            rows = self._query("SELECT * FROM segments ORDER BY start_ts DESC LIMIT 1")
+        else:
+            rows = self._query("SELECT * FROM segments WHERE camera = ? ORDER BY start_ts DESC LIMIT 1", (camera,))
+        return rows[0] if rows else None
+
+    def segments_between(self, camera, start_ts, end_ts):
+        """Restituisce i segmenti di una telecamera che coprono l'intervallo dato"""
+        # Il limite inferiore su start_ts mantiene la ricerca un intervallo
+        # dell'indice (camera, start_ts) invece di leggere tutto lo storico
+        return self._query(
+            "SELECT * FROM segments WHERE camera = ? AND start_ts >= ? AND start_ts < ? AND end_ts > ? "
+            "ORDER BY start_ts",
+            (camera, start_ts - MAX_SEGMENT_SPAN, end_ts, start_ts),
+        )
+
+    def segment(self, segment_id):
+        """Restituisce un segmento dato il suo id (None se non presente)"""
+        rows = self._query("SELECT * FROM segments WHERE id = ?", (segment_id,))
+        return rows[0] if rows else None
+
+    def days(self, camera):
+        """Giorni (AAAA-MM-GG, ora locale) con almeno un segmento della telecamera"""
+        # Legge solo l'indice (camera, start_ts), senza accedere alle righe
+        rows = self._query("SELECT DISTINCT date(start_ts, 'unixepoch', 'localtime') AS day FROM segments "
+                           "WHERE camera = ? ORDER BY day", (camera,))
+        return [row["day"] for row in rows]
+
+    def summary(self, camera=None):
+        """
+        Restituisce numero file, byte totali e segmento più vecchio/recente.
+
+        Returns:
+            dict: total_files, total_bytes, oldest, newest (righe o None)
+        """
+        where, params = ("WHERE camera = ?", (camera,)) if camera else ("", ())
+        row = self._query(f"SELECT COUNT(*) AS files, COALESCE(SUM(size), 0) AS bytes FROM segments {where}", params)[0]
+        oldest = self._query(f"SELECT * FROM segments {where} ORDER BY start_ts LIMIT 1", params)
+        return {
+            "total_files": row["files"],
+            "total_bytes": row["bytes"],
+            "oldest": oldest[0] if oldest else None,
+            "newest": self.latest_segment(camera),
+        }
+
+    def directory_totals(self, directory):
+        """
+        Restituisce numero file e byte dei segmenti sotto una cartella (volume).
+
+        Returns:
+            dict: files, bytes
+        """
+        return self._query(
+            "SELECT COUNT(*) AS files, COALESCE(SUM(size), 0) AS bytes FROM segments WHERE path >= ? AND path < ?",
+            self._prefix_range(directory),
+        )[0]
+
+    def byte_rate(self, camera, since):
+        """
+        Byte al secondo registrati da una telecamera a partire da `since`.
+
+        Returns:
+            float | None: None se non ci sono segmenti nell'intervallo
+        """
+        row = self._query(
+            "SELECT SUM(size) AS bytes, SUM(end_ts - start_ts) AS seconds FROM segments "
+            "WHERE camera = ? AND start_ts >= ?",
+            (camera, since),
+        )[0]
+        if not row["seconds"]:
+            return None
+        return row["bytes"] / row["seconds"]
+
+    def totals(self, camera=None):
+        """
+        Restituisce i totali mantenuti dai trigger (costo indipendente dal numero di segmenti).
+
+        Returns:
+            list: Righe di camera_totals (tutte o della telecamera indicata)
+        """
+        if camera is None:
+            return self._query("SELECT * FROM camera_totals ORDER BY camera")
+        return self._query("SELECT * FROM camera_totals WHERE camera = ?", (camera,))
+
+    def recompute_totals(self):
+        """Ricalcola da zero i totali per telecamera a partire dai segmenti"""
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.execute("DELETE FROM camera_totals")
+                self._conn.execute(
+                    "INSERT INTO camera_totals (camera, files, bytes, oldest_ts, newest_ts) "
+                    "SELECT camera, COUNT(*), COALESCE(SUM(size), 0), MIN(start_ts), MAX(start_ts) "
+                    "FROM segments GROUP BY camera"
+                )
+                self._conn.execute(
+                    "UPDATE camera_totals SET "
+                    "oldest_path = (SELECT path FROM segments s WHERE s.camera = camera_totals.camera "
+                    "ORDER BY start_ts LIMIT 1), "
+                    "newest_path = (SELECT path FROM segments s WHERE s.camera = camera_totals.camera "
+                    "ORDER BY start_ts DESC LIMIT 1)"
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def cameras(self):
+        """Elenco delle telecamere presenti nel catalogo"""
+        return [row["camera"] for row in self._query("SELECT DISTINCT camera FROM segments ORDER BY camera")]
+
+    # --- Ricostruzione ---
+
+    def rebuild_from_disk(self, directories):
+        """
+        Sincronizza il catalogo con i file presenti su disco.
+
+        Una sola scansione delle cartelle: aggiunge i segmenti mancanti,
+        aggiorna dimensione/fine e rimuove le voci dei file non più presenti.
+        La scansione avviene mentre si registra: le voci scritte dal feed o
+        da uno spostamento dopo il suo inizio sono più recenti di quanto
+        visto su disco e restano intatte, dimensione e fine non diminuiscono
+        mai e il vecchio percorso di un segmento spostato non viene riaggiunto.
+        Le voci sotto cartelle non disponibili (volume smontato) o non
+        elencate restano intatte.
+
+        Args:
+            directories (str | list): Cartella delle registrazioni o volumi del pool
+
+        Returns:
+            int: Numero di segmenti presenti su disco
+        """
+        if isinstance(directories, str):
+            directories = [directories]
+        started = time.time()
+        found = []
+        scanned = []
+        for directory in directories:
+            if not os.path.isdir(directory):
+                logging.warning(f"⚠️ Cartella non disponibile, voci del catalogo mantenute: {directory}")
+                continue
+            scanned.append(self._prefix_range(directory))
+            for root, dirs, files in os.walk(directory):
+                # Salta cartelle nascoste (liste segmenti, database)
+                dirs[:] = [d for d in dirs if not d.startswith(".")]
+                for filename in files:
+                    camera, start_ts = parse_segment_name(filename)
+                    if camera is None:
+                        continue
+                    path = os.path.join(root, filename)
+                    try:
+                        st = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    found.append((camera, path, start_ts, max(st.st_mtime, start_ts), st.st_size))
+
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.execute("CREATE TEMP TABLE IF NOT EXISTS disk_paths (path TEXT PRIMARY KEY)")
+                self._conn.execute("DELETE FROM disk_paths")
+                self._conn.executemany("INSERT OR IGNORE INTO disk_paths (path) VALUES (?)", [(f[1],) for f in found])
+                self._conn.execute("CREATE TEMP TABLE IF NOT EXISTS scanned_dirs (first TEXT, last TEXT)")
+                self._conn.execute("DELETE FROM scanned_dirs")
+                self._conn.executemany("INSERT INTO scanned_dirs (first, last) VALUES (?, ?)", scanned)
+                self._conn.execute("DELETE FROM segments WHERE path NOT IN (SELECT path FROM disk_paths) "
+                                   "AND updated_at < ? AND EXISTS (SELECT 1 FROM scanned_dirs "
+                                   "WHERE segments.path >= first AND segments.path < last)", (started,))
+                self._conn.executemany(
+                    "INSERT INTO segments (camera, path, start_ts, end_ts, size) SELECT ?, ?, ?, ?, ? "
+                    "WHERE NOT EXISTS (SELECT 1 FROM segments WHERE camera = ? AND start_ts = ? AND path <> ? "
+                    "AND updated_at >= ?) "
+                    "ON CONFLICT(path) DO UPDATE SET end_ts = MAX(end_ts, excluded.end_ts), "
+                    "size = MAX(size, excluded.size) WHERE updated_at < ?",
+                    [f + (f[0], f[2], f[1], started, started) for f in found],
+                )
+                self._conn.execute("DELETE FROM disk_paths")
+                self._conn.execute("DELETE FROM scanned_dirs")
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+        logging.info(f"🗂️ Catalogo segmenti sincronizzato: {len(found)} file in {time.time() - started:.1f}s")
+        return len(found)
+
+    def is_empty(self):
+        """Indica se il catalogo non contiene segmenti"""
+        return not self._query("SELECT 1 FROM segments LIMIT 1")
+
+
+class SegmentListFeed:
+    """
+    Legge le liste CSV dei segmenti scritte da ffmpeg e aggiorna il catalogo.
+
+    ffmpeg aggiunge una riga 'nomefile,inizio,fine' ogni volta che chiude un
+    segmento. Ogni processo scrive su una lista propria, così un riavvio non
+    tronca voci non ancora lette.
+    """
+
+    def __init__(self, catalog, list_dir, poll_interval=FEED_POLL_INTERVAL):
+        """
+        Args:
+            catalog (SegmentCatalog): Catalogo da aggiornare
+            list_dir (str): Cartella delle liste CSV
+            poll_interval (float): Secondi tra due letture
+        """
+        self.catalog = catalog
+        self.list_dir = list_dir
+        self.poll_interval = poll_interval
+        self._watched = {}  # percorso lista -> {"camera", "output", "offset"}
+        self._listeners = []
+        self._lock = threading.Lock()
+        os.makedirs(list_dir, exist_ok=True)
+        self._thread = threading.Thread(target=self._poll_loop, name="segment-list-feed", daemon=True)
+        self._thread.start()
+
+    def new_list_path(self, camera):
+        """Restituisce un percorso di lista univoco per un nuovo processo ffmpeg"""
+        return os.path.join(self.list_dir, f"{camera}.{int(time.time() * 1000)}.csv")
+
+    def watch(self, camera, list_path, output_template):
+        """Inizia a seguire la lista di un processo ffmpeg"""
+        with self._lock:
+            self._watched[list_path] = {"camera": camera, "output": output_template, "offset": 0}
+
+    def finish(self, list_path):
+        """Legge le ultime voci di una lista (processo terminato) e la elimina"""
+        with self._lock:
+            entry = self._watched.pop(list_path, None)
+        if entry:
+            self._read_new_entries(list_path, entry)
+        try:
+            os.remove(list_path)
+        except FileNotFoundError:
+            pass
+
+    def add_listener(self, callback):
+        """Registra una funzione chiamata con la riga del segmento appena chiuso"""
+        self._listeners.append(callback)
+
+    def _poll_loop(self):
+        while True:
+            time.sleep(self.poll_interval)
+            with self._lock:
+                watched = list(self._watched.items())
+            for list_path, entry in watched:
+                try:
+                    self._read_new_entries(list_path, entry)
+                except Exception as e:
+                    logging.error(f"❌ Errore lettura lista segmenti {list_path}: {e}")
+
+    def _read_new_entries(self, list_path, entry):
+        """Legge le righe complete aggiunte dall'ultima lettura"""
+        try:
+            with open(list_path, "rb") as list_file:
+                list_file.seek(entry["offset"])
+                data = list_file.read()
+        except FileNotFoundError:
+            return
+
+        # Considera solo righe complete (terminate da newline)
+        complete = data[:data.rfind(b"\n") + 1]
+        entry["offset"] += len(complete)
+        for line in complete.decode("utf-8", errors="replace").splitlines():
+            self._ingest_line(entry, line)
+
+    def _ingest_line(self, entry, line):
+        """Registra nel catalogo il segmento descritto da una riga CSV"""
+        parts = line.strip().rsplit(",", 2)
+        if len(parts) != 3:
+            return
+        filename, seg_start, seg_end = parts
+        filename = filename.strip('"')
+        camera, start_ts = parse_segment_name(filename)
+        if camera is None:
+            return
+        try:
+            duration = max(0.0, float(seg_end) - float(seg_start))
+        except ValueError:
+            duration = 0.0
+
+        # ffmpeg riporta solo il nome file: la cartella deriva dal modello di output
+        directory = time.strftime(os.path.dirname(entry["output"]), time.localtime(start_ts))
+        path = os.path.join(directory, filename)
+        try:
+            size = os.stat(path).st_size
+        except FileNotFoundError:
+            return
+
+        segment = {"camera": camera, "path": path, "start_ts": start_ts,
+                   "end_ts": start_ts + duration, "size": size}
+        self.catalog.add_segment(**segment)
+        for listener in self._listeners:
+            try:
+                listener(segment)
+            except Exception as e:
+                logging.error(f"❌ Errore notifica segmento chiuso {filename}: {e}")
@@ -0,0 +1,86 @@
+"""
+Contabilità incrementale dello storage delle registrazioni.
+
+I totali per telecamera (byte, numero file, segmento più vecchio e più
+recente) sono aggiornati dai trigger del catalogo a ogni chiusura ed
+eliminazione di segmento. Le richieste di statistiche leggono solo queste
+righe, quindi costano lo stesso a prescindere dalla dimensione dell'archivio.
+Una riconciliazione periodica in background riallinea i totali con il disco.
+"""
+
+import logging
+import threading
+import time
+
+# Intervallo tra due riconciliazioni complete con il disco (6 ore)
+RECONCILE_INTERVAL = 6 * 3600
+
+
+class StorageAccountant:
+    """Totali di utilizzo per telecamera e globali, letti in O(1)."""
+
+    def __init__(self, catalog, directory):
+        """
+        Args:
+            catalog (SegmentCatalog): Catalogo dei segmenti con i totali
+            directory (str | list): Cartella delle registrazioni (o volumi del pool) da riconciliare
+        """
+        self.catalog = catalog
+        self.directory = directory
+        self.last_reconcile = None
+
+    def per_camera(self):
+        """
+        Restituisce l'utilizzo per telecamera.
+
+        Returns:
+            dict: telecamera -> {files, bytes, oldest_ts, oldest_path, newest_ts, newest_path}
+        """
+        return {row.pop("camera"): row for row in self.catalog.totals()}
+
+    def usage(self, camera=None):
+        """
+        Restituisce l'utilizzo di una telecamera o globale.
+
+        Returns:
+            dict: files, bytes, oldest_ts, oldest_path, newest_ts, newest_path
+        """
+        rows = self.catalog.totals(camera)
+        totals = {"files": 0, "bytes": 0, "oldest_ts": None, "oldest_path": None,
+                  "newest_ts": None, "newest_path": None}
+        for row in rows:
+            totals["files"] += row["files"]
+            totals["bytes"] += row["bytes"]
+            if row["oldest_ts"] is not None and (totals["oldest_ts"] is None or row["oldest_ts"] < totals["oldest_ts"]):
+                totals["oldest_ts"], totals["oldest_path"] = row["oldest_ts"], row["oldest_path"]
+            if row["newest_ts"] is not None and (totals["newest_ts"] is None or row["newest_ts"] > totals["newest_ts"]):
+                totals["newest_ts"], totals["newest_path"] = row["newest_ts"], row["newest_path"]
+        return totals
+
+    def reconcile(self):
+        """Riallinea catalogo e totali con i file realmente presenti su disco"""
+        started = time.time()
+        before = self.usage()
+        self.catalog.rebuild_from_disk(self.directory)
+        self.catalog.recompute_totals()
+        after = self.usage()
+        self.last_reconcile = time.time()
+
+        drift = after["bytes"] - before["bytes"]
+        if before["files"] != after["files"] or drift:
+            logging.info(f"📊 Riconciliazione storage: {before['files']} → {after['files']} file, "
+                         f"differenza {drift / (1024**2):.1f} MB ({time.time() - started:.1f}s)")
+
+    def start_reconciler(self, interval=RECONCILE_INTERVAL):
+        """Avvia la riconciliazione periodica in background"""
+        def _loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.reconcile()
+                except Exception as e:
+                    logging.error(f"❌ Errore riconciliazione storage: {e}")
+
+        thread = threading.Thread(target=_loop, name="storage-reconciler", daemon=True)
+        thread.start()
+        return thread
@@ -0,0 +1,193 @@
+"""
+Organizzazione delle registrazioni su disco.
+
+Due layout:
+
+- "flat": tutti i segmenti in un'unica cartella (`{camera}_%Y%m%dT%H%M%S.mkv`);
+- "sharded": una cartella per telecamera e giorno (`{camera}/{YYYY}/{MM}/{DD}/`),
+  così nessuna cartella supera qualche centinaio di file.
+
+Il muxer segment di ffmpeg espande i percorsi con strftime ma non crea le
+cartelle: quelle del giorno corrente e del successivo vengono create in
+anticipo. Il nome del file resta invariato, quindi catalogo e parser non
+dipendono dal layout.
+
+Uso da riga di comando per migrare un archivio esistente mentre l'NVR registra:
+
+    python3 storage_layout.py migrate
+"""
+
+import logging
+import os
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+from segment_catalog import parse_segment_name
+
+LAYOUT_FLAT = "flat"
+LAYOUT_SHARDED = "sharded"
+LAYOUTS = (LAYOUT_FLAT, LAYOUT_SHARDED)
+
+# Età minima dall'ultima modifica perché un file venga spostato dalla migrazione
+MIGRATION_MIN_AGE = 120
+# Pausa tra due spostamenti della migrazione (secondi)
+MIGRATION_PAUSE = 0.02
+
+
+def output_template(directory, camera, layout=LAYOUT_FLAT, extension="mkv"):
+    """Percorso strftime passato a ffmpeg per i segmenti della telecamera"""
+    filename = f"{camera}_%Y%m%dT%H%M%S.{extension}"
+    if layout == LAYOUT_SHARDED:
+        return os.path.join(directory, camera, "%Y", "%m", "%d", filename)
+    return os.path.join(directory, filename)
+
+
+def day_directory(directory, camera, day):
+    """Cartella `{camera}/{YYYY}/{MM}/{DD}` di un giorno"""
+    return os.path.join(directory, camera, f"{day.year:04d}", f"{day.month:02d}", f"{day.day:02d}")
+
+
+def ensure_day_directories(directory, cameras, now=None, days_ahead=1):
+    """
+    Crea le cartelle del giorno corrente e dei successivi `days_ahead` giorni.
+
+    Returns:
+        list: Cartelle garantite (esistenti o appena create)
+    """
+    today = datetime.fromtimestamp(now or time.time()).date()
+    created = []
+    for camera in cameras:
+        for offset in range(days_ahead + 1):
+            path = day_directory(directory, camera, today + timedelta(days=offset))
+            os.makedirs(path, exist_ok=True)
+            created.append(path)
+    return created
+
+
+def _directory_day(path, directory):
+    """Restituisce la data di una cartella `{camera}/{YYYY}/{MM}/{DD}` (o None)"""
+    parts = os.path.relpath(path, directory).split(os.sep)
+    if len(parts) != 4:
+        return None
+    try:
+        return date(int(parts[1]), int(parts[2]), int(parts[3]))
+    except ValueError:
+        return None
+
+
+def prune_empty_day_directories(segment_path, directory):
+    """
+    Rimuove la cartella del giorno di un segmento eliminato, e le cartelle di
+    mese e anno, se sono rimaste vuote. Le cartelle di oggi e dei giorni
+    successivi (create in anticipo per ffmpeg) non vengono mai toccate.
+    """
+    day_dir = os.path.dirname(segment_path)
+    day = _directory_day(day_dir, directory)
+    if day is None or day >= date.today():
+        return
+    camera_dir = os.path.dirname(os.path.dirname(os.path.dirname(day_dir)))
+    current = day_dir
+    while current != camera_dir:
+        try:
+            os.rmdir(current)
+        except OSError:
+            return  # non vuota (o già rimossa)
+        current = os.path.dirname(current)
+
+
+class LayoutMigrator:
+    """Sposta in background i segmenti del layout flat nelle cartelle per giorno."""
+
+    def __init__(self, catalog, directory, min_age=MIGRATION_MIN_AGE, pause=MIGRATION_PAUSE):
+        """
+        Args:
+            catalog (SegmentCatalog): Catalogo da aggiornare con i nuovi percorsi
+            directory (str): Cartella delle registrazioni
+            min_age (int): Secondi dall'ultima modifica sotto i quali un file non si sposta
+            pause (float): Pausa tra due spostamenti
+        """
+        self.catalog = catalog
+        self.directory = directory
+        self.min_age = min_age
+        self.pause = pause
+        self.moved = 0
+        self.running = False
+
+    def pending(self):
+        """Indica se nella cartella principale restano segmenti da spostare"""
+        with os.scandir(self.directory) as entries:
+            return any(entry.is_file() and parse_segment_name(entry.name)[0] for entry in entries)
+
+    def run(self):
+        """
+        Sposta tutti i segmenti flat non più in scrittura.
+
+        Gli spostamenti sono rename nello stesso filesystem: i registratori
+        non vengono interrotti e un file in lettura resta valido.
+
+        Returns:
+            int: Segmenti spostati
+        """
+        self.running = True
+        started = time.time()
+        moved = 0
+        try:
+            with os.scandir(self.directory) as entries:
+                candidates = [entry.name for entry in entries if entry.is_file()]
+
+            for filename in candidates:
+                camera, start_ts = parse_segment_name(filename)
+                if camera is None:
+                    continue
+                source = os.path.join(self.directory, filename)
+                try:
+                    if time.time() - os.stat(source).st_mtime < self.min_age:
+                        continue  # probabilmente ancora in scrittura
+                except FileNotFoundError:
+                    continue
+
+                target_dir = day_directory(self.directory, camera, datetime.fromtimestamp(start_ts).date())
+                target = os.path.join(target_dir, filename)
+                try:
+                    os.makedirs(target_dir, exist_ok=True)
+                    os.rename(source, target)
+                except FileNotFoundError:
+                    continue  # eliminato nel frattempo
+                except OSError as e:
+                    logging.error(f"❌ Migrazione {filename}: {e}")
+                    continue
+
+                # Una rinomina riuscita lascia l'unica copia: se mancava nel catalogo la si registra
+                self.catalog.move_segment(source, target, register_missing=True)
+                moved += 1
+                self.moved += 1
+                if moved % 1000 == 0:
+                    logging.info(f"📦 Migrazione layout: {moved} segmenti spostati")
+                time.sleep(self.pause)
+        finally:
+            self.running = False
+
+        logging.info(f"📦 Migrazione layout completata: {moved} segmenti spostati in {time.time() - started:.0f}s")
+        return moved
+
+    def start(self):
+        """Avvia la migrazione in un thread in background"""
+        thread = threading.Thread(target=self.run, name="layout-migrator", daemon=True)
+        thread.start()
+        return thread
+
+
+if __name__ == "__main__":
+    import sys
+
+    import config
+    from segment_catalog import CATALOG_FILENAME, SegmentCatalog
+
+    if len(sys.argv) < 2 or sys.argv[1] != "migrate":
+        print("Uso: python3 storage_layout.py migrate")
+        sys.exit(1)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    catalog = SegmentCatalog(os.path.join(config.REGISTRAZIONI_DIR, CATALOG_FILENAME))
+    LayoutMigrator(catalog, config.REGISTRAZIONI_DIR).run()
@@ -0,0 +1,189 @@
+"""
+Pool di volumi per le registrazioni e assegnazione delle telecamere.
+
+Con un solo disco SATA il limite di scrittura sequenziale si raggiunge
+intorno alle 20 telecamere ad alto bitrate. Il pool distribuisce le
+telecamere su più volumi scegliendo, per ciascuna, il volume che resterebbe
+pieno più tardi: spazio libero diviso per il bitrate totale (misurato) delle
+telecamere che vi scrivono. Le assegnazioni sono persistenti, quindi un
+riavvio non sposta le telecamere. Solo quando un volume supera la soglia di
+ribilanciamento (sopra quella della pulizia: la conservazione non riesce più a
+contenerlo) si sposta una telecamera alla volta, senza toccare le altre, e solo
+verso un volume nettamente migliore.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+import psutil
+
+# File (nella cartella registrazioni principale) con le assegnazioni telecamera -> volume
+PLACEMENT_FILENAME = ".placement.json"
+
+# Bitrate ipotizzato per le telecamere mai misurate (4 Mbit/s, in byte/s)
+DEFAULT_BYTE_RATE = 4_000_000 / 8
+
+# Il volume di destinazione deve restare libero almeno questo multiplo del tempo di quello pieno
+REBALANCE_MIN_GAIN = 1.5
+
+# Secondi prima che la stessa telecamera possa essere spostata di nuovo
+REBALANCE_COOLDOWN = 6 * 3600
+
+
+class StoragePool:
+    """Volumi di registrazione e assegnazione telecamera -> volume."""
+
+    def __init__(self, volumes, state_path, high_watermark=94.0, rebalance_watermark=97.0,
+                 min_gain=REBALANCE_MIN_GAIN, cooldown=REBALANCE_COOLDOWN):
+        """
+        Args:
+            volumes (list): Cartelle delle registrazioni, una per volume
+            state_path (str): File JSON dove salvare le assegnazioni
+            high_watermark (float): Percentuale oltre la quale un volume è pieno
+            rebalance_watermark (float): Percentuale oltre la quale si sposta una telecamera
+                (mai sotto high_watermark, gestita dalla pulizia)
+            min_gain (float): Guadagno minimo di autonomia (spazio libero / byte/s) del volume di destinazione
+            cooldown (float): Secondi minimi tra due spostamenti della stessa telecamera
+        """
+        self.volumes = list(volumes)
+        self.state_path = state_path
+        self.high_watermark = high_watermark
+        self.rebalance_watermark = max(rebalance_watermark, high_watermark)
+        self.min_gain = min_gain
+        self.cooldown = cooldown
+        self._moved_at = {}  # telecamera -> time.monotonic() dell'ultimo spostamento
+        self._lock = threading.Lock()
+        self.assignments = self._load()
+
+    def _load(self):
+        try:
+            with open(self.state_path) as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logging.warning(f"⚠️ Assegnazioni volumi non leggibili, le ricalcolo: {e}")
+            return {}
+        # Ignora i volumi non più presenti nel pool
+        return {camera: volume for camera, volume in saved.items() if volume in self.volumes}
+
+    def _save(self):
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.assignments, f, indent=2)
+        os.replace(tmp_path, self.state_path)
+
+    def usage(self, volume):
+        """psutil.disk_usage del volume"""
+        return psutil.disk_usage(volume)
+
+    def usage_percent(self, volume):
+        usage = self.usage(volume)
+        return (usage.used / usage.total) * 100
+
+    def is_full(self, volume):
+        return self.usage_percent(volume) >= self.high_watermark
+
+    def volume_of(self, path):
+        """Volume che contiene il percorso (None se esterno al pool)"""
+        path = os.path.abspath(path)
+        matches = [volume for volume in self.volumes
+                   if path == volume or path.startswith(volume.rstrip(os.sep) + os.sep)]
+        return max(matches, key=len) if matches else None
+
+    def volume_for(self, camera):
+        """Volume assegnato alla telecamera (None se non ancora assegnata)"""
+        return self.assignments.get(camera)
+
+    def _loads(self, rates, exclude_camera=None):
+        """Byte/s scritti su ogni volume dalle telecamere assegnate"""
+        loads = {volume: 0.0 for volume in self.volumes}
+        for camera, volume in self.assignments.items():
+            if camera != exclude_camera and volume in loads:
+                loads[volume] += rates.get(camera, DEFAULT_BYTE_RATE)
+        return loads
+
+    def _best_volume(self, rate, loads, exclude=()):
+        """Volume che resterebbe pieno più tardi aggiungendo `rate` byte/s"""
+        candidates = [volume for volume in self.volumes if volume not in exclude]
+        not_full = [volume for volume in candidates if not self.is_full(volume)]
+        candidates = not_full or candidates
+        if not candidates:
+            return None
+        return max(candidates, key=lambda volume: self.usage(volume).free / (loads[volume] + rate))
+
+    def assign(self, cameras, rates):
+        """
+        Assegna un volume alle telecamere che non ne hanno uno valido.
+
+        Le telecamere già assegnate restano dove sono; le nuove vengono
+        distribuite in ordine di bitrate decrescente.
+
+        Args:
+            cameras (list): Nomi delle telecamere
+            rates (dict): telecamera -> byte/s misurati
+
+        Returns:
+            dict: telecamera -> volume
+        """
+        with self._lock:
+            loads = self._loads(rates)
+            unassigned = [camera for camera in cameras if camera not in self.assignments]
+            for camera in sorted(unassigned, key=lambda c: rates.get(c, DEFAULT_BYTE_RATE), reverse=True):
+                rate = rates.get(camera, DEFAULT_BYTE_RATE)
+                volume = self._best_volume(rate, loads)
+                self.assignments[camera] = volume
+                loads[volume] += rate
+                logging.info(f"💽 {camera} assegnata al volume {volume} ({rate * 8 / 1e6:.1f} Mbit/s)")
+            if unassigned:
+                self._save()
+            return {camera: self.assignments[camera] for camera in cameras}
+
+    def rebalance(self, rates):
+        """
+        Sposta la telecamera con il bitrate più alto fuori da ogni volume oltre la
+        soglia di ribilanciamento, se un altro volume garantisce un'autonomia
+        nettamente maggiore. Una telecamera spostata resta ferma per `cooldown` secondi.
+
+        Returns:
+            list: (telecamera, volume precedente, nuovo volume) per ogni spostamento
+        """
+        moves = []
+        if len(self.volumes) < 2:
+            return moves
+        with self._lock:
+            now = time.monotonic()
+            loads = self._loads(rates)
+            for volume in self.volumes:
+                # Sotto la soglia la pulizia basta a contenere il volume
+                if self.usage_percent(volume) < self.rebalance_watermark:
+                    continue
+                cameras = [camera for camera, assigned in self.assignments.items()
+                           if assigned == volume and now - self._moved_at.get(camera, -self.cooldown) >= self.cooldown]
+                if not cameras:
+                    continue
+                camera = max(cameras, key=lambda c: rates.get(c, DEFAULT_BYTE_RATE))
+                rate = rates.get(camera, DEFAULT_BYTE_RATE)
+                others = [other for other in self.volumes if other != volume and not self.is_full(other)]
+                if not others:
+                    continue
+                target = self._best_volume(rate, self._loads(rates, exclude_camera=camera),
+                                           exclude=[v for v in self.volumes if v not in others])
+                # Autonomia prevista: spazio libero / byte/s, sul volume di destinazione con la telecamera in più
+                current = self.usage(volume).free / max(loads[volume], 1)
+                projected = self.usage(target).free / (loads[target] + rate)
+                if projected < current * self.min_gain:
+                    logging.info(f"💽 {camera} resta su {volume}: {target} non offre abbastanza autonomia "
+                                 f"({projected / 3600:.1f}h contro {current / 3600:.1f}h)")
+                    continue
+                self.assignments[camera] = target
+                self._moved_at[camera] = now
+                loads[volume] -= rate
+                loads[target] += rate
+                moves.append((camera, volume, target))
+            if moves:
+                self._save()
+        return moves
@@ -0,0 +1,223 @@
+"""
+Livelli di storage: registrazione su disco veloce, archivio su disco lento.
+
+Con il livello "hot" attivo ffmpeg scrive su un disco locale o SSD; il
+mover sposta i segmenti chiusi sul livello "cold" (il disco esterno o i
+volumi del pool) con copie sequenziali grandi nel kernel
+(copy_file_range, con ripiego su sendfile) e un limite di byte/s.
+Così l'HDD riceve scritture sequenziali invece di una dozzina di append
+concorrenti. Il catalogo viene aggiornato dopo ogni spostamento e
+`resolve_segment_path` trova un segmento su uno qualsiasi dei due livelli.
+"""
+
+import errno
+import logging
+import os
+import threading
+import time
+
+import psutil
+
+from storage_layout import prune_empty_day_directories
+
+# Secondi dalla chiusura prima che un segmento venga spostato
+MOVE_MIN_AGE = 30
+# Intervallo tra due controlli del livello hot
+MOVE_INTERVAL = 15
+# Byte copiati per ogni chiamata di copia
+COPY_CHUNK = 8 * 1024 * 1024
+# Segmenti letti dal catalogo per ogni giro
+_BATCH_SIZE = 50
+
+# Errori per cui copy_file_range non è utilizzabile tra i due filesystem
+_COPY_RANGE_UNSUPPORTED = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP)
+
+
+def cold_path(path, hot_dir, cold_dir):
+    """Percorso di un segmento hot sul volume cold (stessa struttura di cartelle)"""
+    return os.path.join(cold_dir, os.path.relpath(path, hot_dir))
+
+
+def resolve_segment_path(path, hot_dir, cold_dirs):
+    """
+    Restituisce il percorso attuale di un segmento, su qualunque livello.
+
+    Un percorso letto dal catalogo può riferirsi al livello hot mentre il
+    mover lo sta spostando: in quel caso si cerca la copia sui volumi cold.
+
+    Returns:
+        str | None: Percorso esistente o None
+    """
+    if os.path.exists(path):
+        return path
+    if hot_dir and path.startswith(hot_dir.rstrip(os.sep) + os.sep):
+        for cold_dir in cold_dirs:
+            candidate = cold_path(path, hot_dir, cold_dir)
+            if os.path.exists(candidate):
+                return candidate
+    return None
+
+
+class TierMover:
+    """Sposta in background i segmenti chiusi dal livello hot a quello cold."""
+
+    def __init__(self, catalog, hot_dir, destination, bytes_per_second=0, skip=None,
+                 min_age=MOVE_MIN_AGE, interval=MOVE_INTERVAL):
+        """
+        Args:
+            catalog (SegmentCatalog): Catalogo da aggiornare con i nuovi percorsi
+            hot_dir (str): Cartella del livello hot
+            destination (callable): telecamera -> cartella cold di destinazione
+            bytes_per_second (int): Limite di copia (0 = illimitato)
+            skip (callable): Restituisce i percorsi da non spostare (es. in eliminazione)
+            min_age (int): Secondi dalla chiusura prima dello spostamento
+            interval (int): Secondi tra due controlli
+        """
+        self.catalog = catalog
+        self.hot_dir = hot_dir
+        self.destination = destination
+        self.bytes_per_second = bytes_per_second
+        self.skip = skip or (lambda: ())
+        self.min_age = min_age
+        self.interval = interval
+        self.moved = 0
+        self.bytes_moved = 0
+        self.failed = 0
+        self._window_start = time.monotonic()
+        self._window_bytes = 0
+
+    def start(self):
+        thread = threading.Thread(target=self._run, name="tier-mover", daemon=True)
+        thread.start()
+        logging.info(f"🚚 Spostamento segmenti {self.hot_dir} → livello cold avviato")
+        return thread
+
+    def metrics(self):
+        """
+        Returns:
+            dict: moved, bytes_moved, failed, backlog (segmenti chiusi ancora sul livello hot)
+        """
+        backlog = self.catalog.directory_totals(self.hot_dir)
+        return {"moved": self.moved, "bytes_moved": self.bytes_moved, "failed": self.failed,
+                "backlog_files": backlog["files"], "backlog_bytes": backlog["bytes"]}
+
+    def _run(self):
+        try:
+            # Copie in background: priorità I/O più bassa della classe best-effort
+            psutil.Process(threading.get_native_id()).ionice(psutil.IOPRIO_CLASS_BE, value=7)
+        except (AttributeError, psutil.Error, OSError, ValueError) as e:
+            logging.warning(f"⚠️ Impossibile ridurre la priorità I/O dello spostamento: {e}")
+
+        while True:
+            try:
+                moved = self.run_once()
+            except Exception as e:
+                logging.error(f"❌ Errore spostamento livello cold: {e}")
+                moved = 0
+            if moved < _BATCH_SIZE:
+                time.sleep(self.interval)
+
+    def run_once(self):
+        """
+        Sposta un gruppo di segmenti chiusi.
+
+        Returns:
+            int: Segmenti spostati
+        """
+        skip = set(self.skip())
+        segments = self.catalog.oldest_segments(limit=_BATCH_SIZE, ended_before=time.time() - self.min_age,
+                                                directory=self.hot_dir)
+        moved = 0
+        for segment in segments:
+            if segment["path"] in skip:
+                continue
+            target_dir = self.destination(segment["camera"])
+            if not target_dir:
+                continue
+            if self.move(segment["path"], cold_path(segment["path"], self.hot_dir, target_dir)):
+                moved += 1
+        return moved
+
+    def move(self, source, target):
+        """
+        Copia un segmento sul livello cold, aggiorna il catalogo ed elimina l'originale.
+
+        Returns:
+            bool: True se il segmento è stato spostato
+        """
+        partial = target + ".part"
+        try:
+            st = os.stat(source)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(source, "rb") as src, open(partial, "wb") as dst:
+                self._copy(src.fileno(), dst.fileno(), st.st_size)
+                os.fsync(dst.fileno())
+            # Conserva l'mtime: la ricostruzione del catalogo lo usa come fine segmento
+            os.utime(partial, ns=(st.st_atime_ns, st.st_mtime_ns))
+            if source in set(self.skip()):
+                self._discard(partial)
+                return False  # accodato per l'eliminazione durante la copia
+            os.rename(partial, target)
+        except FileNotFoundError:
+            self._discard(partial)
+            return False  # eliminato nel frattempo
+        except OSError as e:
+            self._discard(partial)
+            self.failed += 1
+            logging.error(f"❌ Spostamento di {os.path.basename(source)} fallito: {e}")
+            return False
+
+        if not self.catalog.move_segment(source, target):
+            # Eliminato (voce rimossa) durante la copia: la copia non deve riportarlo nel catalogo
+            self._discard(target)
+            return False
+        try:
+            os.unlink(source)
+        except FileNotFoundError:
+            pass
+        prune_empty_day_directories(source, self.hot_dir)
+        self.moved += 1
+        self.bytes_moved += st.st_size
+        return True
+
+    @staticmethod
+    def _discard(path):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    def _copy(self, src_fd, dst_fd, size):
+        """Copia nel kernel a blocchi grandi, rispettando il limite di byte/s"""
+        use_copy_range = hasattr(os, "copy_file_range")
+        offset = 0
+        while offset < size:
+            count = min(COPY_CHUNK, size - offset)
+            copied = None
+            if use_copy_range:
+                try:
+                    copied = os.copy_file_range(src_fd, dst_fd, count, offset, offset)
+                except OSError as e:
+                    if e.errno not in _COPY_RANGE_UNSUPPORTED:
+                        raise
+                    use_copy_range = False
+            if copied is None:
+                os.lseek(dst_fd, offset, os.SEEK_SET)
+                copied = os.sendfile(dst_fd, src_fd, offset, count)
+            if copied == 0:
+                break  # il file si è accorciato
+            offset += copied
+            self._throttle(copied)
+
+    def _throttle(self, copied):
+        if not self.bytes_per_second:
+            return
+        self._window_bytes += copied
+        elapsed = time.monotonic() - self._window_start
+        expected = self._window_bytes / self.bytes_per_second
+        if expected > elapsed:
+            time.sleep(expected - elapsed)
+        if elapsed > 60:
+            # Finestra scorrevole: le pause tra un giro e l'altro non accumulano credito
+            self._window_start = time.monotonic()
+            self._window_bytes = 0
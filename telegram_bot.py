@@ -6,13 +6,25 @@ import time
 import pathlib
 import subprocess
 import logging
+from collections import OrderedDict
 from functools import wraps
+from datetime import date, datetime, timedelta
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, BotCommand
-from config import REGISTRAZIONI_DIR, USE_EXTERNAL_DRIVE, EXTERNAL_MOUNT_POINT, unmount_hard_drive, load_camera_config, CONFIG_FILE
+from config import THUMBNAIL_MAX_AGE, THUMBNAIL_WIDTH, REGISTRAZIONI_DIR, STORAGE_VOLUMES, HOT_TIER_DIR, USE_EXTERNAL_DRIVE, EXTERNAL_MOUNT_POINT, unmount_hard_drive, load_camera_config, CONFIG_FILE
 from secure_executor import SecureCommandExecutor
 from telegram_notifier import send_telegram_message
 from language_manager import init_language, get_translation
 from security_manager import SecurityManager
+from segment_catalog import SegmentCatalog, CATALOG_FILENAME
+from storage_accountant import StorageAccountant
+from storage_tiering import resolve_segment_path
+from clip_exporter import CLIPS_DIRNAME, ClipExporter, ClipExportError, parse_clip_range
+from ffmpeg_command import build_snapshot_command
+from media_jobs import MediaJobPool
+from keyframe_index import KEYFRAMES_DIRNAME, KeyframeIndex
+from activity_timeline import TIMELINE_DIRNAME, ActivityTimeline, sparkline
+from mosaic import Mosaic
+from thumbnail_cache import ThumbnailCache
 
 # Inizializza il security manager per decifrare le credenziali
 security_manager = SecurityManager(CONFIG_FILE)
@@ -58,6 +70,29 @@ bot = telebot.TeleBot(TELEGRAM_BOT_TOKEN)
 # Inizializza secure executor
 secure_executor = SecureCommandExecutor()
 
+# Catalogo dei segmenti condiviso con il servizio NVR
+segment_catalog = SegmentCatalog(os.path.join(REGISTRAZIONI_DIR, CATALOG_FILENAME))
+storage_accountant = StorageAccountant(segment_catalog, STORAGE_VOLUMES)
+
+# Clip e istantanee: pochi thread dedicati, il polling resta reattivo
+keyframe_index = KeyframeIndex(os.path.join(REGISTRAZIONI_DIR, KEYFRAMES_DIRNAME), workers=0)  # Solo lettura
+clip_exporter = ClipExporter(segment_catalog, os.path.join(REGISTRAZIONI_DIR, CLIPS_DIRNAME),
+                             resolve=lambda path: resolve_segment_path(path, HOT_TIER_DIR, STORAGE_VOLUMES),
+                             keyframes=keyframe_index)
+media_jobs = MediaJobPool(max_workers=2, max_pending=4)
+activity_timeline = ActivityTimeline(os.path.join(REGISTRAZIONI_DIR, TIMELINE_DIRNAME))  # Solo lettura
+ACTIVITY_MAX_PERIODS = 10
+ACTIVITY_CLIP_PADDING = 5  # Secondi aggiunti prima e dopo ogni periodo nei comandi /clip suggeriti
+sent_clips = OrderedDict()  # (telecamera, inizio, fine) -> (istante, file_id Telegram), per non ricaricare la stessa clip
+SENT_CLIPS_MAX = 50
+SENT_CLIPS_TTL = 24 * 3600
+snapshot_cache = {}  # telecamera -> (istante, JPEG)
+SNAPSHOT_CACHE_TTL = 10
+SNAPSHOT_TIMEOUT = 15
+TELEGRAM_UPLOAD_LIMIT = 50 * 1024 * 1024  # Limite di upload dei bot
+thumbnails = ThumbnailCache(max_age=THUMBNAIL_MAX_AGE, width=THUMBNAIL_WIDTH or None)  # Condivise con l'NVR
+mosaic = Mosaic(thumbnails=thumbnails)  # Cache su tmpfs condivisa con il server HTTP dell'NVR
+
 # Inizializza il gestore lingue (legge automaticamente da config.ini)
 try:
     init_language()
@@ -84,6 +119,10 @@ def set_bot_commands():
         BotCommand("storage_stats", "💾 " + get_translation("bot", "storage_stats").split("*")[1].strip()),
         BotCommand("process_status", "⚙️ " + get_translation("bot", "process_status").split("*")[1].strip()),
         BotCommand("cleanup_storage", "🗑️ " + get_translation("bot", "cleanup_storage").replace("...", "")),
+        BotCommand("clip", "🎬 " + get_translation("bot", "clip_command_description")),
+        BotCommand("snapshot", "📸 " + get_translation("bot", "snapshot_command_description")),
+        BotCommand("activity", "📈 " + get_translation("bot", "activity_command_description")),
+        BotCommand("mosaic", "🧩 " + get_translation("bot", "mosaic_command_description")),
         BotCommand("reboot", "🔄 " + get_translation("bot", "reboot").replace("...", "")),
         BotCommand("shutdown", "⚡ " + get_translation("bot", "shutdown").replace("...", ""))
     ]
@@ -429,19 +468,15 @@ def system_health_command(message):
 def storage_stats_command(message):
     """Mostra statistiche dettagliate dello storage"""
     try:
-        import pathlib
-        from pathlib import Path
-        
-        # Calcola statistiche storage manualmente
+        # Statistiche storage dai totali incrementali del catalogo (nessuna scansione del disco)
         usage = psutil.disk_usage(REGISTRAZIONI_DIR)
-        recordings_path = Path(REGISTRAZIONI_DIR)
-        files = list(recordings_path.glob("*.mkv"))
+        totals = storage_accountant.usage()
         
-        total_files = len(files)
+        total_files = totals["files"]
         if total_files > 0:
-            oldest_file = min(files, key=lambda f: f.stat().st_mtime)
-            newest_file = max(files, key=lambda f: f.stat().st_mtime)
-            avg_file_size = sum(f.stat().st_size for f in files) / total_files / (1024**2)  # MB
+            oldest_file = os.path.basename(totals["oldest_path"])
+            newest_file = os.path.basename(totals["newest_path"])
+            avg_file_size = totals["bytes"] / total_files / (1024**2)  # MB
             
             message_text = get_translation('bot', 'storage_stats_title') + "\n\n"
             message_text += get_translation('bot', 'storage_stats_space') + "\n"
@@ -451,8 +486,19 @@ def storage_stats_command(message):
             message_text += get_translation('bot', 'storage_stats_files') + "\n"
             message_text += get_translation('bot', 'storage_stats_total_files', total_files) + "\n"
             message_text += get_translation('bot', 'storage_stats_avg_size', f"{avg_file_size:.1f}") + "\n"
-            message_text += get_translation('bot', 'storage_stats_oldest', oldest_file.name) + "\n"
-            message_text += get_translation('bot', 'storage_stats_newest', newest_file.name) + "\n\n"
+            message_text += get_translation('bot', 'storage_stats_oldest', oldest_file) + "\n"
+            message_text += get_translation('bot', 'storage_stats_newest', newest_file) + "\n\n"
+            if len(STORAGE_VOLUMES) > 1:
+                message_text += get_translation('bot', 'storage_stats_volumes') + "\n"
+                for volume in STORAGE_VOLUMES:
+                    volume_usage = psutil.disk_usage(volume)
+                    volume_totals = segment_catalog.directory_totals(volume)
+                    message_text += get_translation('bot', 'storage_stats_volume', volume,
+                                                    f"{volume_usage.used / (1024**3):.1f}",
+                                                    f"{volume_usage.total / (1024**3):.1f}",
+                                                    f"{(volume_usage.used / volume_usage.total) * 100:.1f}",
+                                                    volume_totals["files"]) + "\n"
+                message_text += "\n"
             message_text += get_translation('bot', 'storage_stats_path', REGISTRAZIONI_DIR)
         else:
             message_text = get_translation('bot', 'storage_stats_no_files')
@@ -508,50 +554,55 @@ def cleanup_storage_command(message):
     except Exception as e:
         bot.reply_to(message, get_translation("bot", "cleanup_storage_error", str(e)))
 
+def _run_cleanup_job(progress):
+    """Elimina i 10 segmenti più vecchi fuori dal thread di polling"""
+    # Pulizia manuale semplificata sul catalogo dei segmenti
+    if segment_catalog.is_empty():
+        bot.edit_message_text(get_translation("bot", "cleanup_no_files"),
+                              progress.chat.id, progress.message_id, parse_mode='Markdown')
+        return
+
+    # Protezione: non eliminare file terminati da meno di 1 ora (più vecchi per primi)
+    safe_files = segment_catalog.oldest_segments(limit=10, ended_before=time.time() - 3600)
+
+    if not safe_files:
+        bot.edit_message_text(get_translation("bot", "cleanup_no_safe_files"),
+                              progress.chat.id, progress.message_id, parse_mode='Markdown')
+        return
+
+    # Elimina i primi 10 file più vecchi
+    deleted = 0
+    for segment in safe_files:
+        # Il catalogo può indicare il livello hot mentre il file è già sul volume cold
+        path = resolve_segment_path(segment["path"], HOT_TIER_DIR, STORAGE_VOLUMES)
+        if path is None:
+            logging.warning(f"⚠️ Segmento non trovato su disco: {os.path.basename(segment['path'])}")
+            continue
+        try:
+            os.unlink(path)
+        except Exception as e:
+            logging.error(f"Errore eliminazione {os.path.basename(path)}: {e}")
+            continue
+        # Riga del catalogo rimossa solo dopo un'eliminazione riuscita
+        deleted += 1
+        segment_catalog.remove_segment(segment["path"])
+        keyframe_index.remove(segment["path"])
+
+    if deleted > 0:
+        bot.edit_message_text(get_translation("bot", "cleanup_completed", deleted),
+                              progress.chat.id, progress.message_id, parse_mode='Markdown')
+    else:
+        bot.edit_message_text(get_translation("bot", "cleanup_failed"),
+                              progress.chat.id, progress.message_id, parse_mode='Markdown')
+
 @bot.callback_query_handler(func=lambda call: call.data in ["confirm_cleanup", "cancel_cleanup"])
 def handle_cleanup_callback(call):
     """Gestisce la conferma pulizia storage"""
     try:
         if call.data == "confirm_cleanup":
-            from pathlib import Path
-            import time
-            
-            # Pulizia manuale semplificata
-            recordings_path = Path(REGISTRAZIONI_DIR)
-            files = list(recordings_path.glob("*.mkv"))
-            
-            if not files:
-                bot.edit_message_text(get_translation("bot", "cleanup_no_files"),
-                                    call.message.chat.id, call.message.message_id, parse_mode='Markdown')
-                return
-            
-            # Ordina per data di modifica (più vecchi per primi)
-            files.sort(key=lambda f: f.stat().st_mtime)
-            
-            # Protezione: non eliminare file più recenti di 1 ora
-            current_time = time.time()
-            safe_files = [f for f in files if current_time - f.stat().st_mtime > 3600]
-            
-            if not safe_files:
-                bot.edit_message_text(get_translation("bot", "cleanup_no_safe_files"),
-                                    call.message.chat.id, call.message.message_id, parse_mode='Markdown')
-                return
-            
-            # Elimina i primi 10 file più vecchi
-            deleted = 0
-            for file in safe_files[:10]:
-                try:
-                    file.unlink()
-                    deleted += 1
-                except Exception as e:
-                    logging.error(f"Errore eliminazione {file.name}: {e}")
-            
-            if deleted > 0:
-                bot.edit_message_text(get_translation("bot", "cleanup_completed", deleted),
-                                    call.message.chat.id, call.message.message_id, parse_mode='Markdown')
-            else:
-                bot.edit_message_text(get_translation("bot", "cleanup_failed"),
-                                    call.message.chat.id, call.message.message_id, parse_mode='Markdown')
+            status = media_jobs.submit(("cleanup",), _run_cleanup_job, call.message)
+            if status != "queued":
+                _edit_progress(call.message, get_translation("bot", f"media_{status}"))
         else:
             bot.edit_message_text(get_translation("bot", "cleanup_cancelled"),
                                 call.message.chat.id, call.message.message_id, parse_mode='Markdown')
@@ -559,6 +610,209 @@ def handle_cleanup_callback(call):
         bot.edit_message_text(get_translation("bot", "cleanup_error_during", str(e)),
                             call.message.chat.id, call.message.message_id)
 
+### CLIP E ISTANTANEE ###
+def _edit_progress(progress, text):
+    """Aggiorna sul posto il messaggio di avanzamento"""
+    try:
+        bot.edit_message_text(text, progress.chat.id, progress.message_id)
+    except Exception as e:
+        logging.warning(f"⚠️ Aggiornamento messaggio non riuscito: {e}")
+
+def _recent_clip(key):
+    """file_id di una clip inviata di recente per la stessa richiesta (None se assente o scaduta)"""
+    entry = sent_clips.get(key)
+    if entry is None:
+        return None
+    if time.time() - entry[0] >= SENT_CLIPS_TTL:
+        sent_clips.pop(key, None)
+        return None
+    sent_clips.move_to_end(key)
+    return entry[1]
+
+def _remember_clip(key, file_id):
+    sent_clips[key] = (time.time(), file_id)
+    sent_clips.move_to_end(key)
+    while len(sent_clips) > SENT_CLIPS_MAX:
+        sent_clips.popitem(last=False)
+
+def _run_clip_job(progress, key, camera, start_ts, end_ts):
+    """Esporta una clip e la invia, aggiornando il messaggio di avanzamento"""
+    try:
+        parts = clip_exporter.plan(camera, start_ts, end_ts)
+        _edit_progress(progress, get_translation("bot", "clip_exporting", camera, len(parts)))
+        clip = clip_exporter.export(camera, start_ts, end_ts)
+    except ClipExportError as e:
+        _edit_progress(progress, get_translation("bot", "clip_error", str(e)))
+        return
+
+    if clip["size"] > TELEGRAM_UPLOAD_LIMIT:
+        _edit_progress(progress, get_translation("bot", "clip_too_large", f"{clip['size'] / (1024**2):.0f}"))
+        return
+
+    caption = get_translation("bot", "clip_caption", camera,
+                              time.strftime("%d/%m %H:%M:%S", time.localtime(clip["start_ts"])),
+                              time.strftime("%H:%M:%S", time.localtime(clip["end_ts"])))
+    _edit_progress(progress, get_translation("bot", "clip_uploading", f"{clip['size'] / (1024**2):.1f}"))
+    try:
+        with open(clip["path"], "rb") as video:
+            sent = bot.send_video(progress.chat.id, video, caption=caption, supports_streaming=True, timeout=300)
+    except Exception as e:
+        logging.error(f"❌ Invio clip {camera} fallito: {e}")
+        _edit_progress(progress, get_translation("bot", "clip_error", str(e)))
+        return
+    # Solo le clip complete vengono riusate per la stessa richiesta
+    if sent.video and clip["end_ts"] >= end_ts:
+        _remember_clip(key, sent.video.file_id)
+    _edit_progress(progress, get_translation("bot", "clip_done", clip["segments"], f"{clip['elapsed']:.1f}"))
+
+@bot.message_handler(commands=['clip'])
+@authorized_only
+def clip_command(message):
+    """Esporta e invia la registrazione di una telecamera: /clip <telecamera> <da> <a>"""
+    args = message.text.split()[1:]
+    if len(args) != 3:
+        bot.reply_to(message, get_translation("bot", "clip_usage"))
+        return
+    camera = args[0]
+    if camera not in segment_catalog.cameras():
+        bot.reply_to(message, get_translation("bot", "camera_unknown", camera))
+        return
+    try:
+        start_ts, end_ts = parse_clip_range(args[1], args[2])
+    except ClipExportError as e:
+        bot.reply_to(message, get_translation("bot", "clip_error", str(e)))
+        return
+
+    key = (camera, int(start_ts), int(end_ts))
+    file_id = _recent_clip(key)
+    if file_id:
+        try:
+            bot.send_video(message.chat.id, file_id, reply_to_message_id=message.message_id)
+            return
+        except Exception as e:
+            # file_id non più valido: si esporta di nuovo
+            logging.warning(f"⚠️ Clip in cache non inviata, la esporto di nuovo: {e}")
+            sent_clips.pop(key, None)
+
+    progress = bot.reply_to(message, get_translation("bot", "clip_searching", camera))
+    status = media_jobs.submit(("clip",) + key, _run_clip_job, progress, key, camera, start_ts, end_ts)
+    if status != "queued":
+        _edit_progress(progress, get_translation("bot", f"media_{status}"))
+
+def _grab_snapshot(camera):
+    """JPEG dell'ultimo fotogramma della telecamera (in cache per pochi secondi)"""
+    # Miniatura dal segmento in scrittura: millisecondi e nessuna sessione RTSP
+    thumbnail = thumbnails.get(camera["name"])
+    if thumbnail:
+        return thumbnail[1]
+    cached = snapshot_cache.get(camera["name"])
+    if cached and time.time() - cached[0] < SNAPSHOT_CACHE_TTL:
+        return cached[1]
+    # Prima dal flusso ritrasmesso (nessuna connessione in più alla telecamera)
+    for url in dict.fromkeys((camera["live_url"], camera["url"])):
+        completed = subprocess.run(build_snapshot_command(url), stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE, timeout=SNAPSHOT_TIMEOUT)
+        if completed.returncode == 0 and completed.stdout:
+            break
+    else:
+        raise RuntimeError(completed.stderr.decode(errors="replace").strip()[-200:] or "nessun fotogramma")
+    snapshot_cache[camera["name"]] = (time.time(), completed.stdout)
+    return completed.stdout
+
+def _run_snapshot_job(progress, camera):
+    try:
+        jpeg = _grab_snapshot(camera)
+    except Exception as e:
+        _edit_progress(progress, get_translation("bot", "snapshot_error", camera["name"], str(e)))
+        return
+    caption = get_translation("bot", "snapshot_caption", camera["name"], time.strftime("%d/%m %H:%M:%S"))
+    bot.send_photo(progress.chat.id, jpeg, caption=caption)
+    bot.delete_message(progress.chat.id, progress.message_id)
+
+@bot.message_handler(commands=['snapshot'])
+@authorized_only
+def snapshot_command(message):
+    """Invia un'istantanea della telecamera: /snapshot <telecamera>"""
+    args = message.text.split()[1:]
+    if len(args) != 1:
+        bot.reply_to(message, get_translation("bot", "snapshot_usage"))
+        return
+    camera = next((cam for cam in load_camera_config(CONFIG_FILE) if cam["name"] == args[0]), None)
+    if camera is None:
+        bot.reply_to(message, get_translation("bot", "camera_unknown", args[0]))
+        return
+
+    progress = bot.reply_to(message, get_translation("bot", "snapshot_capturing", camera["name"]))
+    status = media_jobs.submit(("snapshot", camera["name"]), _run_snapshot_job, progress, camera)
+    if status != "queued":
+        _edit_progress(progress, get_translation("bot", f"media_{status}"))
+
+def _run_mosaic_job(progress):
+    try:
+        jpeg, created = mosaic.get()
+    except Exception as e:
+        _edit_progress(progress, get_translation("bot", "mosaic_error", str(e)))
+        return
+    caption = get_translation("bot", "mosaic_caption", time.strftime("%d/%m %H:%M:%S", time.localtime(created)),
+                              ", ".join(mosaic.camera_names()))
+    bot.send_photo(progress.chat.id, jpeg, caption=caption)
+    bot.delete_message(progress.chat.id, progress.message_id)
+
+@bot.message_handler(commands=['mosaic'])
+@authorized_only
+def mosaic_command(message):
+    """Invia il mosaico di tutte le telecamere in un'unica immagine"""
+    mosaic.set_sources(load_camera_config(CONFIG_FILE))
+    progress = bot.reply_to(message, get_translation("bot", "mosaic_building", len(mosaic.sources)))
+    status = media_jobs.submit(("mosaic",), _run_mosaic_job, progress)
+    if status != "queued":
+        _edit_progress(progress, get_translation("bot", f"media_{status}"))
+
+@bot.message_handler(commands=['activity'])
+@authorized_only
+def activity_command(message):
+    """Attività di una telecamera in un giorno: /activity <telecamera> [AAAA-MM-GG]"""
+    args = message.text.split()[1:]
+    if len(args) not in (1, 2):
+        bot.reply_to(message, get_translation("bot", "activity_usage"))
+        return
+    camera = args[0]
+    try:
+        day = datetime.strptime(args[1], "%Y-%m-%d").date() if len(args) == 2 else date.today()
+    except ValueError:
+        bot.reply_to(message, get_translation("bot", "activity_usage"))
+        return
+    if camera not in activity_timeline.cameras():
+        bot.reply_to(message, get_translation("bot", "activity_no_data", camera))
+        return
+
+    start_ts = datetime(day.year, day.month, day.day).timestamp()
+    # Mezzanotte locale successiva: i giorni del cambio d'ora durano 23 o 25 ore
+    following = day + timedelta(days=1)
+    end_ts = datetime(following.year, following.month, following.day).timestamp()
+    hourly = [score for _, score in activity_timeline.summary(camera, start_ts, end_ts, bucket_seconds=3600)]
+    periods = activity_timeline.busy_periods(camera, start_ts, end_ts)
+
+    lines = [get_translation("bot", "activity_title", camera, day.strftime("%d/%m/%Y")),
+             f"`00 {sparkline(hourly[:12])} 12`", f"`12 {sparkline(hourly[12:])} 24`", ""]
+    if not periods:
+        lines.append(get_translation("bot", "activity_none"))
+    else:
+        lines.append(get_translation("bot", "activity_periods", len(periods)))
+        # I periodi più intensi, in ordine di orario, con il comando /clip pronto
+        strongest = sorted(sorted(periods, key=lambda p: p["peak"], reverse=True)[:ACTIVITY_MAX_PERIODS],
+                           key=lambda p: p["start_ts"])
+        for period in strongest:
+            clip_from = time.strftime("%H:%M:%S", time.localtime(period["start_ts"] - ACTIVITY_CLIP_PADDING))
+            clip_to = time.strftime("%H:%M:%S", time.localtime(period["end_ts"] + ACTIVITY_CLIP_PADDING))
+            if day != date.today():
+                clip_from = f"{day.isoformat()}T{clip_from}"
+                clip_to = f"{day.isoformat()}T{clip_to}"
+            lines.append(f"• {time.strftime('%H:%M:%S', time.localtime(period['start_ts']))} "
+                         f"({period['end_ts'] - period['start_ts']}s, {period['peak'] * 100:.1f}%) "
+                         f"`/clip {camera} {clip_from} {clip_to}`")
+    bot.reply_to(message, "\n".join(lines), parse_mode='Markdown')
+
 def get_health_status(cpu, memory, disk, temp):
     """Restituisce lo stato di salute del sistema"""
     issues = []
@@ -62,3 +62,21 @@ def send_telegram_message(message):
     except requests.exceptions.RequestException as e:
         print(f"⚠️ Errore nell'invio della notifica Telegram: {e}")
         return None
+
+def send_telegram_video(video_path, caption=""):
+    """Invia un breve video (es. clip di un evento) alla chat configurata"""
+    if not TELEGRAM_BOT_TOKEN or not TELEGRAM_CHAT_ID:
+        print("⚠️ Errore: Credenziali Telegram mancanti in telegram_config.ini")
+        return
+
+    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendVideo"
+    data = {"chat_id": TELEGRAM_CHAT_ID, "caption": caption, "supports_streaming": "true"}
+
+    try:
+        with open(video_path, "rb") as video:
+            response = requests.post(url, data=data, files={"video": video}, timeout=120)
+        response.raise_for_status()
+        return response.json()
+    except (requests.exceptions.RequestException, OSError) as e:
+        print(f"⚠️ Errore nell'invio del video Telegram: {e}")
+        return None
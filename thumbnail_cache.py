@@ -0,0 +1,302 @@
+"""
+Miniature dell'ultimo fotogramma delle telecamere senza nuove connessioni RTSP.
+
+L'ultimo keyframe si estrae dal segmento che ffmpeg sta scrivendo: si leggono
+solo le intestazioni del contenitore e la coda del file (al più pochi MB,
+già in page cache), si isola l'ultima unità che inizia con un keyframe
+completo e la si decodifica:
+
+- MPEG-TS: PAT/PMT più i pacchetti dall'ultimo random access indicator;
+- MP4 frammentato: ftyp/moov più l'ultimo frammento (moof + mdat) completo;
+- Matroska: intestazioni fino al primo Cluster più l'ultimo Cluster completo.
+
+Una miniatura costa una decodifica di un solo fotogramma da dati locali
+(decine di ms) invece di connessione, probe e attesa di un keyframe dalla
+telecamera (2-5 s, con una sessione RTSP in più).
+
+Le miniature restano in una cache LRU in memoria e in una cartella su tmpfs
+condivisa tra i processi: il bot legge le miniature estratte dall'NVR e
+viceversa. Il segmento in scrittura di ogni telecamera viene pubblicato
+nella stessa cartella dall'NVR (inotify), così anche il bot sa da dove
+estrarre.
+"""
+
+import fcntl
+import logging
+import os
+import struct
+import subprocess
+import threading
+import time
+from collections import OrderedDict
+from itertools import islice
+
+from event_buffer import TS_PACKET_SIZE, TS_SYNC_BYTE, is_random_access, pmt_pids, ts_pid
+from ffmpeg_command import build_thumbnail_command
+
+# Cartella (tmpfs) delle miniature e dei puntatori ai segmenti in scrittura
+DEFAULT_THUMBNAIL_DIR = "/dev/shm/pws-nvr-thumbs"
+
+# Età massima di una miniatura in cache e miniature tenute in memoria
+DEFAULT_MAX_AGE = 10
+DEFAULT_MAX_ENTRIES = 32
+
+# Un segmento non scritto da più di questi secondi non è più "live"
+STALE_SEGMENT = 120
+
+# Byte letti dalla fine e dall'inizio del segmento
+TAIL_BYTES = 4 * 1024 * 1024
+HEAD_BYTES = 256 * 1024
+
+# Unità (GOP, frammenti, cluster) provate dalla più recente in caso di errore
+MAX_CANDIDATES = 3
+
+# Tempo massimo di decodifica
+THUMBNAIL_TIMEOUT = 10
+
+SEGMENT_POINTER_EXTENSION = ".segment"
+
+_INPUT_FORMATS = {".ts": "mpegts", ".mp4": "mov", ".mkv": "matroska"}
+
+_MKV_CLUSTER_ID = b"\x1f\x43\xb6\x75"
+
+
+# --- Estrazione dell'ultimo keyframe --------------------------------------
+
+def _ts_candidates(head, tail):
+    """Dati TS decodificabili dagli ultimi keyframe completi, dal più recente"""
+    start = next((i for i in range(min(TS_PACKET_SIZE, len(tail)))
+                  if tail[i] == TS_SYNC_BYTE and tail[i + TS_PACKET_SIZE:i + TS_PACKET_SIZE + 1] == b"\x47"), None)
+    if start is None:
+        return []
+    end = start + (len(tail) - start) // TS_PACKET_SIZE * TS_PACKET_SIZE
+    headers = {}
+    pmts = set()
+    keyframes = []  # (offset, PID video)
+    complete = []  # keyframe seguiti da un'altra unità dello stesso PID (quindi interi)
+    for offset in range(start, end, TS_PACKET_SIZE):
+        packet = tail[offset:offset + TS_PACKET_SIZE]
+        if packet[0] != TS_SYNC_BYTE:
+            continue
+        pid = ts_pid(packet)
+        if pid == 0:
+            headers[0] = packet
+            pmts = pmt_pids(packet)
+        elif pid in pmts:
+            headers[pid] = packet
+        elif packet[1] & 0x40:  # payload_unit_start: inizia una nuova unità
+            if keyframes and keyframes[-1][1] == pid and keyframes[-1] not in complete:
+                complete.append(keyframes[-1])
+            if is_random_access(packet):
+                keyframes.append((offset, pid))
+    prefix = b"".join(headers[pid] for pid in sorted(headers))
+    return [prefix + tail[offset:end] for offset, _ in reversed(complete[-MAX_CANDIDATES:])]
+
+
+def _mp4_boxes(data, offset=0):
+    """(offset, dimensione, tipo) dei box consecutivi a partire da `offset`"""
+    while offset + 8 <= len(data):
+        size, kind = struct.unpack_from(">I4s", data, offset)
+        if size == 1 and offset + 16 <= len(data):
+            size = struct.unpack_from(">Q", data, offset + 8)[0]
+        elif size == 0:
+            size = len(data) - offset
+        if size < 8:
+            return
+        yield offset, size, kind
+        offset += size
+
+
+def _mp4_candidates(head, tail):
+    """Intestazioni (ftyp/moov) più gli ultimi frammenti completi, dal più recente"""
+    prefix_end = next((offset for offset, _, kind in _mp4_boxes(head) if kind == b"moof"), None)
+    if prefix_end is None:
+        return []
+    prefix = head[:prefix_end]
+    candidates = []
+    position = len(tail)
+    while len(candidates) < MAX_CANDIDATES:
+        position = tail.rfind(b"moof", 0, position)
+        if position < 4:
+            break
+        start = position - 4
+        boxes = list(islice(_mp4_boxes(tail, start), 2))
+        if [kind for _, _, kind in boxes] == [b"moof", b"mdat"]:
+            mdat_offset, mdat_size, _ = boxes[1]
+            if mdat_offset + mdat_size <= len(tail):
+                candidates.append(prefix + tail[start:mdat_offset + mdat_size])
+        position = start
+    return candidates
+
+
+def _ebml_size(data, offset):
+    """(dimensione, byte occupati) di una dimensione EBML; dimensione None se sconosciuta"""
+    first = data[offset]
+    length = next((i + 1 for i in range(8) if first & (0x80 >> i)), None)
+    if length is None or offset + length > len(data):
+        return None, 0
+    value = first & (0xFF >> length)
+    for byte in data[offset + 1:offset + length]:
+        value = (value << 8) | byte
+    return (None if value == (1 << (7 * length)) - 1 else value), length
+
+
+def _mkv_candidates(head, tail):
+    """Intestazioni fino al primo Cluster più gli ultimi Cluster completi, dal più recente"""
+    prefix_end = head.find(_MKV_CLUSTER_ID)
+    if prefix_end <= 0:
+        return []
+    prefix = head[:prefix_end]
+    candidates = []
+    position = len(tail)
+    while len(candidates) < MAX_CANDIDATES:
+        position = tail.rfind(_MKV_CLUSTER_ID, 0, position)
+        if position < 0 or position + 5 > len(tail):
+            break
+        size, length = _ebml_size(tail, position + 4)
+        if length:
+            end = len(tail) if size is None else position + 4 + length + size
+            if end <= len(tail):
+                candidates.append(prefix + tail[position:end])
+    return candidates
+
+
+_CANDIDATES = {".ts": _ts_candidates, ".mp4": _mp4_candidates, ".mkv": _mkv_candidates}
+
+
+def latest_keyframe_jpeg(path, width=None):
+    """
+    JPEG dell'ultimo keyframe completo di un segmento (anche in scrittura).
+
+    Returns:
+        bytes: JPEG, oppure None se il contenitore non è supportato o non
+        contiene ancora un keyframe completo
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in _CANDIDATES:
+        return None
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        head = f.read(HEAD_BYTES)
+        tail = head if size <= HEAD_BYTES else os.pread(f.fileno(), TAIL_BYTES, max(size - TAIL_BYTES, 0))
+    command = build_thumbnail_command(_INPUT_FORMATS[extension], width)
+    for data in _CANDIDATES[extension](head, tail):
+        completed = subprocess.run(command, input=data, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   timeout=THUMBNAIL_TIMEOUT)
+        if completed.returncode == 0 and completed.stdout:
+            return completed.stdout
+    return None
+
+
+# --- Cache ----------------------------------------------------------------
+
+class ThumbnailCache:
+    """Ultimo fotogramma per telecamera: LRU in memoria più cartella condivisa su tmpfs."""
+
+    def __init__(self, directory=DEFAULT_THUMBNAIL_DIR, max_age=DEFAULT_MAX_AGE, max_entries=DEFAULT_MAX_ENTRIES,
+                 width=None):
+        """
+        Args:
+            directory (str): Cartella (su tmpfs) condivisa tra NVR e bot
+            max_age (float): Età massima di una miniatura prima di estrarne una nuova
+            max_entries (int): Miniature tenute in memoria
+            width (int): Larghezza delle miniature (None = originale)
+        """
+        self.directory = directory
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self.width = width
+        self.hits = 0
+        self.extractions = 0
+        self._entries = OrderedDict()  # telecamera -> (istante, JPEG)
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, camera):
+        return os.path.join(self.directory, f"{camera}.jpg")
+
+    def publish_segment(self, camera, segment_path):
+        """Annota il segmento in scrittura di una telecamera (listener di RecordingActivityTracker)"""
+        pointer = os.path.join(self.directory, camera + SEGMENT_POINTER_EXTENSION)
+        with open(pointer + ".part", "w") as f:
+            f.write(segment_path)
+        os.replace(pointer + ".part", pointer)
+
+    def current_segment(self, camera):
+        """Segmento in scrittura della telecamera, None se sconosciuto o fermo"""
+        try:
+            with open(os.path.join(self.directory, camera + SEGMENT_POINTER_EXTENSION)) as f:
+                segment_path = f.read().strip()
+            if time.time() - os.stat(segment_path).st_mtime > STALE_SEGMENT:
+                return None
+        except (FileNotFoundError, ValueError):
+            return None
+        return segment_path
+
+    def _fresh(self, camera):
+        """Miniatura in cache (memoria o tmpfs) più giovane di max_age"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(camera)
+            if entry and now - entry[0] < self.max_age:
+                self._entries.move_to_end(camera)
+                return entry
+        try:
+            with open(self.path(camera), "rb") as f:
+                created = os.fstat(f.fileno()).st_mtime
+                if now - created >= self.max_age:
+                    return None
+                entry = (created, f.read())
+        except FileNotFoundError:
+            return None
+        self._remember(camera, entry)
+        return entry
+
+    def _remember(self, camera, entry):
+        with self._lock:
+            self._entries[camera] = entry
+            self._entries.move_to_end(camera)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, camera):
+        """
+        Ultimo fotogramma della telecamera, estratto dal segmento in scrittura se la cache è scaduta.
+
+        Returns:
+            tuple: (istante, JPEG), oppure None se non disponibile (usare l'RTSP)
+        """
+        entry = self._fresh(camera)
+        if entry:
+            self.hits += 1
+            return entry
+        segment_path = self.current_segment(camera)
+        if segment_path is None:
+            return None
+
+        with open(self.path(camera) + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # Chi attendeva il lock trova la miniatura appena estratta da un altro
+            entry = self._fresh(camera)
+            if entry:
+                self.hits += 1
+                return entry
+            try:
+                jpeg = latest_keyframe_jpeg(segment_path, self.width)
+            except (OSError, subprocess.SubprocessError) as e:
+                logging.warning(f"⚠️ Miniatura di {camera} non estratta da {os.path.basename(segment_path)}: {e}")
+                return None
+            if not jpeg:
+                return None
+            partial = self.path(camera) + ".part"
+            with open(partial, "wb") as f:
+                f.write(jpeg)
+            os.replace(partial, self.path(camera))
+            entry = (time.time(), jpeg)
+        self.extractions += 1
+        self._remember(camera, entry)
+        return entry
+
+    def file(self, camera):
+        """Percorso della miniatura aggiornata (es. come ingresso del mosaico), None se non disponibile"""
+        return self.path(camera) if self.get(camera) else None